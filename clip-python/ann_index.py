@@ -0,0 +1,89 @@
+import math
+
+import faiss
+import numpy as np
+
+import vector_codec
+
+# Các loại index xấp xỉ hỗ trợ
+ANN_KINDS = ("ivf-flat", "ivf-pq", "hnsw")
+
+
+def default_nlist(n):
+    # Quy tắc thường dùng: ~4*sqrt(N) cụm, mỗi cụm cần >= 39 điểm để train
+    return max(1, min(int(4 * math.sqrt(n)), n // 39 if n >= 39 else 1))
+
+
+def build_ann_index(kind, vectors, ids, nlist=None, nprobe=16, ef_search=64, pq_m=48, hnsw_m=32):
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    ids = np.asarray(ids, dtype="int64")
+    d = vectors.shape[1]
+
+    if kind == "hnsw":
+        # HNSW không cần train; bọc IDMap2 để giữ ID ổn định
+        hnsw = faiss.IndexHNSWFlat(d, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        hnsw.hnsw.efSearch = ef_search
+        index = faiss.IndexIDMap2(hnsw)
+    elif kind in ("ivf-flat", "ivf-pq"):
+        nlist = nlist or default_nlist(len(vectors))
+        quantizer = faiss.IndexFlatIP(d)
+        if kind == "ivf-flat":
+            index = faiss.IndexIVFFlat(quantizer, d, nlist, faiss.METRIC_INNER_PRODUCT)
+        else:
+            # Kho nhỏ: mã PQ ít bit hơn để đủ điểm train cho mỗi tâm (xem vector_codec.pq_nbits)
+            nbits = vector_codec.pq_nbits(len(vectors))
+            index = faiss.IndexIVFPQ(quantizer, d, nlist, pq_m, nbits, faiss.METRIC_INNER_PRODUCT)
+        index.train(vectors)
+        index.nprobe = nprobe
+    else:
+        raise ValueError(f"Loại ANN không hỗ trợ: {kind}")
+
+    if len(vectors):
+        index.add_with_ids(vectors, ids)
+    return index
+
+
+def search_params(index, nprobe=None, ef_search=None, sel=None):
+    # Tham số tìm kiếm theo từng request, không thay đổi trạng thái index dùng chung.
+    # sel: IDSelector giới hạn kết quả trong tập ID cho trước (lọc theo metadata)
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if isinstance(inner, faiss.IndexIVF) and (nprobe or sel is not None):
+        return faiss.SearchParametersIVF(nprobe=int(nprobe or inner.nprobe), sel=sel)
+    if isinstance(inner, faiss.IndexHNSW) and (ef_search or sel is not None):
+        return faiss.SearchParametersHNSW(efSearch=int(ef_search or inner.hnsw.efSearch), sel=sel)
+    if sel is not None:
+        return faiss.SearchParameters(sel=sel)
+    return None
+
+
+def kind_of(index):
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if isinstance(inner, faiss.IndexIVFPQ):
+        return "ivf-pq"
+    if isinstance(inner, faiss.IndexIVF):
+        return "ivf-flat"
+    if isinstance(inner, faiss.IndexHNSW):
+        return "hnsw"
+    return type(inner).__name__
+
+
+def describe(index):
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if isinstance(inner, faiss.IndexIVFPQ):
+        return {"kind": "ivf-pq", "nlist": inner.nlist, "nprobe": inner.nprobe}
+    if isinstance(inner, faiss.IndexIVF):
+        return {"kind": "ivf-flat", "nlist": inner.nlist, "nprobe": inner.nprobe}
+    if isinstance(inner, faiss.IndexHNSW):
+        return {"kind": "hnsw", "efSearch": inner.hnsw.efSearch}
+    return {"kind": type(inner).__name__}
+
+
+def recall_at_k(exact_labels, approx_labels):
+    # Tỉ lệ top-k của index chính xác được index xấp xỉ tìm lại
+    total = 0
+    found = 0
+    for e, a in zip(exact_labels, approx_labels):
+        e = set(e[e >= 0].tolist())
+        total += len(e)
+        found += len(e & set(a[a >= 0].tolist()))
+    return found / float(total) if total else 1.0
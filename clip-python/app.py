@@ -1,247 +1,822 @@
-from flask import Flask, request, jsonify
-import torch
-import faiss
+import time
+_start_time = time.time()
+
+from flask import Flask, request, jsonify, g
 import numpy as np
 import os
 import io
-import cv2
-from PIL import Image
-import time
-from functools import lru_cache
-from transformers import AutoImageProcessor, AutoModel, ConditionalDetrForObjectDetection, ConditionalDetrImageProcessor
-from huggingface_hub import login
+import json
+import urllib.error
+import urllib.request
 
-import shutil
+import detector
+import embedder
+import metrics
+import regions
+import shard
+from profiler import profiler
+from embedder import EMBED_DIM
+from index_store import IndexStore, ReadOnlyIndexError, INDEX_LOAD_MODE
+from ann_index import ANN_KINDS
+from vector_codec import CODECS
+from query_batcher import QueryBatcher
+from job_queue import JobQueue, QueueFullError
+from manifest import Manifest, file_info, scan_dir
+from metadata import MetadataIndex, MetadataError, canonical, check_metadata
+from embedding_cache import content_hash
 
 app = Flask(__name__)
-DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 # === Đường dẫn ===
 INDEX_PATH = "faiss_index_dino.idx"
 PATHS_PATH = "features_paths_dino.npy"
+IDS_PATH = "features_ids_dino.npy"
+VECTORS_PATH = "features_vectors_dino.npy"
+WAL_PATH = "index_dino.wal"
+# Index theo vùng trang phục (REGION_INDEX=1, xem regions.py)
+REGION_INDEX_PATH = "faiss_index_regions.idx"
+REGION_PATHS_PATH = "features_paths_regions.npy"
+REGION_IDS_PATH = "features_ids_regions.npy"
+REGION_VECTORS_PATH = "features_vectors_regions.npy"
+REGION_WAL_PATH = "index_regions.wal"
+JOBS_DB_PATH = "jobs.sqlite3"
+MANIFEST_DB_PATH = "manifest.sqlite3"
+METADATA_DB_PATH = "metadata.sqlite3"
 STORAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "image_storage")
 os.makedirs(STORAGE_DIR, exist_ok=True)
 
 # === Cấu hình tối ưu ===
-# Giới hạn bộ nhớ PyTorch
-torch.backends.cudnn.benchmark = True
-if DEVICE.type == 'cuda':
-    torch.cuda.empty_cache()
-else:
-    # Giới hạn số luồng cho CPU
-    torch.set_num_threads(2)  # Giới hạn số luồng CPU để tránh quá tải
+# torch chỉ được import và cấu hình (số luồng, cudnn) khi tải model lần đầu, xem embedder.setup_torch
 
 # Thêm timeout cho các hoạt động
 TIMEOUT_SECONDS = 30
 
+# Gom các /search đồng thời: một lần forward DINO và một lần index.search cho cả batch
+SEARCH_BATCHING = os.environ.get("SEARCH_BATCHING", "1") == "1"
+SEARCH_BATCH_MAX = int(os.environ.get("SEARCH_BATCH_MAX", "16"))
+SEARCH_BATCH_WAIT_MS = float(os.environ.get("SEARCH_BATCH_WAIT_MS", "5"))
+# Số kết quả tối đa mỗi /search (tham số k)
+SEARCH_K_MAX = 1000
+# /search/by-id, /similar-matrix: tìm bằng vector đã lưu, không chạy DINO.
+# Số dòng truy vấn mỗi lần index.search và số ID tối đa mỗi request /similar-matrix
+SIMILAR_BATCH = 256
+SIMILAR_IDS_MAX = 10000
+
+# Hàng đợi job thêm ảnh: số worker cố định để không lấn tài nguyên của /search
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", "1"))
+INGEST_QUEUE_MAX = int(os.environ.get("INGEST_QUEUE_MAX", "50"))
+# Số ảnh xử lý giữa hai lần ghi tiến độ
+INGEST_CHUNK = 64
+# Reload: file đổi mtime nhưng vector mới gần như trùng vector đã lưu thì giữ nguyên vector cũ
+RELOAD_SAME_VECTOR = 0.9999
+# Phát hiện ảnh trùng khi thêm (/add, /add-batch, /reload), ảnh trùng được liên kết với ID ảnh gốc
+# thay vì thêm vector mới:
+#   exact: cùng hash nội dung với ảnh đã có (không cần trích xuất)
+#   near: thêm ảnh gần trùng, cosine với vector gần nhất >= DEDUP_THRESHOLD
+#   off: luôn thêm
+DEDUP_MODE = os.environ.get("DEDUP_MODE", "near")
+DEDUP_THRESHOLD = float(os.environ.get("DEDUP_THRESHOLD", "0.985"))
+# /search?collapse=1: lấy dư bấy nhiêu lần k rồi gộp các kết quả gần trùng nhau
+SEARCH_COLLAPSE_FETCH = 3
+
+# Vai trò tiến trình (xem serve.py):
+#   standalone: một tiến trình vừa tìm kiếm vừa sửa index
+#   writer: tiến trình duy nhất sửa index (WAL, snapshot, job thêm ảnh)
+#   reader: chỉ tìm kiếm trên index mmap, theo dõi WAL/snapshot của writer,
+#           chuyển các request sửa index sang writer
+INDEX_ROLE = os.environ.get("INDEX_ROLE", "standalone")
+WRITER_URL = os.environ.get("WRITER_URL", "http://127.0.0.1:5001")
+# Chu kỳ reader kiểm tra thay đổi của writer
+INDEX_REFRESH_MS = float(os.environ.get("INDEX_REFRESH_MS", "200"))
+
 # === Lazy loading mô hình ===
-dino_processor = None
-dino_model = None
-detr_processor = None
-detr_model = None
+# Mỗi model tự tải khi được dùng lần đầu (embedder/detector). Warm-up chỉ chạy các model
+# cần cho traffic thường xuyên: DINO luôn, DETR khi bật index vùng hoặc PRELOAD_DETR=1;
+# /detect và /search?crop=1 vẫn tự tải DETR khi cần
+PRELOAD_DETR = os.environ.get("PRELOAD_DETR", "1" if regions.REGION_INDEX else "0") == "1"
+# Tên model -> thời gian tải + warm-up (s); readiness chờ đủ các model này
+warmed_models = {}
+ready_after = None
 
-def load_models_if_needed():
-    global dino_processor, dino_model, detr_processor, detr_model
-    
-    # Tải DINO model nếu chưa tải
-    if dino_processor is None or dino_model is None:
-        print("Đang tải mô hình DINO...")
-        try:
-            dino_processor = AutoImageProcessor.from_pretrained("facebook/dinov2-base")
-            dino_model = AutoModel.from_pretrained("facebook/dinov2-base").to(DEVICE).eval()
-            print("Đã tải xong mô hình DINO")
-        except Exception as e:
-            print(f"Lỗi khi tải mô hình DINO: {e}")
-            raise
-    
-    # Tải DETR model nếu chưa tải và cần thiết
-    if detr_processor is None or detr_model is None:
-        print("Đang tải mô hình DETR...")
-        try:
-            detr_processor = ConditionalDetrImageProcessor.from_pretrained("yainage90/fashion-object-detection")
-            detr_model = ConditionalDetrForObjectDetection.from_pretrained("yainage90/fashion-object-detection").to(DEVICE).eval()
-            print("Đã tải xong mô hình DETR")
-        except Exception as e:
-            print(f"Lỗi khi tải mô hình DETR: {e}")
-            raise
+def enabled_models():
+    # Writer của serve.py tải model khi có thao tác ghi đầu tiên: không chờ model nào
+    if INDEX_ROLE == "writer":
+        return []
+    models = [("dino", embedder.warm_up)]
+    if PRELOAD_DETR:
+        models.append(("detr", detector.warm_up))
+    return models
+
+def warm_up_models():
+    global ready_after
+    for name, warm_up in enabled_models():
+        if name in warmed_models:
+            continue
+        start_time = time.time()
+        warm_up()
+        warmed_models[name] = round(time.time() - start_time, 2)
+    ready_after = round(time.time() - _start_time, 2)
+    print(f"✅ Sẵn sàng sau {ready_after:.2f}s kể từ khi khởi động")
 
 # Preload models in background to avoid cold start
 def preload_models():
     print("⏳ Preloading models in background...")
     try:
-        load_models_if_needed()
-        print("✅ Models preloaded successfully!")
+        warm_up_models()
     except Exception as e:
         print(f"❌ Error preloading models: {e}")
 
 # === Load index ===
-print("Đang tải FAISS index...")
-if os.path.exists(INDEX_PATH) and os.path.exists(PATHS_PATH):
-    index = faiss.read_index(INDEX_PATH)
-    image_paths = list(np.load(PATHS_PATH, allow_pickle=True))
-    print(f"Đã tải index với {len(image_paths)} ảnh")
+if shard.SHARD_URLS:
+    # Vector nằm ở các tiến trình shard (shard.py); tiến trình này chỉ gửi lệnh và gộp kết quả
+    print(f"Kết nối {len(shard.SHARD_URLS)} shard...")
+    store = shard.ShardedStore(shard.SHARD_URLS)
+else:
+    print("Đang tải FAISS index...")
+    store = IndexStore(INDEX_PATH, PATHS_PATH, IDS_PATH, VECTORS_PATH, WAL_PATH)
+if store.load():
+    print(f"Đã tải index với {len(store)} ảnh")
 else:
-    index = faiss.IndexFlatIP(768)
-    image_paths = []
     print("Tạo index mới")
+region_store = None
+if regions.REGION_INDEX:
+    region_store = IndexStore(REGION_INDEX_PATH, REGION_PATHS_PATH, REGION_IDS_PATH, REGION_VECTORS_PATH, REGION_WAL_PATH)
+    region_store.load()
+    if INDEX_ROLE != "reader":
+        regions.migrate_ids(region_store)
+    print(f"Đã tải index vùng với {len(region_store)} vùng")
+for index_store in (store, region_store):
+    if index_store is None:
+        continue
+    if INDEX_ROLE == "reader":
+        index_store.start_follow(INDEX_REFRESH_MS / 1000.0)
+    else:
+        index_store.start_snapshots()
+
+def add_regions(ids, paths):
+    # Thêm một vector cho mỗi vùng trang phục, liên kết với ID ảnh gốc
+    if region_store is None or not ids:
+        return 0
+    vectors, refs, region_ids = regions.embed_regions(ids, paths)
+    if refs:
+        region_store.add(vectors, refs, region_ids)
+    return len(refs)
+
+def remove_images(ids, keep_files=False):
+    # Xóa vector trực tiếp theo ID, không cần trích xuất lại các ảnh còn lại.
+    # keep_files: file vẫn dùng tiếp (thêm lại với nội dung khác), không xóa file và dòng manifest
+    ids = [int(i) for i in ids]
+    paths_of = dict(zip(ids, store.paths(ids)))
+    # File trùng đang liên kết với các ID sắp xóa: giữ vector để một file trùng thay ảnh gốc
+    orphans = file_manifest.duplicates_of([i for i, p in paths_of.items() if p is not None])
+    orphan_vectors = store.vectors(list(orphans)) if orphans else None
+    removed = store.remove(ids)
+    if region_store is not None and removed:
+        region_store.remove(regions.region_ids_for(region_store, removed))
+    metadata_index.remove(removed)
+    removed_paths = set() if keep_files else set(paths_of.values()) - {None}
+
+    # Xóa ảnh gốc nếu không còn vector nào trỏ tới (chỉ tra các tên file vừa xóa)
+    remaining = set(store.paths([i for p in removed_paths for i in store.ids_for_filename(os.path.basename(p))]))
+    file_manifest.remove(removed_paths - remaining)
+    for path in removed_paths - remaining:
+        if os.path.exists(path):
+            try:
+                os.remove(path)
+            except Exception as e:
+                print(f"Lỗi xóa file {path}: {e}")
+    if orphans:
+        promote_duplicates(orphans, orphan_vectors)
+    return removed
+
+def overwrite_images(ids, paths, vectors):
+    # Nội dung mới cho file đã có vector: ghi đè vector, giữ ID cũ. File trùng đang liên kết với
+    # nội dung cũ thì một trong số đó thành ảnh gốc với vector cũ
+    orphans = file_manifest.duplicates_of(ids)
+    orphan_vectors = store.vectors(list(orphans)) if orphans else None
+    store.add(vectors, paths, ids)
+    if region_store is not None:
+        region_store.remove(regions.region_ids_for(region_store, ids))
+    add_regions(ids, paths)
+    if orphans:
+        promote_duplicates(orphans, orphan_vectors)
+
+def promote_duplicates(orphans, vectors):
+    # Ảnh gốc đã bị xóa nhưng còn file trùng: file trùng đầu tiên còn trên đĩa thành ảnh gốc mới
+    # với vector của ảnh gốc cũ (không trích xuất lại), các file trùng còn lại trỏ sang ID mới
+    for (old_id, paths), vec in zip(orphans.items(), vectors):
+        existing = [p for p in paths if os.path.exists(p)]
+        file_manifest.remove([p for p in paths if p not in existing])
+        if not existing:
+            continue
+        new_id = store.add(vec.reshape(1, -1), existing[:1])[0]
+        add_regions([new_id], existing[:1])
+        file_manifest.promote(existing[0], old_id, new_id)
+        metadata_index.attach([new_id], existing[:1])
+        print(f"{os.path.basename(existing[0])} thay ảnh gốc đã xóa: ID {old_id} -> {new_id}")
+
+def remove_duplicate_files(paths):
+    # Xóa file trùng (không có vector riêng): bỏ liên kết, dòng manifest và file ảnh
+    links = file_manifest.duplicates(paths)
+    file_manifest.remove(list(links))
+    for path in links:
+        if os.path.exists(path):
+            try:
+                os.remove(path)
+            except Exception as e:
+                print(f"Lỗi xóa file {path}: {e}")
+    return links
 
 # === Hàm trích xuất đặc trưng với cache ===
-@lru_cache(maxsize=200)  # Tăng cache size lên 200 ảnh
-def extract_feature_dino(image_path):
+# Cache theo nội dung ảnh + model (embedding_cache.py), không theo đường dẫn
+def extract_feature_dino(image_path, persist=True):
     start_time = time.time()
     try:
-        # Đảm bảo model đã được tải
-        load_models_if_needed()
-        
         # Đọc ảnh với chất lượng gốc
-        image = Image.open(image_path).convert("RGB")
+        with open(image_path, "rb") as f:
+            data = f.read()
             
         # Xử lý với DINO - giữ nguyên chất lượng ảnh
-        inputs = dino_processor(images=image, return_tensors="pt").to(DEVICE)
-        with torch.no_grad():
-            outputs = dino_model(**inputs)
-            feat = outputs.last_hidden_state[:, 0]
-            feat = torch.nn.functional.normalize(feat, dim=-1)
-        
-        result = feat.cpu().numpy().squeeze()
+        result = embedder.embed_bytes(data, persist=persist)
         
         elapsed = time.time() - start_time
         print(f"Trích xuất đặc trưng DINO: {elapsed:.2f}s")
         return result
     except Exception as e:
+        # Không trả vector rỗng: ảnh lỗi không được thêm vào index (embed_each ghi lỗi)
         print(f"Lỗi trích xuất đặc trưng: {e}")
-        # Trả về vector rỗng nếu có lỗi
-        return np.zeros(768, dtype=np.float32)
+        raise
 
-# === Crop váy bằng DETR với timeout ===
-def crop_dress(image_path, save_path):
-    start_time = time.time()
-    try:
-        # Đảm bảo model đã được tải
-        load_models_if_needed()
-            
-        # Đọc ảnh với OpenCV giữ nguyên kích thước gốc
-        img_cv2 = cv2.imread(image_path)
-        if img_cv2 is None:
-            print(f"⚠️ Không thể đọc ảnh: {image_path}")
-            return False
-            
-        # Lấy kích thước ảnh
-        height, width = img_cv2.shape[:2]
-        
-        # Sử dụng ảnh gốc không resize
-        orig_img = img_cv2
-            
-        # Chuyển đổi sang PIL để xử lý với DETR
-        image = Image.fromarray(cv2.cvtColor(img_cv2, cv2.COLOR_BGR2RGB))
-        
-        # Xử lý với DETR - giữ nguyên chất lượng ảnh
-        inputs = detr_processor(images=image, return_tensors="pt").to(DEVICE)
-        with torch.no_grad():
-            outputs = detr_model(**inputs)
-
-        # Xử lý kết quả
-        probs = outputs.logits.softmax(-1)[0, :, :-1]
-        keep = probs.max(dim=-1).values > 0.7
-        boxes = outputs.pred_boxes[0, keep]
-        labels = probs[keep].argmax(dim=-1)
-        
-        # Tìm váy/skirt
-        found = False
-        for i, box in enumerate(boxes):
-            label = detr_model.config.id2label[labels[i].item()]
-            if "dress" in label.lower() or "skirt" in label.lower():
-                # Lấy tọa độ box
-                cx, cy, w, h = box
-                
-                # Tính toán tọa độ trên ảnh gốc
-                x1 = int((cx - w / 2) * width)
-                y1 = int((cy - h / 2) * height)
-                x2 = int((cx + w / 2) * width)
-                y2 = int((cy + h / 2) * height)
-                
-                x1, y1 = max(x1, 0), max(y1, 0)
-                x2, y2 = min(x2, width), min(y2, height)
-
-                # Crop và lưu ảnh với kích thước gốc
-                crop = orig_img[y1:y2, x1:x2]
-                if crop.size == 0:
-                    continue
-                    
-                # Lưu ảnh crop không resize
-                crop = cv2.resize(crop, (224, 224))
-                cv2.imwrite(save_path, crop)
-                found = True
+# === Gom truy vấn tìm kiếm ===
+def resolve_filter(options):
+    # filter (chuỗi JSON chuẩn, dùng được làm khóa nhóm batch) -> id_filter cho store.search;
+    # kết quả lọc được cache trong metadata_index cho tới khi metadata thay đổi
+    options = dict(options)
+    expr = options.pop("filter", None)
+    if expr is not None:
+        options["id_filter"] = metadata_index.select(expr)
+    return options
+
+def stored_search_options(data):
+    # Tham số tìm kiếm từ body JSON, cùng ý nghĩa với form của /search
+    options = {
+        "k": max(1, min(int(data.get('k', 10)), SEARCH_K_MAX)),
+        "exact": bool(data.get('exact')),
+        "nprobe": data.get('nprobe'),
+        "ef_search": data.get('ef_search'),
+        "rerank": data.get('rerank'),
+        "rerank_factor": data.get('rerank_factor')
+    }
+    if data.get('filter') is not None:
+        options["filter"] = canonical(data['filter'])
+    return options
+
+def search_stored(ids, options):
+    # Top-k láng giềng của các ID đã có trong index: đọc vector đã lưu rồi search theo batch,
+    # bỏ chính ID truy vấn khỏi kết quả. Trả về (kết quả từng ID, shard bị thiếu)
+    options = resolve_filter(options)
+    k = options.pop("k")
+    results = []
+    missing = set()
+    for pos in range(0, len(ids), SIMILAR_BATCH):
+        chunk = ids[pos:pos + SIMILAR_BATCH]
+        hits = store.search(store.vectors(chunk), k + 1, **options)
+        for i, row in zip(chunk, hits):
+            results.append([(j, score, path) for j, score, path in row if j != i][:k])
+            missing.update(getattr(row, "missing_shards", ()))
+    return results, sorted(missing)
+
+def collapse_hits(hits, k):
+    # Giữ kết quả điểm cao nhất của mỗi cụm ảnh gần trùng (cosine >= DEDUP_THRESHOLD với một kết quả đã giữ)
+    if not hits:
+        return hits
+    vectors = store.vectors([i for i, _, _ in hits])
+    kept = []
+    for j in range(len(hits)):
+        if not kept or (vectors[kept] @ vectors[j]).max() < DEDUP_THRESHOLD:
+            kept.append(j)
+            if len(kept) == k:
                 break
-        
-        # Nếu không tìm thấy, sử dụng crop mặc định
-        if not found:
-            # Crop mặc định vùng giữa ảnh
-            x1, y1, x2, y2 = 89, 273, 300, 600
-            x1, y1 = max(x1, 0), max(y1, 0)
-            x2, y2 = min(x2, width), min(y2, height)
-
-            crop = img_cv2[y1:y2, x1:x2]
-            crop = cv2.resize(crop, (224, 224))
-            cv2.imwrite(save_path, crop)
-        
-        print(f"Crop ảnh: {time.time() - start_time:.2f}s")
-        return True
-    except Exception as e:
-        print(f"Lỗi khi crop ảnh: {e}")
-        # Nếu có lỗi, giữ nguyên ảnh gốc
+    return [hits[j] for j in kept]
+
+def missing_shards_header(response, missing):
+    # Chế độ sharded: shard lỗi hoặc quá hạn bị bỏ qua, kết quả chỉ từ các shard còn lại
+    if missing:
+        response.headers["X-Missing-Shards"] = ",".join(store.shards[s].url for s in missing)
+    return response
+
+def run_search_batch(items):
+    # items: (vector đã cache hoặc None, ảnh đã tiền xử lý, cache key, tham số tìm kiếm)
+    vectors = [vec for vec, _, _, _ in items]
+    missing = [j for j, vec in enumerate(vectors) if vec is None]
+    if missing:
+        embedded = embedder.embed_prepared([items[j][1] for j in missing])
+        for j, vec in zip(missing, embedded):
+            vectors[j] = vec
+            embedder.embed_cache.put(items[j][2], vec, persist=False)
+
+    # Một lần search nhiều dòng cho mỗi nhóm request có cùng tham số
+    groups = {}
+    for j, (_, _, _, options) in enumerate(items):
+        groups.setdefault(tuple(sorted(options.items())), []).append(j)
+    results = [None] * len(items)
+    for options, rows in groups.items():
+        hits = store.search(np.vstack([vectors[j] for j in rows]), **resolve_filter(dict(options)))
+        for j, row_hits in zip(rows, hits):
+            results[j] = row_hits
+    return results
+
+search_batcher = QueryBatcher(run_search_batch, SEARCH_BATCH_MAX, SEARCH_BATCH_WAIT_MS, name="search") if SEARCH_BATCHING else None
+
+# === Job thêm ảnh ===
+def run_ingest_job(job):
+    start_time = time.time()
+    pending = job.pending_files()
+    dedupe = DEDUP_MODE if job.params.get("dedupe", True) else "off"
+    added = 0
+    duplicates = 0
+    for i in range(0, len(pending), INGEST_CHUNK):
+        chunk = pending[i:i+INGEST_CHUNK]
+        # File đã có vector (tải lên lại cùng tên): ingest_files ghi đè thay vì thêm ID mới.
+        # Tra theo tên file của chunk, không duyệt cả catalog
+        existing = ids_of_paths(chunk)
+        if job.resumed and existing:
+            # Job chạy dở trước khi restart: bỏ qua ảnh đã có trong index (snapshot + WAL)
+            job.report(list(existing))
+            chunk = [p for p in chunk if p not in existing]
+            existing = {}
+            if not chunk:
+                continue
+        # Trích xuất đặc trưng theo batch thật: mỗi batch là một lần forward DINO;
+        # ảnh trùng với ảnh đã có được liên kết thay vì thêm
+        infos, errors = file_infos(chunk)
+        id_of, links, embed_errors = ingest_files(list(infos), infos, dedupe=dedupe, existing=existing)
+        errors.update(embed_errors)
+        job.report(list(id_of) + [link[0] for link in links], errors, added=len(id_of))
+        if errors:
+            metrics.errors_total.inc(len(errors), "ingest")
+        added += len(id_of)
+        duplicates += len(links)
+    
+    elapsed = time.time() - start_time
+    print(f"Job {job.id}: thêm {added}/{len(pending)} ảnh, {duplicates} ảnh trùng: {elapsed:.2f}s")
+
+# === Manifest và job reload ===
+# (size, mtime, hash, model, ID) của từng file đã vào index; chỉ writer ghi
+file_manifest = Manifest(MANIFEST_DB_PATH) if INDEX_ROLE != "reader" else None
+# Metadata theo ID để lọc khi tìm kiếm (metadata.py); reader đọc thay đổi của writer từ SQLite
+metadata_index = MetadataIndex(METADATA_DB_PATH)
+
+def file_infos(paths):
+    # (size, mtime_ns, hash) của từng file, hash tính song song trong decode_pool
+    infos = {}
+    errors = {}
+    for path, future in [(p, embedder.decode_pool.submit(file_info, p)) for p in paths]:
         try:
-            # Sao chép ảnh gốc mà không resize
-            shutil.copy(image_path, save_path)
-            return True
-        except:
-            return False
+            infos[path] = future.result()
+        except OSError as e:
+            errors[path] = str(e)
+    return infos, errors
+
+def embed_each(paths):
+    # Trích xuất từng ảnh qua cache (dùng cho /add); cùng kết quả với embedder.embed_paths:
+    # (vectors, các path thành công, {path: lỗi})
+    vectors = []
+    ok_paths = []
+    errors = {}
+    for path in paths:
+        try:
+            vectors.append(extract_feature_dino(path))
+            ok_paths.append(path)
+        except Exception as e:
+            errors[path] = str(e)
+    if not vectors:
+        return np.zeros((0, EMBED_DIM), dtype="float32"), [], errors
+    return np.vstack(vectors).astype("float32"), ok_paths, errors
+
+def ids_of_paths(paths):
+    # {đường dẫn: [ID]} của các file đã có vector, tra theo tên file (không duyệt cả catalog)
+    candidates = [(path, i) for path in paths for i in store.ids_for_filename(os.path.basename(path))]
+    out = {}
+    for (path, i), found in zip(candidates, store.paths([i for _, i in candidates])):
+        if found == path:
+            out.setdefault(path, []).append(i)
+    return out
+
+def ingest_files(paths, infos, embed=None, dedupe=None, existing=None):
+    # Thêm các file mới vào index và manifest, bỏ qua ảnh trùng:
+    #   trùng chính xác: cùng hash với file đã biết hoặc file trước đó trong batch, không cần trích xuất
+    #   gần trùng: sau khi trích xuất, vector gần nhất trong index hoặc trong batch có cosine >= DEDUP_THRESHOLD
+    # File đã có vector (thêm lại cùng tên file với nội dung mới) được ghi đè, giữ ID cũ như reload.
+    # existing: {đường dẫn: [ID]} của các file trong paths đã có vector; None thì tra theo tên file
+    # Trả về ({đường dẫn: ID}, [(đường dẫn, ID ảnh gốc, loại, điểm)], {đường dẫn: lỗi})
+    dedupe = dedupe or DEDUP_MODE
+    if existing is None:
+        existing = ids_of_paths(paths)
+    model = embedder.embed_cache.model_tag
+    # Đích liên kết: ID ảnh gốc đã có, hoặc đường dẫn của ảnh gốc nằm trong cùng batch.
+    # same: file được thêm lại đúng đường dẫn của ảnh gốc, không ghi liên kết
+    targets = {}
+    same = set()
+    to_embed = []
+    if dedupe != "off":
+        known = file_manifest.find_hashes({infos[p][2] for p in paths})
+        known_ids = [i for i in known.values() if i is not None]
+        known_paths = dict(zip(known_ids, store.paths(known_ids)))
+        first = {}
+        for path in paths:
+            digest = infos[path][2]
+            canonical_path = known_paths.get(known.get(digest))
+            if canonical_path is not None:
+                targets[path] = (known[digest], "exact", 1.0)
+                if canonical_path == path:
+                    same.add(path)
+            elif digest in first:
+                targets[path] = (first[digest], "exact", 1.0)
+            else:
+                first[digest] = path
+                to_embed.append(path)
+    else:
+        to_embed = list(paths)
+
+    vectors, ok_paths, errors = (embed or embedder.embed_paths)(to_embed) if to_embed else ([], [], {})
+    keep = list(range(len(ok_paths)))
+    if dedupe == "near" and ok_paths:
+        keep = []
+        nearest = store.search(vectors, 1) if len(store) else [[] for _ in ok_paths]
+        for j, path in enumerate(ok_paths):
+            if nearest[j] and nearest[j][0][1] >= DEDUP_THRESHOLD:
+                targets[path] = (nearest[j][0][0], "near", nearest[j][0][1])
+                if nearest[j][0][2] == path:
+                    same.add(path)
+                continue
+            scores = vectors[keep] @ vectors[j] if keep else np.zeros(0)
+            if len(scores) and scores.max() >= DEDUP_THRESHOLD:
+                targets[path] = (ok_paths[keep[int(scores.argmax())]], "near", float(scores.max()))
+                continue
+            keep.append(j)
+
+    added_paths = [ok_paths[j] for j in keep]
+    new_ids = iter(store.allocate_ids(sum(p not in existing for p in added_paths)))
+    ids = [existing[p][0] if p in existing else next(new_ids) for p in added_paths]
+    id_of = dict(zip(added_paths, ids))
+
+    # Liên kết tới ảnh khác trong batch: giờ mới có ID; ảnh gốc trong batch bị lỗi thì ảnh trùng cũng lỗi
+    links = []
+    for path, (target, kind, score) in targets.items():
+        while isinstance(target, str) and target not in id_of and target in targets:
+            target = targets[target][0]
+        target = id_of.get(target) if isinstance(target, str) else target
+        if target is None:
+            errors[path] = "Ảnh gốc cùng batch bị lỗi"
+        else:
+            links.append((path, int(target), kind, round(float(score), 6)))
+
+    file_manifest.put([(p, *infos[p], model, int(i)) for p, i in id_of.items()] +
+                      [(p, *infos[p], model, i) for p, i, _, _ in links])
+    file_manifest.unlink(added_paths + list(same))
+    file_manifest.link([link for link in links if link[0] not in same])
+
+    # Ghi đè sau khi đã ghi liên kết: ảnh trong batch trùng với nội dung cũ cũng được chuyển sang
+    # vector cũ (overwrite_images)
+    rows = [j for j, p in zip(keep, added_paths) if p in existing]
+    if rows:
+        overwrite_images([id_of[ok_paths[j]] for j in rows], [ok_paths[j] for j in rows], vectors[rows])
+    rows = [j for j, p in zip(keep, added_paths) if p not in existing]
+    if rows:
+        store.add(vectors[rows], [ok_paths[j] for j in rows], [id_of[ok_paths[j]] for j in rows])
+        add_regions([id_of[ok_paths[j]] for j in rows], [ok_paths[j] for j in rows])
+
+    # ID cũ không còn dùng: file giờ là ảnh trùng của ảnh khác, hoặc vector thừa khi cùng tên file
+    # từng được thêm nhiều lần
+    kept = {**id_of, **{p: targets[p][0] for p in same}}
+    stale = [i for p, old_ids in existing.items() if p in kept or p in targets
+             for i in old_ids if i != kept.get(p)]
+    if stale:
+        remove_images(stale, keep_files=True)
+
+    # Metadata gửi trước (/add-batch, /metadata) được gắn vào ID mới; của file trùng thì giữ lại
+    # đến khi file đó thành ảnh gốc (promote_duplicates)
+    metadata_index.attach(ids, added_paths)
+    for path, _, kind, _ in links:
+        if path not in same:
+            metrics.duplicates_total.inc(1, kind)
+    return id_of, links, errors
+
+def run_reload_job(job):
+    # Đối chiếu từng file của job với index: file đã mất -> xóa vector; file mới hoặc đổi
+    # nội dung -> trích xuất rồi thêm/ghi đè (giữ ID cũ); cùng nội dung -> chỉ cập nhật manifest.
+    # Mọi bước đều lặp lại được nên job chạy dở được tiếp tục sau restart
+    start_time = time.time()
+    model = embedder.embed_cache.model_tag
+    path_ids = store.path_ids()
+    pending = job.pending_files()
+
+    gone = [p for p in pending if not os.path.exists(p)]
+    if gone:
+        remove_images([i for p in gone for i in path_ids.get(p, [])])
+        file_manifest.remove(gone)
+        job.report(gone)
+        # File trùng có thể vừa thay ảnh gốc đã mất (ID mới)
+        path_ids = store.path_ids()
+    entries = file_manifest.entries()
+    dup_links = file_manifest.duplicates()
+    live_ids = {i for ids in path_ids.values() for i in ids}
+    gone_set = set(gone)
+    present = [p for p in pending if p not in gone_set]
+
+    counts = {"removed": len(gone), "added": 0, "updated": 0, "unchanged": 0, "duplicates": 0}
+    for pos in range(0, len(present), INGEST_CHUNK):
+        chunk = present[pos:pos + INGEST_CHUNK]
+        written = counts["added"] + counts["updated"]
+        infos, errors = file_infos(chunk)
+
+        # Cùng nội dung, cùng model và file có đúng vector ghi trong manifest (hoặc vẫn liên kết
+        # với ảnh gốc còn sống nếu là file trùng): không cần trích xuất
+        rows = []
+        to_embed = []
+        for path, info in infos.items():
+            entry = entries.get(path)
+            if entry and entry[2] == info[2] and entry[3] == model and (
+                    path_ids.get(path) == [entry[4]]
+                    or (dup_links.get(path, (None,))[0] == entry[4] and entry[4] in live_ids)):
+                rows.append((path, *info, model, entry[4]))
+            else:
+                to_embed.append(path)
+        counts["unchanged"] += len(rows)
+
+        # File mới (kể cả file trùng đã đổi nội dung): thêm như /add-batch, có kiểm tra ảnh trùng
+        new_paths = [p for p in to_embed if not path_ids.get(p)]
+        to_embed = [p for p in to_embed if path_ids.get(p)]
+        done = []
+        if new_paths:
+            id_of, links, new_errors = ingest_files(new_paths, infos, existing={})
+            errors.update(new_errors)
+            counts["added"] += len(id_of)
+            counts["duplicates"] += len(links)
+            live_ids.update(id_of.values())
+            done = list(id_of) + [link[0] for link in links]
+
+        # Đọc/giải mã trong decode_pool song song với forward theo batch của embed_paths
+        if to_embed:
+            vectors, ok_paths, embed_errors = embedder.embed_paths(to_embed)
+            errors.update(embed_errors)
+            updated_rows, extra_ids = [], []
+            for path, vec in zip(ok_paths, vectors):
+                ids = path_ids[path]
+                # Cùng tên file được thêm nhiều lần: giữ một vector
+                extra_ids.extend(ids[1:])
+                if float(store.vectors(ids[:1])[0] @ vec) >= RELOAD_SAME_VECTOR:
+                    rows.append((path, *infos[path], model, ids[0]))
+                    counts["unchanged"] += 1
+                else:
+                    updated_rows.append((path, vec, ids[0]))
+            if extra_ids:
+                remove_images(extra_ids)
+            if updated_rows:
+                ids = [i for _, _, i in updated_rows]
+                paths = [p for p, _, _ in updated_rows]
+                overwrite_images(ids, paths, np.vstack([v for _, v, _ in updated_rows]))
+                rows.extend((p, *infos[p], model, i) for p, i in zip(paths, ids))
+                counts["updated"] += len(updated_rows)
+
+        file_manifest.put(rows)
+        job.report([r[0] for r in rows] + done, errors, added=counts["added"] + counts["updated"] - written)
+        if errors:
+            metrics.errors_total.inc(len(errors), "reload")
+
+    elapsed = time.time() - start_time
+    print(f"Job {job.id}: reload {len(pending)} file {counts}: {elapsed:.2f}s")
+
+def run_job(job):
+    if job.kind == "reload":
+        run_reload_job(job)
+    else:
+        run_ingest_job(job)
+
+# Reader không chạy job: /add-batch, /reload và /jobs được chuyển sang writer
+ingest_queue = JobQueue(JOBS_DB_PATH, run_job, INGEST_WORKERS, INGEST_QUEUE_MAX) if INDEX_ROLE != "reader" else None
+
+# === Metrics ===
+def collect_metrics():
+    # Giá trị tức thời đọc lúc scrape /metrics
+    caches = [("embedding", embedder.embed_cache), ("detection", detector.detect_cache)]
+    families = [
+        ("clip_cache_hits_total", "counter", "Số lần tìm thấy trong cache",
+         [({"cache": name}, cache.hits) for name, cache in caches]),
+        ("clip_cache_misses_total", "counter", "Số lần không có trong cache",
+         [({"cache": name}, cache.misses) for name, cache in caches]),
+        ("clip_cache_disk_hits_total", "counter", "Số lần tìm thấy trong cache trên đĩa",
+         [({"cache": name}, cache.disk_hits) for name, cache in caches]),
+        ("clip_embed_batch_limit", "gauge", "Batch size DINO hiện tại (tự giảm khi thiếu bộ nhớ)",
+         [({}, embedder.current_batch_size())]),
+        ("clip_models_ready", "gauge", "Model đã warm-up",
+         [({"model": name}, int(name in warmed_models)) for name, _ in enabled_models()])
+    ]
+    depths = []
+    if search_batcher is not None:
+        depths.append(({"queue": "search"}, search_batcher.queue_depth()))
+    if ingest_queue is not None:
+        depths.append(({"queue": "ingest"}, ingest_queue.queue_depth()))
+    families.append(("clip_queue_depth", "gauge", "Số item đang chờ trong hàng đợi", depths))
+
+    indexes = [("main", store)] + ([("regions", region_store)] if region_store is not None else [])
+    vectors = []
+    delta = []
+    index_bytes = []
+    for name, index_store in indexes:
+        version = index_store.version_status()
+        codec = index_store.codec_status()
+        vectors.append(({"index": name}, len(index_store)))
+        delta.append(({"index": name}, version["delta_vectors"]))
+        index_bytes.append(({"index": name}, codec["bytes_per_vector"] * version["base_vectors"]
+                            + version["delta_vectors"] * EMBED_DIM * 4))
+    families += [
+        ("clip_index_vectors", "gauge", "Số vector còn sống trong index", vectors),
+        ("clip_index_delta_vectors", "gauge", "Số vector chưa gộp vào snapshot", delta),
+        ("clip_index_vector_bytes", "gauge", "Bộ nhớ ước tính của vector trong index", index_bytes),
+        ("clip_wal_bytes", "gauge", "Kích thước WAL đang ghi",
+         [({"index": name}, (index_store.wal_status() or {}).get("bytes", 0)) for name, index_store in indexes])
+    ]
+    return families
+
+metrics.register_collector(collect_metrics)
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    if profiler is not None:
+        profiler.begin()
+
+@app.after_request
+def record_request(response):
+    elapsed = time.perf_counter() - g.get("request_start", time.perf_counter())
+    endpoint = request.endpoint or "unknown"
+    metrics.request_seconds.observe(elapsed, endpoint, request.method, str(response.status_code))
+    if profiler is not None:
+        profiler.end(endpoint, elapsed)
+    return response
+
+@app.route('/metrics')
+def prometheus_metrics():
+    # Định dạng text của Prometheus; ở chế độ serve.py mỗi tiến trình có số liệu riêng
+    return app.response_class(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.route('/debug/profiles')
+def list_profiles():
+    if profiler is None:
+        return jsonify({"error": "Profiler chưa bật (PROFILE_SLOW_MS)"}), 404
+    return jsonify({"slow_ms": profiler.slow_ms, "dumps": profiler.dumps, "files": profiler.list()})
 
 # === API ===
 
+# Các endpoint sửa index hoặc đọc trạng thái job, chỉ writer xử lý
+WRITER_ENDPOINTS = {
+    "add_image", "add_images_batch", "get_job", "list_jobs", "delete_image", "delete_images_batch",
+    "reload_index", "build_ann", "change_codec", "reset_index", "update_metadata", "list_duplicates"
+}
+
+@app.before_request
+def forward_to_writer():
+    if INDEX_ROLE != "reader" or request.endpoint not in WRITER_ENDPOINTS:
+        return None
+    headers = {"Content-Type": request.content_type} if request.content_type else {}
+    forward = urllib.request.Request(WRITER_URL + request.full_path.rstrip('?'),
+                                     data=request.get_data() or None, headers=headers, method=request.method)
+    try:
+        with urllib.request.urlopen(forward, timeout=TIMEOUT_SECONDS * 20) as resp:
+            status, body, resp_headers = resp.status, resp.read(), resp.headers
+    except urllib.error.HTTPError as e:
+        status, body, resp_headers = e.code, e.read(), e.headers
+    except urllib.error.URLError as e:
+        return jsonify({"error": f"Không kết nối được tiến trình ghi: {e.reason}"}), 503
+
+    # Đọc ngay thay đổi vừa ghi để client thấy kết quả của chính request này
+    store.refresh()
+    if region_store is not None:
+        region_store.refresh()
+    response = app.response_class(body, status=status, content_type=resp_headers.get("Content-Type"))
+    if resp_headers.get("Retry-After"):
+        response.headers["Retry-After"] = resp_headers["Retry-After"]
+    return response
+
+@app.errorhandler(ReadOnlyIndexError)
+def handle_read_only(e):
+    return jsonify({"error": str(e)}), 409
+
+@app.errorhandler(MetadataError)
+def handle_metadata_error(e):
+    return jsonify({"error": str(e)}), 400
+
+@app.errorhandler(shard.ShardError)
+def handle_shard_error(e):
+    return jsonify({"error": f"Lỗi shard: {e}"}), 503
+
+@app.route('/healthz')
+def liveness():
+    # Tiến trình còn sống và nhận request; không phụ thuộc model đã tải hay chưa
+    return jsonify({"status": "ok", "pid": os.getpid()})
+
+@app.route('/readyz')
+def readiness():
+    # Sẵn sàng nhận traffic khi index đã tải và các model bật sẵn đã warm-up
+    pending = [name for name, _ in enabled_models() if name not in warmed_models]
+    return jsonify({
+        "ready": not pending,
+        "pending": pending,
+        "warmed_s": warmed_models,
+        "ready_after_s": ready_after,
+        "index_size": len(store)
+    }), 503 if pending else 200
+
 @app.route('/')
 def status():
     # Kiểm tra xem model đã được tải chưa
     models_loaded = {
-        "dino_processor": dino_processor is not None,
-        "dino_model": dino_model is not None,
-        "detr_processor": detr_processor is not None,
-        "detr_model": detr_model is not None
+        "dino_processor": embedder.dino_processor is not None,
+        "dino_model": embedder.dino_model is not None,
+        "detr_processor": detector.detr_processor is not None,
+        "detr_model": detector.detr_model is not None
     }
     
     return jsonify({
         "model": "DINOv2 + DETR",
-        "device": str(DEVICE),
-        "index_size": len(image_paths),
+        "device": str(embedder.device) if embedder.device is not None else None,
+        "role": INDEX_ROLE,
+        "pid": os.getpid(),
+        "index_size": len(store),
+        "index_version": store.version_status(),
+        "index_load_mode": INDEX_LOAD_MODE,
+        "shards": store.shard_status() if shard.SHARD_URLS else None,
         "models_loaded": models_loaded,
-        "memory_usage": f"{torch.cuda.memory_allocated() / 1024**2:.1f}MB" if torch.cuda.is_available() else "N/A"
+        "embed_backend": embedder.backend_name(),
+        "embed_batch_size": embedder.current_batch_size(),
+        "embed_cache": embedder.embed_cache.stats(),
+        "detect_cache": detector.detect_cache.stats(),
+        "ann": store.ann_status(),
+        "search_batcher": search_batcher.stats() if search_batcher is not None else None,
+        "storage": store.codec_status(),
+        "wal": store.wal_status(),
+        "manifest_files": len(file_manifest) if file_manifest is not None else None,
+        "duplicates": file_manifest.duplicate_counts() if file_manifest is not None else None,
+        "dedup_mode": DEDUP_MODE,
+        "metadata": metadata_index.stats(),
+        "regions": regions.status(region_store, store) if region_store is not None else {"enabled": False},
+        "memory_usage": embedder.memory_usage()
     })
 
 @app.route('/add', methods=['POST'])
 def add_image():
     start_time = time.time()
-    file = request.files['image']
-    filename = file.filename
-    save_path = os.path.join(STORAGE_DIR, filename)
-    file.save(save_path)
-
-    # Trích xuất đặc trưng trực tiếp từ ảnh gốc, không cần crop
-    vec = extract_feature_dino(save_path).astype("float32").reshape(1, -1)
-    index.add(vec)
-    image_paths.append(save_path)
-
-    # Chỉ lưu index sau mỗi 5 ảnh hoặc khi thời gian xử lý dưới ngưỡng
-    if len(image_paths) % 5 == 0 or time.time() - start_time < 5:
-        faiss.write_index(index, INDEX_PATH)
-        np.save(PATHS_PATH, np.array(image_paths))
-        print(f"Đã lưu index với {len(image_paths)} ảnh")
+    # metadata (tùy chọn): object JSON gắn với ảnh, dùng cho filter của /search
+    meta = parse_json_field('metadata')
+    with metrics.stage("upload"):
+        file = request.files['image']
+        filename = file.filename
+        save_path = os.path.join(STORAGE_DIR, filename)
+        file.save(save_path)
+
+    # Trích xuất đặc trưng trực tiếp từ ảnh gốc, không cần crop; ghi vào WAL (fsync) rồi thêm vào
+    # index trong RAM, snapshot đầy đủ được ghi nền. dedupe=0: thêm cả khi trùng ảnh đã có
+    infos, errors = file_infos([save_path])
+    if errors:
+        return jsonify({"error": errors[save_path]}), 500
+    dedupe = "off" if request.form.get('dedupe') in ('0', 'false') else DEDUP_MODE
+    id_of, links, errors = ingest_files([save_path], infos, embed=embed_each, dedupe=dedupe)
+    if links:
+        # Ảnh trùng: không thêm vector, metadata giữ theo file đến khi file thành ảnh gốc
+        _, canonical, kind, score = links[0]
+        if meta is not None:
+            metadata_index.stage({save_path: meta})
+        print(f"Ảnh trùng ({kind}, {score:.4f}) với ID {canonical}: {time.time() - start_time:.2f}s")
+        return jsonify({"message": "Ảnh trùng với ảnh đã có, không thêm vào index", "path": save_path,
+                        "id": canonical, "duplicate_of": canonical, "duplicate": kind, "score": round(score, 4)})
+    if errors:
+        return jsonify({"error": errors[save_path]}), 500
+    image_id = id_of[save_path]
+    if meta is not None:
+        metadata_index.put({image_id: meta})
     
     print(f"Thêm ảnh: {time.time() - start_time:.2f}s")
-    return jsonify({"message": "Đã thêm ảnh", "path": save_path})
+    return jsonify({"message": "Đã thêm ảnh", "path": save_path, "id": image_id})
+
+def parse_json_field(name):
+    # Trường form chứa JSON (metadata, filter); lỗi cú pháp trả 400 qua handle_metadata_error
+    value = request.form.get(name)
+    if not value:
+        return None
+    try:
+        return json.loads(value)
+    except ValueError:
+        raise MetadataError(f"{name} không phải JSON hợp lệ")
+
+def queue_full_response():
+    response = jsonify({"error": "Hàng đợi xử lý ảnh đã đầy, vui lòng thử lại sau", "status": "rejected"})
+    response.headers["Retry-After"] = "30"
+    return response, 429
 
 @app.route('/add-batch', methods=['POST'])
 def add_images_batch():
-    start_time = time.time()
     if 'images' not in request.files:
         return jsonify({"error": "Không có file nào được gửi"}), 400
     
@@ -249,6 +824,17 @@ def add_images_batch():
     if len(files) == 0:
         return jsonify({"error": "Không có file nào được gửi"}), 400
     
+    # metadata (tùy chọn): {tên file: object}, được gắn vào ID khi job thêm xong từng ảnh
+    meta = parse_json_field('metadata') or {}
+    if not isinstance(meta, dict):
+        return jsonify({"error": "metadata phải là object {tên file: metadata}"}), 400
+    for value in meta.values():
+        check_metadata(value)
+
+    # Từ chối sớm khi hàng đợi đầy, trước khi ghi file
+    if ingest_queue.is_full():
+        return queue_full_response()
+    
     # Lưu tất cả các file trước khi xử lý bất đồng bộ
     saved_files = []
     for file in files:
@@ -260,95 +846,224 @@ def add_images_batch():
         # Lưu file ngay lập tức để tránh lỗi "I/O operation on closed file"
         file.save(save_path)
         saved_files.append((save_path, filename))
+    metadata_index.stage({p: meta[name] for p, name in saved_files if name in meta})
     
-    # Trả về response ngay lập tức để không block client
-    response = {
-        "message": f"Đang xử lý {len(saved_files)} ảnh...",
-        "status": "processing",
-        "total": len(saved_files)
-    }
-    
-    # Tạo thread để xử lý ảnh trong background
-    def process_images():
-        added_paths = []
-        vectors = []
-        
-        # Tăng batch size để xử lý nhanh hơn
-        batch_size = min(10, len(saved_files))  # Xử lý tối đa 10 ảnh cùng lúc
-        
-        for i in range(0, len(saved_files), batch_size):
-            batch_files = saved_files[i:i+batch_size]
-            batch_vectors = []
-            batch_paths = []
-            
-            # Xử lý từng ảnh trong batch
-            for save_path, filename in batch_files:
-                try:
-                    # Trích xuất đặc trưng trực tiếp từ ảnh gốc, không cần crop
-                    vec = extract_feature_dino(save_path).astype("float32").reshape(1, -1)
-                    batch_vectors.append(vec)
-                    batch_paths.append(save_path)
-                    added_paths.append(save_path)
-                except Exception as e:
-                    print(f"Lỗi xử lý ảnh {filename}: {e}")
-            
-            # Thêm vectors vào index
-            if batch_vectors:
-                vectors.extend(batch_vectors)
-                image_paths.extend(batch_paths)
-        
-        # Thêm tất cả các vector vào index một lần
-        if vectors:
-            index.add(np.vstack(vectors))
-            faiss.write_index(index, INDEX_PATH)
-            np.save(PATHS_PATH, np.array(image_paths))
-            print(f"Đã lưu index batch với {len(image_paths)} ảnh")
-        
-        elapsed = time.time() - start_time
-        print(f"Thêm batch {len(added_paths)} ảnh: {elapsed:.2f}s ({elapsed/len(saved_files):.2f}s/ảnh)")
-    
-    # Chạy xử lý ảnh trong thread riêng
-    import threading
-    thread = threading.Thread(target=process_images)
-    thread.daemon = True
-    thread.start()
+    # Đưa vào hàng đợi job bền vững rồi trả về ngay để không block client
+    try:
+        params = {"dedupe": False} if request.form.get('dedupe') in ('0', 'false') else None
+        # Cùng tên file gửi nhiều lần: file lưu sau ghi đè file trước, chỉ xử lý một lần
+        paths = list(dict.fromkeys(p for p, _ in saved_files))
+        job_id = ingest_queue.submit("add-batch", paths, params)
+    except QueueFullError:
+        return queue_full_response()
     
-    return jsonify(response)
+    return jsonify({
+        "message": f"Đang xử lý {len(paths)} ảnh...",
+        "status": "queued",
+        "total": len(paths),
+        "job_id": job_id
+    }), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = ingest_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Không tìm thấy job"}), 404
+    return jsonify(job)
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    return jsonify({
+        "queue_depth": ingest_queue.queue_depth(),
+        "jobs": ingest_queue.list(limit=request.args.get('limit', 20, type=int))
+    })
 
 @app.route('/search', methods=['POST'])
 def search_image():
     start_time = time.time()
-    if index.ntotal == 0:
+    if len(store) == 0:
         return jsonify([])
 
-    file = request.files['image']
-    temp_path = f"temp_query_{int(time.time())}.jpg"  # Tên file duy nhất
+    # filter: điều kiện trên metadata, vd {"category": "dress", "in_stock": true, "price": {"$lt": 500000}};
+    # top-k chỉ lấy trong các ảnh thỏa điều kiện (lọc trong FAISS, xem IndexStore.search)
+    expr = parse_json_field('filter')
+    if expr is not None:
+        expr = canonical(expr)
+        if len(metadata_index.select(expr)) == 0:
+            return jsonify([])
+
+    # Nhận upload (parse multipart) và đọc ảnh truy vấn vào bộ nhớ, không ghi file tạm
+    with metrics.stage("upload"):
+        file = request.files['image']
+        data = file.read()
     try:
-        # Lưu file trước khi xử lý
-        file.save(temp_path)
         
-        # Trích xuất đặc trưng trực tiếp từ ảnh gốc
-        vec = extract_feature_dino(temp_path).astype("float32").reshape(1, -1)
-        D, I = index.search(vec, k=min(10, index.ntotal))
+        # Tham số ANN theo từng request; exact=1 để luôn tìm trên index phẳng
+        # rerank=1: lấy k*rerank_factor ứng viên rồi xếp hạng lại bằng vector float32
+        rerank = request.form.get('rerank')
+        options = {
+            "k": max(1, min(request.form.get('k', 10, type=int), SEARCH_K_MAX)),
+            "exact": request.form.get('exact') in ('1', 'true'),
+            "nprobe": request.form.get('nprobe', type=int),
+            "ef_search": request.form.get('ef_search', type=int),
+            "rerank": None if rerank is None else rerank in ('1', 'true'),
+            "rerank_factor": request.form.get('rerank_factor', type=int)
+        }
+        if expr is not None:
+            options["filter"] = expr
+        
+        # collapse=1: gộp các kết quả gần trùng nhau (ảnh trùng thêm trước khi có dedupe)
+        collapse = request.form.get('collapse') in ('1', 'true')
+        k = options["k"]
+        
+        # crop=1: tìm theo vùng trang phục do DETR phát hiện thay vì cả ảnh
+        crop = request.form.get('crop') in ('1', 'true')
+        # regions=1: tìm trên index vùng, gộp điểm theo ảnh (aggregate=max|sum)
+        by_region = region_store is not None and request.form.get('regions') in ('1', 'true')
+        aggregate = request.form.get('aggregate', regions.REGION_AGGREGATE)
+        if aggregate not in regions.AGGREGATES:
+            return jsonify({"error": f"aggregate phải là một trong {list(regions.AGGREGATES)}"}), 400
+        if by_region and expr is not None:
+            return jsonify({"error": "filter chưa hỗ trợ khi tìm theo vùng (regions=1)"}), 400
+        
+        # Ảnh truy vấn chỉ giữ trong cache RAM, không ghi xuống đĩa
+        digest = content_hash(data)
+        key = embedder.embed_cache.key(digest + "-crop" if crop else digest)
+        vec = embedder.embed_cache.get(key)
+        item = None
+        if vec is None:
+            # Giải mã + tiền xử lý ngay trong thread của request; vùng crop được đưa thẳng
+            # vào embedder trong bộ nhớ
+            if crop:
+                image = detector.crop_garments([embedder.load_image(io.BytesIO(data))],
+                                               [detector.detect_cache.key(digest)])[0]
+                item = embedder.prepare_image(image)
+            else:
+                item = embedder.prepare_bytes(data)
+        if by_region:
+            if vec is None:
+                vec = embedder.embed_prepared([item])[0]
+                embedder.embed_cache.put(key, vec, persist=False)
+            k = options.pop("k")
+            rows = regions.search(region_store, vec.astype("float32").reshape(1, -1), k, aggregate, **options)[0]
+            # Trả về ảnh gốc kèm vùng khớp nhất
+            parent_paths = store.paths([parent for parent, _, _, _ in rows])
+            results = [
+                {"path": path, "score": round(float(score), 4), "box": box, "label": label}
+                for path, (_, score, box, label) in zip(parent_paths, rows) if path is not None
+            ]
+            print(f"Tìm kiếm theo vùng: {time.time() - start_time:.2f}s")
+            return jsonify(results)
+        if collapse:
+            options["k"] = min(k * SEARCH_COLLAPSE_FETCH, SEARCH_K_MAX)
+        if search_batcher is not None:
+            # Phần forward + search đi theo batch cùng các request khác
+            hits = search_batcher.submit((vec, item, key, options))
+        else:
+            if vec is None:
+                vec = embedder.embed_prepared([item])[0]
+                embedder.embed_cache.put(key, vec, persist=False)
+            hits = store.search(vec.astype("float32").reshape(1, -1), **resolve_filter(options))[0]
 
-        results = [image_paths[i] for i in I[0] if i < len(image_paths)]
+        missing = getattr(hits, "missing_shards", None)
+        if collapse:
+            hits = collapse_hits(hits, k)
+        results = [path for _, _, path in hits]
         
         print(f"Tìm kiếm ảnh: {time.time() - start_time:.2f}s")
-        return jsonify(results)
+        return missing_shards_header(jsonify(results), missing)
     except Exception as e:
         print(f"Lỗi tìm kiếm: {e}")
+        metrics.errors_total.inc(1, "search")
         return jsonify([])
-    finally:
-        # Dọn dẹp file tạm
-        if os.path.exists(temp_path):
-            try:
-                os.remove(temp_path)
-            except:
-                pass
+
+@app.route('/search/by-id', methods=['POST'])
+def search_by_id():
+    # "Sản phẩm tương tự" cho ảnh đã có trong catalog: dùng vector đã lưu, không upload lại ảnh,
+    # không chạy DINO. {"id": 5} hoặc {"filename": "a.jpg"}, tham số khác như /search (k, filter, exact...)
+    start_time = time.time()
+    data = request.json or {}
+    if data.get('id') is not None:
+        image_id = int(data['id'])
+    elif data.get('filename'):
+        ids = store.ids_for_filename(data['filename'])
+        image_id = ids[0] if ids else None
+    else:
+        return jsonify({"error": "Thiếu id hoặc filename"}), 400
+    if image_id is None or store.path(image_id) is None:
+        return jsonify({"error": "Không tìm thấy ảnh"}), 404
+
+    results, missing = search_stored([image_id], stored_search_options(data))
+    
+    print(f"Tìm kiếm theo ID: {time.time() - start_time:.2f}s")
+    response = jsonify([{"id": i, "path": path, "score": round(float(score), 4)} for i, score, path in results[0]])
+    return missing_shards_header(response, missing)
+
+@app.route('/similar-matrix', methods=['POST'])
+def similar_matrix():
+    # Top-k láng giềng cho nhiều ảnh đã lưu trong một request, để tính trước "sản phẩm liên quan":
+    # {"ids": [...]} hoặc duyệt cả catalog theo trang {"offset": 0, "limit": 1000}.
+    # Không chạy DINO: vector đọc thẳng từ index, mỗi lần index.search SIMILAR_BATCH dòng
+    start_time = time.time()
+    data = request.json or {}
+    live = store.live_ids()
+    next_offset = None
+    if data.get('ids') is not None:
+        ids = np.asarray([int(i) for i in data['ids']], dtype="int64")
+        found = np.isin(ids, live)
+        not_found = ids[~found].tolist()
+        ids = ids[found].tolist()
+    else:
+        offset = max(0, int(data.get('offset', 0)))
+        ids = live[offset:offset + max(0, int(data.get('limit', 1000)))].tolist()
+        not_found = []
+        if offset + len(ids) < len(live):
+            next_offset = offset + len(ids)
+    if len(ids) > SIMILAR_IDS_MAX:
+        return jsonify({"error": f"Tối đa {SIMILAR_IDS_MAX} ID mỗi request"}), 400
+
+    options = stored_search_options(data)
+    results, missing = search_stored(ids, options)
+    
+    print(f"Ma trận tương tự {len(ids)} ảnh: {time.time() - start_time:.2f}s")
+    response = jsonify({
+        "k": options["k"],
+        "results": [{"id": i, "neighbors": [[j, round(float(score), 4), path] for j, score, path in row]}
+                    for i, row in zip(ids, results)],
+        "not_found": not_found,
+        "next_offset": next_offset,
+        "total": len(live)
+    })
+    return missing_shards_header(response, missing)
+
+@app.route('/detect', methods=['POST'])
+def detect_images():
+    start_time = time.time()
+    files = request.files.getlist('images') or request.files.getlist('image')
+    if not files:
+        return jsonify({"error": "Không có file nào được gửi"}), 400
+
+    # Cả request là một batch DETR; ảnh đã phát hiện trước đó lấy từ cache theo nội dung
+    datas = [file.read() for file in files]
+    images = [embedder.load_image(io.BytesIO(data)) for data in datas]
+    detections = detector.detect_images(images, [detector.detect_cache.key(data) for data in datas])
+
+    results = []
+    for file, image, detection in zip(files, images, detections):
+        results.append({
+            "filename": file.filename,
+            "size": [image.width, image.height],
+            "boxes": detection["boxes"].round(1).tolist(),
+            "scores": detection["scores"].round(4).tolist(),
+            "labels": detector.label_names(detection["labels"]),
+            "garment_box": list(detector.garment_box(image, detection))
+        })
+    
+    print(f"Phát hiện {len(files)} ảnh: {time.time() - start_time:.2f}s")
+    return jsonify(results)
 
 @app.route('/delete', methods=['POST'])
 def delete_image():
-    global index, image_paths
     start_time = time.time()
 
     filename = request.json.get('filename')
@@ -356,122 +1071,251 @@ def delete_image():
         return jsonify({"error": "Thiếu tên file"}), 400
 
     # Tìm file cần xóa
-    idx_to_remove = -1
-    for i, path in enumerate(image_paths):
-        if os.path.basename(path) == filename:
-            idx_to_remove = i
-            break
-
-    if idx_to_remove == -1:
+    ids = store.ids_for_filename(filename)
+    if not ids:
+        # File trùng không có vector riêng: chỉ xóa liên kết và file
+        links = remove_duplicate_files([os.path.join(STORAGE_DIR, filename)])
+        if links:
+            return jsonify({"message": "Đã xóa ảnh trùng", "filename": filename, "ids": [],
+                            "duplicate_of": next(iter(links.values()))[0]})
         return jsonify({"error": "Không tìm thấy file"}), 404
 
-    # Xóa phần tử khỏi danh sách
-    removed_path = image_paths.pop(idx_to_remove)
+    removed = remove_images(ids)
     
-    # Tái tạo index (vì FAISS IndexFlatIP không hỗ trợ xóa)
-    # Chỉ tạo lại index nếu số lượng ảnh > 0
-    if image_paths:
-        # Tạo index mới
-        new_index = faiss.IndexFlatIP(768)
-        
-        # Xử lý theo batch để tránh OOM
-        batch_size = 50
-        for i in range(0, len(image_paths), batch_size):
-            batch_paths = image_paths[i:i+batch_size]
-            batch_vectors = []
-            
-            for path in batch_paths:
-                try:
-                    vec = extract_feature_dino(path).astype("float32").reshape(1, -1)
-                    batch_vectors.append(vec)
-                except Exception as e:
-                    print(f"Lỗi xử lý ảnh {path}: {e}")
-            
-            if batch_vectors:
-                new_index.add(np.vstack(batch_vectors))
-        
-        index = new_index
-    else:
-        # Nếu không còn ảnh nào, tạo index trống
-        index = faiss.IndexFlatIP(768)
+    print(f"Xóa ảnh: {time.time() - start_time:.2f}s")
+    return jsonify({"message": "Đã xóa ảnh", "filename": filename, "ids": removed})
+
+@app.route('/delete-batch', methods=['POST'])
+def delete_images_batch():
+    start_time = time.time()
 
-    # Lưu index mới
-    faiss.write_index(index, INDEX_PATH)
-    np.save(PATHS_PATH, np.array(image_paths))
+    data = request.json or {}
+    ids = [int(i) for i in data.get('ids', [])]
+    filenames = data.get('filenames', [])
+    if not ids and not filenames:
+        return jsonify({"error": "Thiếu ids hoặc filenames"}), 400
 
-    # Xóa ảnh gốc
-    to_delete = [os.path.join(STORAGE_DIR, filename)]
-    for path in to_delete:
-        if os.path.exists(path):
-            try:
-                os.remove(path)
-            except Exception as e:
-                print(f"Lỗi xóa file {path}: {e}")
+    not_found = [i for i, path in zip(ids, store.paths(ids)) if path is None]
+    duplicates = []
+    for filename in filenames:
+        found = store.ids_for_filename(filename)
+        if not found:
+            if remove_duplicate_files([os.path.join(STORAGE_DIR, filename)]):
+                duplicates.append(filename)
+            else:
+                not_found.append(filename)
+        ids.extend(found)
+
+    removed = remove_images(ids)
     
-    print(f"Xóa ảnh: {time.time() - start_time:.2f}s")
-    return jsonify({"message": "Đã xóa ảnh", "filename": filename})
+    print(f"Xóa {len(removed)} ảnh: {time.time() - start_time:.2f}s")
+    return jsonify({
+        "message": f"Đã xóa {len(removed)} ảnh",
+        "removed": removed,
+        "duplicates_removed": duplicates,
+        "not_found": not_found
+    })
+
+@app.route('/metadata', methods=['POST'])
+def update_metadata():
+    # {"items": [{"id": 5, "metadata": {...}}, {"filename": "a.jpg", "metadata": {...}}], "merge": false}
+    # metadata null -> xóa; merge=true -> chỉ ghi đè các trường được gửi.
+    # Tên file chưa có trong index (job add-batch chưa xong) -> giữ lại, gắn khi file được thêm
+    start_time = time.time()
+    data = request.json or {}
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "Thiếu items"}), 400
+
+    updates, removed, staged, not_found = {}, [], {}, []
+    item_ids = [int(item['id']) for item in items if item.get('id') is not None]
+    item_paths = dict(zip(item_ids, store.paths(item_ids)))
+    for item in items:
+        meta = item.get('metadata')
+        if meta is not None:
+            check_metadata(meta)
+        if item.get('id') is not None:
+            ids = [int(item['id'])] if item_paths[int(item['id'])] is not None else []
+            if not ids:
+                not_found.append(item['id'])
+                continue
+        elif item.get('filename'):
+            ids = store.ids_for_filename(item['filename'])
+            if not ids:
+                if meta is None:
+                    not_found.append(item['filename'])
+                else:
+                    staged[os.path.join(STORAGE_DIR, item['filename'])] = meta
+                continue
+        else:
+            return jsonify({"error": "Mỗi item cần id hoặc filename"}), 400
+        for i in ids:
+            if meta is None:
+                removed.append(i)
+            else:
+                updates[i] = meta
+
+    metadata_index.put(updates, merge=bool(data.get('merge')))
+    metadata_index.remove(removed)
+    metadata_index.stage(staged)
+    
+    print(f"Cập nhật metadata {len(updates)} ảnh: {time.time() - start_time:.2f}s")
+    return jsonify({
+        "updated": sorted(updates),
+        "removed": removed,
+        "staged": [os.path.basename(p) for p in staged],
+        "not_found": not_found
+    })
+
+@app.route('/metadata/<int:image_id>', methods=['GET'])
+def get_metadata(image_id):
+    path = store.path(image_id)
+    if path is None:
+        return jsonify({"error": "Không tìm thấy ảnh"}), 404
+    metadata_index.refresh()
+    return jsonify({"id": image_id, "path": path, "metadata": metadata_index.get(image_id)})
+
+@app.route('/duplicates', methods=['GET'])
+def list_duplicates():
+    # File trùng được liên kết với ảnh gốc thay vì thêm vector riêng
+    links = file_manifest.duplicates(limit=request.args.get('limit', 100, type=int))
+    canonical_ids = [i for i, _, _ in links.values()]
+    canonical_paths = dict(zip(canonical_ids, store.paths(canonical_ids)))
+    return jsonify({
+        "counts": file_manifest.duplicate_counts(),
+        "threshold": DEDUP_THRESHOLD,
+        "duplicates": [{"path": path, "duplicate_of": i, "canonical_path": canonical_paths[i], "kind": kind,
+                        "score": round(score, 4)} for path, (i, kind, score) in links.items()]
+    })
 
 @app.route('/reload', methods=['POST'])
 def reload_index():
-    global index, image_paths
+    # Đồng bộ index với image_storage theo manifest: chỉ trích xuất file mới hoặc đã đổi,
+    # xóa vector của file đã mất. Chạy như job (bền vững, tiếp tục sau restart),
+    # tiến độ xem ở /jobs/<job_id>
+    start_time = time.time()
+
+    running = ingest_queue.active("reload")
+    if running is not None:
+        return jsonify({"error": "Đang có job reload chưa xong", "job_id": running["id"], "job": running}), 409
+
+    files = scan_dir(STORAGE_DIR)
+    changed, gone, unchanged = file_manifest.diff(files, embedder.embed_cache.model_tag)
+    # Vector trỏ tới file đã mất nhưng không có trong manifest (index tạo trước khi có manifest)
+    gone = sorted(set(gone) | {p for p in store.ids_by_path() if p not in files})
+    if not changed and not gone:
+        return jsonify({
+            "message": "Index đã khớp với thư mục ảnh",
+            "status": "done",
+            "unchanged": unchanged,
+            "total_images": len(store)
+        })
+
+    try:
+        job_id = ingest_queue.submit("reload", changed + gone)
+    except QueueFullError:
+        return queue_full_response()
+
+    print(f"Reload: {len(changed)} file mới/đổi, {len(gone)} file đã mất, {unchanged} không đổi: "
+          f"{time.time() - start_time:.2f}s")
+    return jsonify({
+        "message": f"Đang reload {len(changed)} file mới/đổi, xóa {len(gone)} file đã mất",
+        "status": "queued",
+        "job_id": job_id,
+        "changed": len(changed),
+        "removed": len(gone),
+        "unchanged": unchanged,
+        "total_images": len(store)
+    }), 202
+
+@app.route('/ann/build', methods=['POST'])
+def build_ann():
+    # Train ANN index ngay (không đợi đến ngưỡng tự động)
+    kind = (request.json or {}).get('kind') if request.is_json else None
+    if kind and kind not in ANN_KINDS:
+        return jsonify({"error": f"kind phải là một trong {list(ANN_KINDS)}"}), 400
+    if len(store) == 0:
+        return jsonify({"error": "Index trống"}), 400
+    if not store.build_ann_async(kind):
+        return jsonify({"message": "ANN index đang được train", "ann": store.ann_status()}), 409
+    return jsonify({"message": "Đang train ANN index", "ann": store.ann_status()})
+
+@app.route('/ann/recall', methods=['GET'])
+def ann_recall():
+    # Đo recall@k của ANN (có và không rerank) so với top-k chính xác để chọn nprobe/efSearch trên dữ liệu thật
+    def int_list(name):
+        value = request.args.get(name)
+        return [int(v) for v in value.split(',')] if value else None
+
+    if store.ann is None:
+        return jsonify({"error": "Chưa có ANN index"}), 400
+    results = store.recall_check(
+        k=request.args.get('k', 10, type=int),
+        num_queries=request.args.get('queries', 200, type=int),
+        nprobe_values=int_list('nprobe'),
+        ef_search_values=int_list('ef_search')
+    )
+    return jsonify({"ann": store.ann_status(), "results": results})
+
+@app.route('/index/codec', methods=['POST'])
+def change_codec():
+    # Chuyển codec lưu vector (flat/fp16/sq8/pq) từ index hiện có, không trích xuất lại
     start_time = time.time()
+    codec = (request.json or {}).get('codec')
+    if codec not in CODECS:
+        return jsonify({"error": f"codec phải là một trong {list(CODECS)}"}), 400
+    try:
+        # Mã hóa lại và lưu snapshot; search vẫn chạy trên version cũ cho tới khi hoán đổi
+        changed = store.migrate_codec(codec)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    print(f"Chuyển codec: {time.time() - start_time:.2f}s")
+    return jsonify({"message": "Đã chuyển codec" if changed else "Codec không thay đổi",
+                    "storage": store.codec_status()})
 
-    image_files = [
+@app.route('/embed/drift', methods=['GET'])
+def embed_drift():
+    # So backend DINO đang dùng với bản fp32 trên một mẫu ảnh đã lưu
+    start_time = time.time()
+    files = sorted(
         os.path.join(STORAGE_DIR, f)
         for f in os.listdir(STORAGE_DIR)
         if f.lower().endswith(('.jpg', '.jpeg', '.png'))
-    ]
-
-    image_paths = []
+    )[:request.args.get('images', 16, type=int)]
+    if not files:
+        return jsonify({"error": "Chưa có ảnh nào để so sánh"}), 400
+    images = [embedder.load_image(path) for path in files]
+    result = embedder.drift_check(images)
     
-    # Tạo index mới
-    new_index = faiss.IndexFlatIP(768)
-    
-    # Xử lý theo batch để tránh OOM
-    batch_size = 20
-    for i in range(0, len(image_files), batch_size):
-        batch_files = image_files[i:i+batch_size]
-        batch_vectors = []
-        batch_paths = []
-        
-        for path in batch_files:
-            # Kiểm tra timeout
-            if time.time() - start_time > TIMEOUT_SECONDS * 5:  # Cho phép thời gian dài hơn cho reload
-                print("Timeout khi reload index")
-                break
-                
-            try:
-                # Trích xuất đặc trưng trực tiếp từ ảnh gốc
-                vec = extract_feature_dino(path).astype("float32").reshape(1, -1)
-                batch_vectors.append(vec)
-                batch_paths.append(path)
-            except Exception as e:
-                print(f"Lỗi ảnh {path}: {e}")
-        
-        if batch_vectors:
-            new_index.add(np.vstack(batch_vectors))
-            image_paths.extend(batch_paths)
-    
-    # Cập nhật index
-    index = new_index
-    
-    # Lưu index
-    faiss.write_index(index, INDEX_PATH)
-    np.save(PATHS_PATH, np.array(image_paths))
+    print(f"Kiểm tra backend {result['backend']}: {time.time() - start_time:.2f}s")
+    return jsonify(result)
+
+@app.route('/embed/preprocess-check', methods=['GET'])
+def embed_preprocess_check():
+    # So tiền xử lý nhanh với AutoImageProcessor trên một mẫu ảnh đã lưu
+    start_time = time.time()
+    files = sorted(
+        os.path.join(STORAGE_DIR, f)
+        for f in os.listdir(STORAGE_DIR)
+        if f.lower().endswith(('.jpg', '.jpeg', '.png'))
+    )[:request.args.get('images', 16, type=int)]
+    if not files:
+        return jsonify({"error": "Chưa có ảnh nào để so sánh"}), 400
+    result = embedder.preprocess_check(files)
     
-    print(f"Reload index: {time.time() - start_time:.2f}s")
-    return jsonify({
-        "message": "Đã reload toàn bộ index",
-        "total_images": len(image_paths)
-    })
+    print(f"Kiểm tra tiền xử lý: {time.time() - start_time:.2f}s")
+    return jsonify(result)
 
 @app.route('/reset', methods=['POST'])
 def reset_index():
-    global index, image_paths
     start_time = time.time()
 
-    if os.path.exists(INDEX_PATH): os.remove(INDEX_PATH)
-    if os.path.exists(PATHS_PATH): os.remove(PATHS_PATH)
+    store.reset()
+    if region_store is not None:
+        region_store.reset()
+    file_manifest.clear()
+    metadata_index.clear()
 
     for file in os.listdir(STORAGE_DIR):
         path = os.path.join(STORAGE_DIR, file)
@@ -480,9 +1324,6 @@ def reset_index():
                 os.remove(path)
             except Exception as e:
                 print(f"Lỗi xóa file {path}: {e}")
-
-    index = faiss.IndexFlatIP(768)
-    image_paths = []
     
     print(f"Reset index: {time.time() - start_time:.2f}s")
     return jsonify({"message": "Đã reset toàn bộ hệ thống và xóa ảnh"})
@@ -0,0 +1,494 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Benchmark offline cho dịch vụ: mỗi kích thước catalog chạy serve.py trong một thư mục
+# tạm riêng (bản copy mã nguồn, index sinh sẵn), đo qua HTTP rồi ghi kết quả JSON.
+#   python bench/run.py --sizes 1000,10000 --out bench.json
+#   python bench/run.py --sizes 1000 --env INDEX_CODEC=sq8 --baseline bench.json
+# Mặc định dùng DINOv2 khởi tạo ngẫu nhiên (không tải model, không cần mạng); con số
+# tuyệt đối của bước forward vì vậy nhỏ hơn thật, dùng --model để đo với model thật.
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, SERVICE_DIR)
+
+import synthetic  # noqa: E402
+
+DEFAULT_SIZES = "1000,10000,100000,1000000"
+# Thời gian chờ dịch vụ sẵn sàng (catalog 1M cần tải + mmap vài GB)
+STARTUP_TIMEOUT = 900
+REQUEST_TIMEOUT = 600
+# Chu kỳ lấy mẫu RSS của cây tiến trình
+RSS_INTERVAL = 0.2
+# Chênh lệch (%) so với baseline được coi là thay đổi thật
+REGRESSION_PCT = 10.0
+
+
+# === HTTP ===
+
+def multipart(files, fields=None):
+    # files: [(tên field, tên file, bytes)] -> (body, content type)
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in (fields or {}).items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, filename, data in files:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: image/jpeg\r\n\r\n'.encode() + data + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def call(url, method="GET", files=None, fields=None, body=None, timeout=REQUEST_TIMEOUT):
+    # Trả về (status, JSON hoặc None); lỗi HTTP không ném ngoại lệ
+    headers = {}
+    data = None
+    if files is not None:
+        data, headers["Content-Type"] = multipart(files, fields)
+    elif body is not None:
+        data = json.dumps(body).encode()
+        headers["Content-Type"] = "application/json"
+    req = urllib.request.Request(url, data=data, headers=headers, method=method)
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            status, raw = resp.status, resp.read()
+    except urllib.error.HTTPError as e:
+        status, raw = e.code, e.read()
+    try:
+        return status, json.loads(raw)
+    except ValueError:
+        return status, None
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# === Tiến trình dịch vụ ===
+
+def process_tree(pid):
+    # PID của tiến trình và mọi tiến trình con (đọc /proc, chỉ Linux)
+    children = {}
+    for stat in glob.glob("/proc/[0-9]*/stat"):
+        try:
+            with open(stat) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        children.setdefault(int(fields[1]), []).append(int(stat.split("/")[2]))
+    tree = [pid]
+    for p in tree:
+        tree.extend(children.get(p, []))
+    return tree
+
+
+def tree_rss(pid):
+    total = 0
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/statm") as f:
+                total += int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            pass
+    return total
+
+
+class Service:
+    # serve.py (1 writer + N reader) chạy trong work_dir; RSS tính trên cả cây tiến trình
+
+    def __init__(self, work_dir, workers, env):
+        self.work_dir = work_dir
+        self.port = free_port()
+        self.writer_port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.env = dict(os.environ, **env,
+                        SERVE_HOST="127.0.0.1",
+                        SERVE_PORT=str(self.port),
+                        WRITER_PORT=str(self.writer_port),
+                        SERVE_WORKERS=str(workers),
+                        PYTHONUNBUFFERED="1")
+        self.log_path = os.path.join(work_dir, "service.log")
+        self.proc = None
+        self.peak_rss = 0
+        self._stop = threading.Event()
+
+    def start(self):
+        start_time = time.time()
+        self._log = open(self.log_path, "w")
+        self.proc = subprocess.Popen([sys.executable, "serve.py"], cwd=self.work_dir, env=self.env,
+                                     stdout=self._log, stderr=subprocess.STDOUT)
+        threading.Thread(target=self._sample_rss, daemon=True).start()
+
+        live_s = None
+        urls = [self.url, f"http://127.0.0.1:{self.writer_port}"]
+        while True:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"Dịch vụ dừng với mã {self.proc.returncode}:\n{self.log_tail()}")
+            if time.time() - start_time > STARTUP_TIMEOUT:
+                raise RuntimeError(f"Dịch vụ không sẵn sàng sau {STARTUP_TIMEOUT}s:\n{self.log_tail()}")
+            try:
+                statuses = [call(u + "/readyz", timeout=5)[0] for u in urls]
+            except (urllib.error.URLError, OSError):
+                statuses = []
+            if statuses and live_s is None:
+                live_s = time.time() - start_time
+            if statuses and all(s == 200 for s in statuses):
+                break
+            time.sleep(0.05)
+        return {"live_s": round(live_s, 3), "ready_s": round(time.time() - start_time, 3)}
+
+    def rss_mb(self):
+        return round(tree_rss(self.proc.pid) / 1024**2, 1)
+
+    def _sample_rss(self):
+        while not self._stop.is_set() and self.proc.poll() is None:
+            self.peak_rss = max(self.peak_rss, tree_rss(self.proc.pid))
+            time.sleep(RSS_INTERVAL)
+
+    def log_tail(self, lines=30):
+        with open(self.log_path, errors="replace") as f:
+            return "".join(f.readlines()[-lines:])
+
+    def stop(self):
+        self._stop.set()
+        if self.proc is not None and self.proc.poll() is None:
+            # serve.py dừng các tiến trình con khi nhận SIGTERM
+            self.proc.send_signal(signal.SIGTERM)
+            try:
+                self.proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                for p in reversed(process_tree(self.proc.pid)):
+                    try:
+                        os.kill(p, signal.SIGKILL)
+                    except OSError:
+                        pass
+                self.proc.wait()
+        self._log.close()
+
+
+def prepare_work_dir(root, size):
+    # Bản copy mã nguồn: image_storage, index, cache, jobs đều nằm trong thư mục tạm
+    work_dir = tempfile.mkdtemp(prefix=f"clip-bench-{size}-", dir=root)
+    for path in glob.glob(os.path.join(SERVICE_DIR, "*.py")):
+        shutil.copy(path, work_dir)
+    storage_dir = os.path.join(work_dir, "image_storage")
+    os.makedirs(storage_dir)
+    return work_dir, storage_dir
+
+
+# === Các phép đo ===
+
+def latency_stats(latencies, wall=None):
+    ms = np.asarray(latencies, dtype="float64") * 1000
+    if not len(ms):
+        return {"count": 0}
+    stats = {
+        "count": len(ms),
+        "p50_ms": round(float(np.percentile(ms, 50)), 2),
+        "p99_ms": round(float(np.percentile(ms, 99)), 2),
+        "mean_ms": round(float(ms.mean()), 2)
+    }
+    if wall:
+        stats["qps"] = round(len(ms) / wall, 2)
+    return stats
+
+
+def bench_search(service, images, concurrency, warmup):
+    # Ảnh truy vấn đều khác nhau nên mỗi request đi hết đường: parse -> tiền xử lý -> forward -> search
+    for i, data in enumerate(images[:warmup]):
+        call(service.url + "/search", "POST", files=[("image", f"warmup_{i}.jpg", data)])
+    queries = images[warmup:]
+
+    def one(item):
+        i, data = item
+        start_time = time.perf_counter()
+        status, _ = call(service.url + "/search", "POST", files=[("image", f"query_{i}.jpg", data)])
+        return time.perf_counter() - start_time, status
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(one, enumerate(queries)))
+    wall = time.perf_counter() - start_time
+    errors = sum(status != 200 for _, status in results)
+    return dict(latency_stats([t for t, _ in results], wall), concurrency=concurrency, errors=errors)
+
+
+def bench_add(service, images, warmup=1):
+    # Writer của serve.py tải model ở lần ghi đầu tiên: thêm rồi xóa vài ảnh trước khi đo
+    for i, data in enumerate(images[:warmup]):
+        call(service.url + "/add", "POST", files=[("image", f"warmup_add_{i}.jpg", data)])
+        call(service.url + "/delete", "POST", body={"filename": f"warmup_add_{i}.jpg"})
+    latencies = []
+    filenames = []
+    errors = 0
+    for i, data in enumerate(images[warmup:]):
+        filename = f"bench_add_{i:05d}.jpg"
+        start_time = time.perf_counter()
+        status, _ = call(service.url + "/add", "POST", files=[("image", filename, data)])
+        latencies.append(time.perf_counter() - start_time)
+        if status == 200:
+            filenames.append(filename)
+        else:
+            errors += 1
+    return dict(latency_stats(latencies), errors=errors), filenames
+
+
+def wait_job(service, job_id):
+    while True:
+        _, job = call(f"{service.url}/jobs/{job_id}")
+        if job and job["status"] in ("done", "failed"):
+            return job
+        time.sleep(0.05)
+
+
+def bench_add_batch(service, images):
+    # Thời gian từ lúc gửi tới khi job ingest xong (gồm cả thời gian upload)
+    files = [("images", f"bench_batch_{i:05d}.jpg", data) for i, data in enumerate(images)]
+    start_time = time.perf_counter()
+    status, body = call(service.url + "/add-batch", "POST", files=files)
+    submit_s = time.perf_counter() - start_time
+    if status != 202:
+        return {"images": len(images), "error": f"HTTP {status}: {body}"}
+    job = wait_job(service, body["job_id"])
+    total_s = time.perf_counter() - start_time
+    return {
+        "images": len(images),
+        "added": job["added"],
+        "failed": job["failed"],
+        "submit_s": round(submit_s, 3),
+        "total_s": round(total_s, 3),
+        "images_per_s": round(len(images) / total_s, 2)
+    }
+
+
+def bench_delete(service, filenames):
+    latencies = []
+    errors = 0
+    for filename in filenames:
+        start_time = time.perf_counter()
+        status, _ = call(service.url + "/delete", "POST", body={"filename": filename})
+        latencies.append(time.perf_counter() - start_time)
+        errors += status != 200
+    return dict(latency_stats(latencies), errors=errors)
+
+
+def bench_reload(service, storage_dir, images):
+    # Reload tăng dần: trích xuất các ảnh mới ghi thẳng vào image_storage, catalog sinh sẵn
+    # không đổi (file và manifest đã có). Lần reload thứ hai không có gì thay đổi: chi phí
+    # quét thư mục + đối chiếu manifest với catalog đầy đủ
+    for i, data in enumerate(images):
+        with open(os.path.join(storage_dir, f"bench_reload_{i:05d}.jpg"), "wb") as f:
+            f.write(data)
+    start_time = time.perf_counter()
+    status, body = call(service.url + "/reload", "POST")
+    if status == 202:
+        job = wait_job(service, body["job_id"])
+        if job["status"] != "done":
+            body = job
+            status = 500
+    elapsed = time.perf_counter() - start_time
+    result = {
+        "changed": (body or {}).get("changed", 0),
+        "removed": (body or {}).get("removed", 0),
+        "total_s": round(elapsed, 3),
+        "images_per_s": round(len(images) / elapsed, 2)
+    }
+    if status not in (200, 202):
+        result["error"] = f"HTTP {status}: {body}"
+        return result
+    start_time = time.perf_counter()
+    status, body = call(service.url + "/reload", "POST")
+    result["noop_s"] = round(time.perf_counter() - start_time, 3)
+    if status != 200:
+        result["error"] = f"Reload lần hai: HTTP {status}: {body}"
+    return result
+
+
+def run_size(args, size, env):
+    work_dir, storage_dir = prepare_work_dir(args.work_dir, size)
+    print(f"=== Catalog {size} vector ({work_dir}) ===")
+    result = {"catalog": synthetic.seed_catalog(work_dir, storage_dir, size, args.seed)}
+    # Mỗi phase một seed riêng: ảnh không trùng nhau giữa các phase và các lần chạy cùng seed giống nhau
+    seed = args.seed * 10
+    service = Service(work_dir, args.workers, env)
+    try:
+        result["startup"] = service.start()
+        result["rss_mb"] = {"ready": service.rss_mb()}
+        print(f"Sẵn sàng sau {result['startup']['ready_s']}s, RSS {result['rss_mb']['ready']} MB")
+
+        queries = synthetic.make_images(args.warmup + args.queries, seed + 1, args.image_width, args.image_height)
+        result["search"] = bench_search(service, queries, args.concurrency, args.warmup)
+        result["rss_mb"]["after_search"] = service.rss_mb()
+        print(f"Search: {result['search']}")
+
+        adds = synthetic.make_images(1 + args.adds, seed + 2, args.image_width, args.image_height)
+        result["add"], added = bench_add(service, adds, 1)
+        print(f"Add: {result['add']}")
+
+        batch = synthetic.make_images(args.batch, seed + 3, args.image_width, args.image_height)
+        result["add_batch"] = bench_add_batch(service, batch)
+        print(f"Add batch: {result['add_batch']}")
+
+        result["delete"] = bench_delete(service, added)
+        print(f"Delete: {result['delete']}")
+
+        if args.reload_images >= 0:
+            reload_images = synthetic.make_images(args.reload_images, seed + 4, args.image_width, args.image_height)
+            result["reload"] = bench_reload(service, storage_dir, reload_images)
+            print(f"Reload: {result['reload']}")
+        result["rss_mb"]["end"] = service.rss_mb()
+        result["rss_mb"]["peak"] = round(service.peak_rss / 1024**2, 1)
+    except Exception:
+        if service.proc is not None:
+            print(service.log_tail())
+        raise
+    finally:
+        service.stop()
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return result
+
+
+# === So sánh với baseline ===
+
+def flatten(results, prefix=""):
+    out = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            out.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            out[name] = value
+    return out
+
+
+def direction(name):
+    # +1: càng lớn càng tốt, -1: càng nhỏ càng tốt, 0: không so sánh (số đếm, thời gian tạo catalog)
+    _, group, metric = name.split(".", 2)
+    if group == "catalog":
+        return 0
+    if metric in ("qps", "images_per_s"):
+        return 1
+    if group == "rss_mb" or metric.endswith(("_ms", "_s")):
+        return -1
+    return 0
+
+
+def compare(current, baseline, threshold=REGRESSION_PCT):
+    # Trả về danh sách (metric, baseline, hiện tại, % thay đổi, nhãn) cho các metric có ở cả hai
+    now = flatten(current["results"])
+    before = flatten(baseline["results"])
+    rows = []
+    for name in sorted(now.keys() & before.keys()):
+        sign = direction(name)
+        if not sign or not before[name]:
+            continue
+        change = (now[name] - before[name]) / abs(before[name]) * 100
+        better = change * sign
+        label = "tốt hơn" if better > threshold else "CHẬM HƠN" if better < -threshold else ""
+        rows.append((name, before[name], now[name], round(change, 1), label))
+    return rows
+
+
+def print_comparison(rows):
+    width = max((len(r[0]) for r in rows), default=10)
+    print(f"{'metric':<{width}}  {'baseline':>12}  {'hiện tại':>12}  {'thay đổi':>9}")
+    for name, before, now, change, label in rows:
+        print(f"{name:<{width}}  {before:>12}  {now:>12}  {change:>+8.1f}%  {label}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SERVICE_DIR,
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline: ingest, search, reload, khởi động")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="Kích thước catalog, phân tách bằng dấu phẩy")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--adds", type=int, default=20)
+    parser.add_argument("--batch", type=int, default=64)
+    parser.add_argument("--reload-images", type=int, default=200,
+                        help="Số ảnh mới ghi vào image_storage trước khi đo /reload (-1 để bỏ qua)")
+    parser.add_argument("--image-width", type=int, default=640)
+    parser.add_argument("--image-height", type=int, default=480)
+    parser.add_argument("--workers", type=int, default=1, help="Số reader của serve.py")
+    parser.add_argument("--model", default="tiny",
+                        help="tiny (DINOv2 ngẫu nhiên, offline) hoặc model id/thư mục cho DINO_MODEL_ID")
+    parser.add_argument("--tiny-layers", type=int, default=1)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Biến môi trường cho dịch vụ, ví dụ INDEX_CODEC=sq8 hoặc EMBED_BACKEND=onnx")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-dir", default=None, help="Thư mục chứa các thư mục tạm")
+    parser.add_argument("--keep", action="store_true", help="Giữ thư mục tạm sau khi chạy")
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--baseline", help="File JSON của lần chạy trước để so sánh")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_PCT)
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+
+    env = dict(item.split("=", 1) for item in args.env)
+    if args.model == "tiny":
+        model_dir = os.path.join(args.work_dir or tempfile.gettempdir(), f"clip-bench-dinov2-tiny-{args.tiny_layers}")
+        env["DINO_MODEL_ID"] = synthetic.make_tiny_model(model_dir, args.tiny_layers)
+        env.setdefault("HF_HUB_OFFLINE", "1")
+    else:
+        env["DINO_MODEL_ID"] = args.model
+    # Tiến trình benchmark tự tạo catalog bằng index_store: dùng cùng cấu hình với dịch vụ
+    os.environ.update(env)
+
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    report = {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "model": args.model,
+            "env": env,
+            "args": {k: v for k, v in vars(args).items() if k not in ("baseline", "out")}
+        },
+        "results": {}
+    }
+    for size in sizes:
+        report["results"][str(size)] = run_size(args, size, env)
+        # Ghi sau mỗi kích thước: catalog lớn chạy lâu, lỗi giữa chừng vẫn giữ kết quả đã đo
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Đã ghi kết quả: {args.out}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            rows = compare(report, json.load(f), args.threshold)
+        print_comparison(rows)
+        if args.fail_on_regression and any(r[4] == "CHẬM HƠN" for r in rows):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+import io
+import os
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+# Dữ liệu tổng hợp cho benchmark: không cần mạng, cùng seed cho cùng kết quả
+
+# Kích thước vector phải khớp EMBED_DIM của index_store
+EMBED_DIM = 768
+# Số cụm của vector catalog: vector ngẫu nhiên đều trên mặt cầu là trường hợp xấu
+# không thực tế cho IVF, vector thật của DINO tập trung theo loại sản phẩm
+VECTOR_CLUSTERS = 256
+VECTOR_NOISE = 0.35
+# Sinh vector theo từng khối cố định để kết quả không phụ thuộc kích thước catalog
+VECTOR_BLOCK = 4096
+
+# Tên file index trong thư mục làm việc, trùng với app.py
+INDEX_PATH = "faiss_index_dino.idx"
+PATHS_PATH = "features_paths_dino.npy"
+IDS_PATH = "features_ids_dino.npy"
+VECTORS_PATH = "features_vectors_dino.npy"
+WAL_PATH = "index_dino.wal"
+MANIFEST_DB_PATH = "manifest.sqlite3"
+
+
+def make_tiny_model(out_dir, layers=1):
+    # DINOv2 khởi tạo ngẫu nhiên, đủ nhỏ để chạy trên CPU nhưng giữ hidden_size 768
+    # và processor giống facebook/dinov2-base (resize 256 -> crop 224)
+    from transformers import BitImageProcessor, Dinov2Config, Dinov2Model
+
+    if os.path.exists(os.path.join(out_dir, "config.json")):
+        return out_dir
+    config = Dinov2Config(hidden_size=EMBED_DIM, num_hidden_layers=layers, num_attention_heads=12,
+                          mlp_ratio=1, image_size=224, patch_size=14)
+    model = Dinov2Model(config).eval()
+    processor = BitImageProcessor(
+        do_resize=True, size={"shortest_edge": 256}, resample=Image.BICUBIC,
+        do_center_crop=True, crop_size={"height": 224, "width": 224},
+        do_rescale=True, rescale_factor=1 / 255, do_normalize=True,
+        image_mean=[0.485, 0.456, 0.406], image_std=[0.229, 0.224, 0.225], do_convert_rgb=True
+    )
+    os.makedirs(out_dir, exist_ok=True)
+    model.save_pretrained(out_dir)
+    processor.save_pretrained(out_dir)
+    return out_dir
+
+
+def make_image(rng, width, height):
+    # Nền gradient + vài khối màu, làm mờ nhẹ: kích thước JPEG và chi phí giải mã gần ảnh chụp
+    # hơn nhiễu trắng (nhiễu trắng nén rất kém)
+    x = np.linspace(0, 1, width, dtype="float32")[None, :, None]
+    y = np.linspace(0, 1, height, dtype="float32")[:, None, None]
+    start, end = rng.uniform(0, 255, size=(2, 3)).astype("float32")
+    base = start + (end - start) * (0.5 * x + 0.5 * y)
+    image = Image.fromarray(base.astype("uint8"))
+    draw = ImageDraw.Draw(image)
+    for _ in range(int(rng.integers(3, 8))):
+        x1, x2 = sorted(rng.integers(0, width, size=2).tolist())
+        y1, y2 = sorted(rng.integers(0, height, size=2).tolist())
+        color = tuple(int(c) for c in rng.integers(0, 256, size=3))
+        if rng.random() < 0.5:
+            draw.rectangle((x1, y1, x2, y2), fill=color)
+        else:
+            draw.ellipse((x1, y1, x2, y2), fill=color)
+    return image.filter(ImageFilter.GaussianBlur(1.5))
+
+
+def image_bytes(seed, width=640, height=480, quality=90):
+    rng = np.random.default_rng(seed)
+    buffer = io.BytesIO()
+    make_image(rng, width, height).save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def make_images(n, seed, width=640, height=480):
+    # Danh sách bytes JPEG; seed khác nhau cho mỗi ảnh nên embedding cache không bao giờ trúng
+    return [image_bytes(seed * 1000003 + i, width, height) for i in range(n)]
+
+
+def random_vectors(start, count, seed=0):
+    # Vector chuẩn hóa L2 quanh VECTOR_CLUSTERS tâm cụm; hàng i luôn giống nhau với cùng seed
+    centers = np.random.default_rng(seed).standard_normal((VECTOR_CLUSTERS, EMBED_DIM)).astype("float32")
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    out = np.empty((count, EMBED_DIM), dtype="float32")
+    end = start + count
+    for block in range(start // VECTOR_BLOCK, (end - 1) // VECTOR_BLOCK + 1 if count else 0):
+        rng = np.random.default_rng([seed, block])
+        labels = rng.integers(0, VECTOR_CLUSTERS, size=VECTOR_BLOCK)
+        noise = rng.standard_normal((VECTOR_BLOCK, EMBED_DIM), dtype="float32")
+        vectors = centers[labels] + VECTOR_NOISE * noise / np.sqrt(EMBED_DIM)
+        lo = max(start, block * VECTOR_BLOCK)
+        hi = min(end, (block + 1) * VECTOR_BLOCK)
+        out[lo - start:hi - start] = vectors[lo - block * VECTOR_BLOCK:hi - block * VECTOR_BLOCK]
+    out /= np.linalg.norm(out, axis=1, keepdims=True)
+    return out
+
+
+def seed_catalog(work_dir, storage_dir, n, seed=0):
+    # Ghi thẳng một snapshot n vector vào thư mục làm việc của dịch vụ (không qua /add).
+    # Mỗi vector có một file trên đĩa (hardlink tới cùng một ảnh JPEG) và dòng manifest tương ứng,
+    # để /reload đối chiếu với một catalog n ảnh còn sống thay vì xóa toàn bộ.
+    # Import muộn: index_store đọc cấu hình (codec, ANN) từ biến môi trường lúc import
+    import embedder
+    import index_store
+    from manifest import Manifest, file_info
+
+    start_time = time.time()
+    store = index_store.IndexStore(*(os.path.join(work_dir, p) for p in (INDEX_PATH, PATHS_PATH, IDS_PATH, VECTORS_PATH)),
+                                   wal_path=os.path.join(work_dir, WAL_PATH))
+    paths = [os.path.join(storage_dir, f"catalog_{i:07d}.jpg") for i in range(n)]
+    ids = store.allocate_ids(n)
+    store.replace(random_vectors(0, n, seed), paths, ids)
+
+    # Ảnh gốc nằm ngoài image_storage: /reload không thấy nó như một file mới
+    placeholder = os.path.join(work_dir, "catalog_placeholder.jpg")
+    with open(placeholder, "wb") as f:
+        f.write(image_bytes(seed))
+    for path in paths:
+        os.link(placeholder, path)
+    info = file_info(placeholder)
+    model = embedder.embed_cache.model_tag
+    Manifest(os.path.join(work_dir, MANIFEST_DB_PATH)).put([(p, *info, model, i) for p, i in zip(paths, ids)])
+    # Nén codec / train ANN như dịch vụ sẽ làm khi tải, để lúc đo dịch vụ đã ở trạng thái ổn định
+    store.wait_rebuild()
+    store.maybe_compress()
+    store.wait_rebuild()
+    store.maybe_promote()
+    store.wait_rebuild()
+    print(f"Tạo catalog {n} vector: {time.time() - start_time:.2f}s")
+    return {
+        "vectors": len(store),
+        "codec": store.codec_status()["codec"],
+        "ann": store.ann_status()["kind"],
+        "seed_s": round(time.time() - start_time, 2)
+    }
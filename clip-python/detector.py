@@ -0,0 +1,164 @@
+import io
+import os
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+import embedder
+import metrics
+from embedder import load_image
+from embedding_cache import EmbeddingCache
+
+# === Cấu hình phát hiện trang phục ===
+DETR_MODEL_ID = os.environ.get("DETR_MODEL_ID", "yainage90/fashion-object-detection")
+# Ngưỡng điểm của box được giữ lại
+DETECT_THRESHOLD = float(os.environ.get("DETECT_THRESHOLD", "0.7"))
+# Số ảnh trong một lần forward DETR
+DETECT_BATCH_SIZE = int(os.environ.get("DETECT_BATCH_SIZE", "8"))
+# Cạnh ngắn của ảnh đưa vào DETR (mặc định của processor là 800, rất chậm trên CPU);
+# box trả về vẫn theo tọa độ pixel của ảnh gốc
+DETECT_SHORTEST_EDGE = int(os.environ.get("DETECT_SHORTEST_EDGE", "512"))
+# Cache kết quả phát hiện theo nội dung ảnh, lưu trên đĩa
+DETECT_CACHE_DIR = os.environ.get("DETECT_CACHE_DIR", "detection_cache")
+DETECT_CACHE_MEMORY_ITEMS = int(os.environ.get("DETECT_CACHE_MEMORY_ITEMS", "5000"))
+# Nhãn được dùng để crop, theo thứ tự ưu tiên khi cùng điểm
+GARMENT_LABELS = ("dress", "skirt")
+# Vùng crop mặc định khi không tìm thấy trang phục (x1, y1, x2, y2)
+DEFAULT_CROP = (89, 273, 300, 600)
+# Kích thước ảnh giả dùng để warm-up (rộng, cao)
+WARMUP_IMAGE_SIZE = (480, 640)
+
+detr_processor = None
+detr_model = None
+_load_lock = threading.Lock()
+
+# Mỗi ảnh lưu một mảng (n, 6): x1, y1, x2, y2, score, label; ngưỡng nằm trong tag
+# vì cache chỉ giữ các box đã qua ngưỡng
+detect_cache = EmbeddingCache(
+    DETECT_CACHE_DIR,
+    f"{DETR_MODEL_ID}@{DETECT_SHORTEST_EDGE}@{DETECT_THRESHOLD}",
+    DETECT_CACHE_MEMORY_ITEMS)
+
+
+def load_detr_model():
+    global detr_processor, detr_model
+    if detr_model is not None:
+        return
+    with _load_lock:
+        if detr_model is not None:
+            return
+        device = embedder.setup_torch()
+        print("Đang tải mô hình DETR...")
+        try:
+            from transformers import ConditionalDetrForObjectDetection, ConditionalDetrImageProcessor
+
+            detr_processor = ConditionalDetrImageProcessor.from_pretrained(DETR_MODEL_ID)
+            detr_model = ConditionalDetrForObjectDetection.from_pretrained(DETR_MODEL_ID).to(device).eval()
+            print("Đã tải xong mô hình DETR")
+        except Exception as e:
+            print(f"Lỗi khi tải mô hình DETR: {e}")
+            raise
+
+
+def _pack(detection):
+    return np.hstack([
+        detection["boxes"],
+        detection["scores"][:, None],
+        detection["labels"][:, None]
+    ]).astype("float32")
+
+
+def _unpack(packed):
+    packed = np.asarray(packed, dtype="float32").reshape(-1, 6)
+    return {
+        "boxes": packed[:, :4],
+        "scores": packed[:, 4],
+        "labels": packed[:, 5].astype("int64")
+    }
+
+
+def _forward(images):
+    import torch
+
+    # Một lần forward cho cả batch; processor pad ảnh và trả về pixel_mask
+    size = {"shortest_edge": DETECT_SHORTEST_EDGE, "longest_edge": DETECT_SHORTEST_EDGE * 1333 // 800}
+    metrics.observe_batch("detect", len(images))
+    with metrics.stage("detect_preprocess"):
+        inputs = detr_processor(images=images, size=size, return_tensors="pt").to(embedder.device)
+    with metrics.stage("detect"), torch.inference_mode():
+        outputs = detr_model(**inputs)
+    target_sizes = torch.tensor([(image.height, image.width) for image in images])
+    processed = detr_processor.post_process_object_detection(
+        outputs, threshold=DETECT_THRESHOLD, target_sizes=target_sizes)
+    return [{
+        "boxes": result["boxes"].cpu().numpy().astype("float32"),
+        "scores": result["scores"].cpu().numpy().astype("float32"),
+        "labels": result["labels"].cpu().numpy().astype("int64")
+    } for result in processed]
+
+
+def warm_up():
+    load_detr_model()
+    start_time = time.time()
+    _forward([Image.new("RGB", WARMUP_IMAGE_SIZE)])
+    print(f"Warm-up DETR: {time.time() - start_time:.2f}s")
+
+
+def detect_images(images, keys=None):
+    # Phát hiện trên danh sách ảnh PIL; keys (cache key theo nội dung, cùng thứ tự)
+    # cho phép dùng lại kết quả đã có. Trả về mỗi ảnh một dict boxes/scores/labels (numpy)
+    load_detr_model()
+    results = [None] * len(images)
+    pending = []
+    for j in range(len(images)):
+        packed = detect_cache.get(keys[j]) if keys is not None else None
+        if packed is not None:
+            results[j] = _unpack(packed)
+        else:
+            pending.append(j)
+
+    for pos in range(0, len(pending), DETECT_BATCH_SIZE):
+        chunk = pending[pos:pos + DETECT_BATCH_SIZE]
+        for j, detection in zip(chunk, _forward([images[j] for j in chunk])):
+            results[j] = detection
+            if keys is not None:
+                detect_cache.put(keys[j], _pack(detection))
+    return results
+
+
+def detect_bytes(data):
+    return detect_images([load_image(io.BytesIO(data))], [detect_cache.key(data)])[0]
+
+
+def label_names(labels):
+    return [detr_model.config.id2label[int(label)] for label in labels]
+
+
+def clip_box(image, box):
+    # Box nguyên (x1, y1, x2, y2) nằm trong ảnh, None nếu rỗng
+    x1, y1, x2, y2 = box
+    box = (max(int(x1), 0), max(int(y1), 0), min(int(x2), image.width), min(int(y2), image.height))
+    if box[2] <= box[0] or box[3] <= box[1]:
+        return None
+    return box
+
+
+def garment_box(image, detection):
+    # Box trang phục có điểm cao nhất; không có thì dùng vùng mặc định (cắt theo kích thước ảnh)
+    best = None
+    for box, score, name in zip(detection["boxes"], detection["scores"], label_names(detection["labels"])):
+        if any(garment in name.lower() for garment in GARMENT_LABELS) and (best is None or score > best[1]):
+            best = (box, score)
+    box = clip_box(image, best[0] if best is not None else DEFAULT_CROP)
+    return box or (0, 0, image.width, image.height)
+
+
+def crop_garments(images, keys=None):
+    # Crop trang phục trong bộ nhớ để đưa thẳng vào embedder, không ghi file trung gian
+    start_time = time.time()
+    detections = detect_images(images, keys)
+    crops = [image.crop(garment_box(image, detection)) for image, detection in zip(images, detections)]
+    print(f"Crop {len(images)} ảnh: {time.time() - start_time:.2f}s")
+    return crops
@@ -0,0 +1,182 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+
+# Các backend chạy DINOv2, chọn bằng EMBED_BACKEND:
+#   torch: eager fp32 (tham chiếu)
+#   torch-int8: lượng tử hóa động int8 các lớp Linear
+#   torch-bf16: autocast bfloat16 (CPU có AVX512-BF16/AMX mới nhanh hơn)
+#   torchscript: trace + freeze + optimize_for_inference
+#   compile: torch.compile (cần trình biên dịch C, lần chạy đầu chậm)
+#   onnx / onnx-int8: ONNX Runtime, file .onnx được export một lần rồi cache
+BACKENDS = ("torch", "torch-int8", "torch-bf16", "torchscript", "compile", "onnx", "onnx-int8")
+EMBED_BACKEND_DIR = os.environ.get("EMBED_BACKEND_DIR", "embed_backends")
+# Kích thước ảnh sau tiền xử lý của AutoImageProcessor (crop 224)
+IMAGE_SIZE = 224
+
+
+def _normalize(feats):
+    feats = torch.nn.functional.normalize(feats.float(), dim=-1)
+    return feats.cpu().numpy().astype("float32")
+
+
+class CLSModel(torch.nn.Module):
+    # Chỉ trả về token CLS: đầu ra gọn để trace/export
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model(pixel_values=pixel_values).last_hidden_state[:, 0]
+
+
+class TorchBackend:
+    def __init__(self, model, name="torch", dtype=None):
+        self.model = model
+        self.name = name
+        self.dtype = dtype
+
+    def run(self, pixel_values):
+        with torch.inference_mode():
+            if self.dtype is not None:
+                with torch.autocast(device_type=pixel_values.device.type, dtype=self.dtype):
+                    feats = self.model(pixel_values=pixel_values).last_hidden_state[:, 0]
+            else:
+                feats = self.model(pixel_values=pixel_values).last_hidden_state[:, 0]
+        return _normalize(feats)
+
+
+class ModuleBackend:
+    # Module đã trace/compile nhận pixel_values và trả về CLS
+    def __init__(self, module, name):
+        self.module = module
+        self.name = name
+
+    def run(self, pixel_values):
+        with torch.inference_mode():
+            return _normalize(self.module(pixel_values))
+
+
+class OnnxBackend:
+    def __init__(self, path, name):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.name = name
+
+    def run(self, pixel_values):
+        feats = self.session.run(None, {"pixel_values": pixel_values.cpu().numpy()})[0]
+        return _normalize(torch.from_numpy(feats))
+
+
+def _example_input(model, batch=2):
+    param = next(model.parameters())
+    return torch.zeros(batch, 3, IMAGE_SIZE, IMAGE_SIZE, device=param.device)
+
+
+def model_tag(model_id):
+    # Tên file an toàn cho cả ID trên Hub lẫn đường dẫn model cục bộ
+    return model_id.strip("/").replace("/", "--")
+
+
+def export_onnx(model, tag, int8=False):
+    # Export một lần cho mỗi model, các tiến trình sau dùng lại file đã cache
+    os.makedirs(EMBED_BACKEND_DIR, exist_ok=True)
+    path = os.path.join(EMBED_BACKEND_DIR, f"{tag}.onnx")
+    if not os.path.exists(path):
+        start_time = time.time()
+        tmp_path = path + ".tmp"
+        torch.onnx.export(CLSModel(model).eval(), (_example_input(model),), tmp_path,
+                          input_names=["pixel_values"], output_names=["cls"],
+                          dynamic_axes={"pixel_values": {0: "batch"}, "cls": {0: "batch"}},
+                          opset_version=17, dynamo=False)
+        os.replace(tmp_path, path)
+        print(f"Export ONNX {path}: {time.time() - start_time:.2f}s")
+    if not int8:
+        return path
+
+    int8_path = os.path.join(EMBED_BACKEND_DIR, f"{tag}-int8.onnx")
+    if not os.path.exists(int8_path):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        tmp_path = int8_path + ".tmp"
+        quantize_dynamic(path, tmp_path, weight_type=QuantType.QInt8)
+        os.replace(tmp_path, int8_path)
+    return int8_path
+
+
+def create(name, model, tag):
+    # model: DINOv2 fp32 đã .eval(); model gốc không bị sửa
+    if name == "torch":
+        return TorchBackend(model)
+    if name == "torch-int8":
+        quantized = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        return TorchBackend(quantized, name)
+    if name == "torch-bf16":
+        return TorchBackend(model, name, dtype=torch.bfloat16)
+    if name == "torchscript":
+        with torch.inference_mode():
+            traced = torch.jit.trace(CLSModel(model).eval(), _example_input(model), check_trace=False)
+        return ModuleBackend(torch.jit.optimize_for_inference(torch.jit.freeze(traced)), name)
+    if name == "compile":
+        return ModuleBackend(torch.compile(CLSModel(model).eval(), dynamic=True), name)
+    if name in ("onnx", "onnx-int8"):
+        return OnnxBackend(export_onnx(model, tag, int8=name == "onnx-int8"), name)
+    raise ValueError(f"Backend không hỗ trợ: {name}")
+
+
+def _timed(backend, pixel_values, repeats=3):
+    backend.run(pixel_values)  # khởi động (compile/cấp phát) với đúng kích thước batch
+    start_time = time.time()
+    for _ in range(repeats):
+        out = backend.run(pixel_values)
+    return out, (time.time() - start_time) / repeats
+
+
+def drift_check(reference, backend, pixel_values):
+    # So vector của backend với backend fp32 tham chiếu trên cùng các ảnh đã tiền xử lý
+    ref, ref_time = _timed(reference, pixel_values)
+    out, run_time = _timed(backend, pixel_values)
+    cosine = np.sum(ref * out, axis=1)
+    n = len(pixel_values)
+    return {
+        "backend": backend.name,
+        "images": n,
+        "cosine_mean": round(float(cosine.mean()), 6),
+        "cosine_min": round(float(cosine.min()), 6),
+        "reference_ms_per_image": round(ref_time * 1000 / n, 2),
+        "ms_per_image": round(run_time * 1000 / n, 2),
+        "speedup": round(ref_time / max(run_time, 1e-9), 2)
+    }
+
+
+if __name__ == '__main__':
+    # So sánh các backend trên ảnh thật, ví dụ:
+    #   python embed_backends.py image_storage --backends onnx onnx-int8 torch-int8
+    from transformers import AutoImageProcessor, AutoModel
+    from PIL import Image
+
+    parser = argparse.ArgumentParser(description="Đo tốc độ và độ lệch cosine của các backend DINO")
+    parser.add_argument("image_dir")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=list(BACKENDS[1:]))
+    parser.add_argument("--images", type=int, default=32)
+    parser.add_argument("--model", default=os.environ.get("DINO_MODEL_ID", "facebook/dinov2-base"))
+    args = parser.parse_args()
+
+    files = sorted(f for f in os.listdir(args.image_dir) if f.lower().endswith(('.jpg', '.jpeg', '.png')))
+    images = [Image.open(os.path.join(args.image_dir, f)).convert("RGB") for f in files[:args.images]]
+    processor = AutoImageProcessor.from_pretrained(args.model)
+    model = AutoModel.from_pretrained(args.model).eval()
+    pixel_values = processor(images=images, return_tensors="pt")["pixel_values"]
+    reference = TorchBackend(model)
+    for name in args.backends:
+        try:
+            print(drift_check(reference, create(name, model, model_tag(args.model)), pixel_values))
+        except Exception as e:
+            print(f"{name}: lỗi {e}")
@@ -0,0 +1,349 @@
+import io
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import metrics
+import preprocess
+from embedding_cache import EmbeddingCache
+
+# === Cấu hình embedding ===
+DINO_MODEL_ID = os.environ.get("DINO_MODEL_ID", "facebook/dinov2-base")
+EMBED_DIM = 768
+# Số ảnh tối đa trong một lần forward; tự giảm khi thiếu bộ nhớ
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", "16"))
+# Sau bao nhiêu batch thành công liên tiếp thì thử tăng lại batch size
+EMBED_BATCH_GROW_AFTER = 8
+# Cache vector theo nội dung ảnh, lưu trên đĩa
+EMBED_CACHE_DIR = os.environ.get("EMBED_CACHE_DIR", "embedding_cache")
+EMBED_CACHE_MEMORY_ITEMS = int(os.environ.get("EMBED_CACHE_MEMORY_ITEMS", "2000"))
+# Backend chạy DINO (xem embed_backends.py): torch, torch-int8, torch-bf16, torchscript, compile, onnx, onnx-int8
+EMBED_BACKEND = os.environ.get("EMBED_BACKEND", "torch")
+# Số luồng PyTorch trên CPU; chế độ nhiều worker (serve.py) chia core cho các tiến trình
+TORCH_NUM_THREADS = int(os.environ.get("TORCH_NUM_THREADS", "2"))
+# Kích thước ảnh giả dùng để warm-up
+WARMUP_IMAGE_SIZE = 224
+# Tiền xử lý nhanh (preprocess.py) thay cho AutoImageProcessor; tự tắt nếu lệch quá ngưỡng
+FAST_PREPROCESS = os.environ.get("FAST_PREPROCESS", "1") == "1"
+
+# torch/transformers chỉ được import khi cần model lần đầu: tiến trình khởi động,
+# tải index và trả lời liveness trong khi model còn đang tải
+device = None
+_torch_lock = threading.Lock()
+
+dino_processor = None
+dino_model = None
+# Backend đang dùng; dino_model giữ bản fp32 làm tham chiếu cho drift_check
+dino_backend = None
+# FastPreprocessor khi đường nhanh được bật và khớp với dino_processor, ngược lại None
+fast_preprocessor = None
+_load_lock = threading.Lock()
+
+# Giải mã + tiền xử lý ảnh của embed_paths, chạy song song với forward
+decode_pool = ThreadPoolExecutor(preprocess.PREPROCESS_WORKERS, thread_name_prefix="decode")
+
+# Batch size hiện tại (thay đổi theo bộ nhớ khả dụng)
+_batch_size = max(1, EMBED_BATCH_SIZE)
+_batch_successes = 0
+_batch_lock = threading.Lock()
+
+# Backend khác fp32 cho vector hơi lệch: không dùng chung cache với bản fp32
+embed_cache = EmbeddingCache(
+    EMBED_CACHE_DIR,
+    DINO_MODEL_ID if EMBED_BACKEND == "torch" else f"{DINO_MODEL_ID}@{EMBED_BACKEND}",
+    EMBED_CACHE_MEMORY_ITEMS)
+
+
+def setup_torch():
+    # Import và cấu hình torch một lần cho cả tiến trình, trả về thiết bị chạy model
+    global device
+    if device is not None:
+        return device
+    with _torch_lock:
+        if device is None:
+            start_time = time.time()
+            import torch
+            torch.backends.cudnn.benchmark = True
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+                device = torch.device("cuda")
+            else:
+                # Giới hạn số luồng CPU để tránh quá tải
+                torch.set_num_threads(TORCH_NUM_THREADS)
+                device = torch.device("cpu")
+            print(f"Import torch: {time.time() - start_time:.2f}s")
+    return device
+
+
+def memory_usage():
+    if device is None or device.type != 'cuda':
+        return "N/A"
+    import torch
+    return f"{torch.cuda.memory_allocated() / 1024**2:.1f}MB"
+
+
+def load_dino_model():
+    global dino_processor, dino_model, dino_backend, fast_preprocessor
+    if dino_backend is not None:
+        return
+    with _load_lock:
+        if dino_backend is not None:
+            return
+        setup_torch()
+        print("Đang tải mô hình DINO...")
+        try:
+            from transformers import AutoImageProcessor, AutoModel
+
+            dino_processor = AutoImageProcessor.from_pretrained(DINO_MODEL_ID)
+            dino_model = AutoModel.from_pretrained(DINO_MODEL_ID).to(device).eval()
+            print("Đã tải xong mô hình DINO")
+        except Exception as e:
+            print(f"Lỗi khi tải mô hình DINO: {e}")
+            raise
+        fast_preprocessor = _create_preprocessor()
+        dino_backend = _create_backend()
+
+
+def _create_preprocessor():
+    if not FAST_PREPROCESS:
+        return None
+    fast = preprocess.FastPreprocessor.from_processor(dino_processor)
+    if fast is None:
+        print(f"⚠️ Tiền xử lý nhanh không hỗ trợ {type(dino_processor).__name__}, dùng AutoImageProcessor")
+        return None
+    diff = preprocess.self_check(dino_processor, fast)
+    if diff > preprocess.PREPROCESS_TOLERANCE:
+        print(f"⚠️ Tiền xử lý nhanh lệch {diff:.4f} so với AutoImageProcessor, không dùng")
+        return None
+    return fast
+
+
+def _create_backend():
+    import embed_backends
+
+    if EMBED_BACKEND == "torch":
+        return embed_backends.TorchBackend(dino_model)
+    start_time = time.time()
+    try:
+        backend = embed_backends.create(EMBED_BACKEND, dino_model, embed_backends.model_tag(DINO_MODEL_ID))
+        # Chạy thử một lần: trace/compile/khởi tạo session trước request đầu tiên
+        backend.run(embed_backends._example_input(dino_model, 1))
+    except Exception as e:
+        print(f"⚠️ Không dùng được backend {EMBED_BACKEND} ({e}), dùng torch fp32")
+        return embed_backends.TorchBackend(dino_model)
+    print(f"Backend DINO {EMBED_BACKEND}: {time.time() - start_time:.2f}s")
+    return backend
+
+
+def backend_name():
+    return dino_backend.name if dino_backend is not None else EMBED_BACKEND
+
+
+def current_batch_size():
+    return _batch_size
+
+
+def _is_oom(e):
+    if isinstance(e, MemoryError):
+        return True
+    return isinstance(e, RuntimeError) and "out of memory" in str(e).lower()
+
+
+def _shrink_batch_size(failed_size):
+    global _batch_size, _batch_successes
+    with _batch_lock:
+        _batch_size = max(1, min(_batch_size, failed_size // 2))
+        _batch_successes = 0
+    if device.type == 'cuda':
+        import torch
+        torch.cuda.empty_cache()
+    print(f"⚠️ Thiếu bộ nhớ, giảm batch size xuống {_batch_size}")
+
+
+def _record_batch_success(size):
+    global _batch_size, _batch_successes
+    with _batch_lock:
+        if size < _batch_size:
+            return
+        _batch_successes += 1
+        if _batch_successes >= EMBED_BATCH_GROW_AFTER and _batch_size < EMBED_BATCH_SIZE:
+            _batch_size = min(EMBED_BATCH_SIZE, _batch_size * 2)
+            _batch_successes = 0
+
+
+def load_image(source):
+    # source có thể là đường dẫn hoặc file-like object
+    return Image.open(source).convert("RGB")
+
+
+def prepare_image(image):
+    # Ảnh PIL -> đầu vào của _forward: mảng uint8 224x224 (đường nhanh) hoặc chính ảnh PIL
+    load_dino_model()
+    if fast_preprocessor is None:
+        return image
+    with metrics.stage("preprocess"):
+        return fast_preprocessor.prepare(image)
+
+
+def prepare_bytes(data):
+    # Như prepare_image nhưng giải mã từ bytes; JPEG lớn được giải mã ở kích thước giảm
+    load_dino_model()
+    with metrics.stage("preprocess"):
+        if fast_preprocessor is not None:
+            return fast_preprocessor.load(io.BytesIO(data))
+        return load_image(io.BytesIO(data))
+
+
+def _forward(items):
+    metrics.observe_batch("embed", len(items))
+    with metrics.stage("normalize"):
+        if fast_preprocessor is not None:
+            pixel_values = fast_preprocessor.to_tensor(items).to(device)
+        else:
+            pixel_values = dino_processor(images=items, return_tensors="pt")["pixel_values"].to(device)
+    # Backend trả về token CLS của cả batch, đã chuẩn hóa L2
+    with metrics.stage("forward"):
+        return dino_backend.run(pixel_values)
+
+
+def warm_up():
+    # Chạy một batch giả qua backend: khởi tạo kernel/cấp phát bộ nhớ trước request thật
+    load_dino_model()
+    start_time = time.time()
+    _forward([prepare_image(Image.new("RGB", (WARMUP_IMAGE_SIZE, WARMUP_IMAGE_SIZE)))])
+    print(f"Warm-up DINO: {time.time() - start_time:.2f}s")
+
+
+def drift_check(images):
+    # Độ lệch cosine và tốc độ của backend đang dùng so với DINO fp32 trên các ảnh PIL
+    import embed_backends
+
+    load_dino_model()
+    pixel_values = dino_processor(images=images, return_tensors="pt")["pixel_values"].to(device)
+    reference = embed_backends.TorchBackend(dino_model)
+    return embed_backends.drift_check(reference, dino_backend, pixel_values)
+
+
+def preprocess_check(paths):
+    # So tiền xử lý nhanh với AutoImageProcessor trên các file ảnh: chênh lệch pixel và cosine vector
+    load_dino_model()
+    if fast_preprocessor is None:
+        return {"enabled": False}
+    result, ref, out = preprocess.compare(dino_processor, fast_preprocessor, paths)
+    cosine = np.sum(dino_backend.run(ref.to(device)) * dino_backend.run(out.to(device)), axis=1)
+    result.update({
+        "enabled": True,
+        "cosine_mean": round(float(cosine.mean()), 6),
+        "cosine_min": round(float(cosine.min()), 6)
+    })
+    return result
+
+
+def embed_images(images):
+    # Trích xuất đặc trưng cho danh sách ảnh PIL
+    return embed_prepared([prepare_image(image) for image in images])
+
+
+def embed_prepared(items):
+    # Trích xuất đặc trưng cho các ảnh đã qua prepare_*, mỗi batch là một lần forward
+    load_dino_model()
+    if not items:
+        return np.zeros((0, EMBED_DIM), dtype="float32")
+
+    out = []
+    pos = 0
+    while pos < len(items):
+        size = min(_batch_size, len(items) - pos)
+        chunk = items[pos:pos + size]
+        try:
+            out.append(_forward(chunk))
+        except Exception as e:
+            if not _is_oom(e) or size == 1:
+                raise
+            _shrink_batch_size(size)
+            continue
+        _record_batch_success(size)
+        pos += size
+    return np.vstack(out)
+
+
+def embed_bytes(data, persist=True):
+    # Trích xuất một ảnh từ bytes, dùng lại vector đã có trong cache nếu trùng nội dung
+    key = embed_cache.key(data)
+    vec = embed_cache.get(key)
+    if vec is None:
+        vec = embed_prepared([prepare_bytes(data)])[0]
+        embed_cache.put(key, vec, persist=persist)
+    return vec
+
+
+def _read_prepared(path):
+    # Chạy trong decode_pool: đọc file, tra cache, chỉ giải mã khi chưa có vector
+    with open(path, "rb") as f:
+        data = f.read()
+    key = embed_cache.key(data)
+    vec = embed_cache.get(key)
+    return key, vec, prepare_bytes(data) if vec is None else None
+
+
+def embed_paths(paths):
+    # Đọc và trích xuất theo từng batch để không giữ toàn bộ ảnh trong RAM
+    # Ảnh đã có trong cache (theo nội dung) không cần chạy lại DINO
+    # Trả về (vectors, các path thành công, {path: lỗi})
+    start_time = time.time()
+    load_dino_model()
+    results = {}
+    errors = {}
+    cached = 0
+
+    # Batch kế tiếp được giải mã trong decode_pool trong khi batch hiện tại chạy forward
+    batches = [paths[pos:pos + _batch_size] for pos in range(0, len(paths), _batch_size)]
+    futures = [decode_pool.submit(_read_prepared, path) for path in batches[0]] if batches else []
+    for b, batch_paths in enumerate(batches):
+        current = futures
+        futures = [decode_pool.submit(_read_prepared, path) for path in batches[b + 1]] if b + 1 < len(batches) else []
+
+        items = []
+        pending = []
+        for path, future in zip(batch_paths, current):
+            try:
+                key, vec, item = future.result()
+            except Exception as e:
+                print(f"Lỗi đọc ảnh {path}: {e}")
+                errors[path] = str(e)
+                continue
+            if vec is not None:
+                results[path] = vec
+                cached += 1
+                continue
+            items.append(item)
+            pending.append((path, key))
+
+        if not items:
+            continue
+        try:
+            batch_vectors = embed_prepared(items)
+        except Exception as e:
+            print(f"Lỗi trích xuất đặc trưng batch: {e}")
+            for path, _ in pending:
+                errors[path] = str(e)
+            continue
+        for (path, key), vec in zip(pending, batch_vectors):
+            embed_cache.put(key, vec)
+            results[path] = vec
+
+    # Giữ nguyên thứ tự đầu vào
+    ok_paths = [p for p in paths if p in results]
+    if ok_paths:
+        vectors = np.vstack([results[p] for p in ok_paths]).astype("float32")
+    else:
+        vectors = np.zeros((0, EMBED_DIM), dtype="float32")
+
+    if paths:
+        elapsed = time.time() - start_time
+        print(f"Trích xuất DINO {len(ok_paths)} ảnh ({cached} từ cache): {elapsed:.2f}s ({len(ok_paths) / max(elapsed, 1e-6):.1f} ảnh/s)")
+    return vectors, ok_paths, errors
@@ -0,0 +1,100 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class EmbeddingCache:
+    # Cache vector theo nội dung ảnh + model ID: tầng RAM (LRU, có giới hạn)
+    # và tầng đĩa (mỗi vector một file .npy, tồn tại qua các lần khởi động lại)
+
+    def __init__(self, cache_dir, model_id, max_memory_items=2000):
+        self.cache_dir = cache_dir
+        self.model_tag = hashlib.sha256(model_id.encode("utf-8")).hexdigest()[:16]
+        self.max_memory_items = max_memory_items
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, data):
+        # data: bytes của file ảnh (hoặc hash nội dung đã tính sẵn)
+        digest = data if isinstance(data, str) else content_hash(data)
+        return f"{self.model_tag}-{digest}"
+
+    def _disk_path(self, key):
+        digest = key.split("-", 1)[1]
+        return os.path.join(self.cache_dir, self.model_tag, digest[:2], f"{digest}.npy")
+
+    def _remember(self, key, vec):
+        with self._lock:
+            self._memory[key] = vec
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_items:
+                self._memory.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            vec = self._memory.get(key)
+            if vec is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return vec
+
+        if self.cache_dir:
+            path = self._disk_path(key)
+            if os.path.exists(path):
+                try:
+                    vec = np.load(path)
+                except Exception as e:
+                    print(f"Lỗi đọc cache {path}: {e}")
+                else:
+                    self._remember(key, vec)
+                    with self._lock:
+                        self.hits += 1
+                        self.disk_hits += 1
+                    return vec
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, vec, persist=True):
+        vec = np.asarray(vec, dtype="float32")
+        self._remember(key, vec)
+        if not (persist and self.cache_dir):
+            return
+
+        path = self._disk_path(key)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Ghi file tạm rồi rename để không để lại file hỏng khi crash
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.save(f, vec)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"Lỗi ghi cache {path}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "memory_items": len(self._memory),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0
+        }
@@ -0,0 +1,801 @@
+import os
+import threading
+import time
+
+import faiss
+import numpy as np
+
+import ann_index
+import metrics
+import vector_codec
+from embedder import EMBED_DIM
+from index_version import DeltaBuffer, IndexVersion
+from path_table import PathTable, save_array
+from wal import WriteAheadLog, fsync_path
+
+# memory: đọc toàn bộ index vào RAM (đọc/ghi)
+# mmap: map file index vào bộ nhớ, chỉ đọc; các tiến trình trên cùng máy dùng chung page cache
+INDEX_LOAD_MODE = os.environ.get("INDEX_LOAD_MODE", "memory")
+# Cờ mmap cho IndexFlatCodes (FAISS >= 1.10), bản cũ dùng IO_FLAG_MMAP
+IO_FLAG_MMAP = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+
+# Codec lưu vector trong index chính: flat, fp16, sq8 hoặc pq (xem vector_codec.py)
+INDEX_CODEC = os.environ.get("INDEX_CODEC", "flat")
+
+# === Cấu hình ANN ===
+# Loại index xấp xỉ: ivf-flat, ivf-pq, hnsw hoặc none (luôn tìm chính xác)
+ANN_KIND = os.environ.get("ANN_KIND", "ivf-flat")
+# Tự động train và chuyển sang ANN khi số vector vượt ngưỡng
+ANN_PROMOTE_THRESHOLD = int(os.environ.get("ANN_PROMOTE_THRESHOLD", "50000"))
+ANN_NPROBE = int(os.environ.get("ANN_NPROBE", "16"))
+ANN_EF_SEARCH = int(os.environ.get("ANN_EF_SEARCH", "64"))
+# Gộp lại index khi tỉ lệ vector đã xóa/ghi đè nhưng còn nằm trong base/ANN vượt ngưỡng
+ANN_REBUILD_STALE_RATIO = 0.1
+
+# === Cấu hình rerank ===
+# auto: rerank khi tìm trên ANN hoặc index nén; 1/0: luôn bật/tắt
+SEARCH_RERANK = os.environ.get("SEARCH_RERANK", "auto")
+# Lấy k*M ứng viên ở bước 1 rồi xếp hạng lại bằng vector float32 chính xác
+SEARCH_RERANK_FACTOR = int(os.environ.get("SEARCH_RERANK_FACTOR", "4"))
+SIDECAR_CHUNK = 65536
+
+# === Cấu hình lọc theo metadata ===
+# Tập ID được phép không quá ngưỡng này: chấm điểm trực tiếp từng vector float32 (lọc trước)
+FILTER_PREFILTER_MAX = int(os.environ.get("FILTER_PREFILTER_MAX", "2048"))
+# Tập ID được phép nhỏ hơn tỉ lệ này của index: tìm trên index gốc với IDSelector thay vì ANN
+# (ANN kèm bộ lọc chặt bỏ sót nhiều); rộng hơn thì dùng ANN với IDSelector
+FILTER_ANN_MIN_FRACTION = float(os.environ.get("FILTER_ANN_MIN_FRACTION", "0.2"))
+
+# === Cấu hình WAL / snapshot ===
+# fsync mỗi bản ghi WAL (0: nhanh hơn nhưng có thể mất vài lần thêm gần nhất khi mất điện)
+WAL_FSYNC = os.environ.get("WAL_FSYNC", "1") == "1"
+# Ghi snapshot đầy đủ khi WAL có bản ghi cũ hơn SNAPSHOT_INTERVAL giây hoặc lớn hơn SNAPSHOT_WAL_MB
+SNAPSHOT_INTERVAL = float(os.environ.get("SNAPSHOT_INTERVAL", "60"))
+SNAPSHOT_WAL_MB = float(os.environ.get("SNAPSHOT_WAL_MB", "256"))
+# Gộp delta vào index gốc khi số vector thêm sau snapshot vượt ngưỡng (delta được tìm brute-force)
+INDEX_DELTA_MAX = int(os.environ.get("INDEX_DELTA_MAX", "20000"))
+
+
+class ReadOnlyIndexError(RuntimeError):
+    pass
+
+
+def write_index_atomic(index, path):
+    # Ghi file tạm rồi rename để tiến trình đang mmap file cũ không bị hỏng
+    tmp_path = path + ".tmp"
+    faiss.write_index(index, tmp_path)
+    fsync_path(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def new_index(codec=None):
+    # Mỗi vector mang một ID int64 ổn định, xóa trực tiếp bằng remove_ids
+    codec = codec or INDEX_CODEC
+    if vector_codec.train_min(codec):
+        # Codec cần train: lưu float32 cho đến khi đủ vector rồi mới chuyển
+        codec = "flat"
+    return vector_codec.make_index(codec, EMBED_DIM)
+
+
+class IndexStore:
+    # Index theo version: search ghim self.current (IndexVersion bất biến) nên không cần lock.
+    # Thêm/xóa tạo version mới dưới self.lock, chỉ copy phần thay đổi nhỏ; gộp delta,
+    # train ANN, đổi codec và ghi snapshot chạy ngoài lock rồi hoán đổi version.
+
+    def __init__(self, index_path, paths_path, ids_path, vectors_path, wal_path=None):
+        self.index_path = index_path
+        self.paths_path = paths_path
+        self.ids_path = ids_path
+        # Vector float32 đầy đủ (file .npy mở bằng mmap), các hàng theo thứ tự ids_path
+        self.vectors_path = vectors_path
+        self.ann_path = os.path.splitext(index_path)[0] + "_ann.idx"
+        # Lock của writer; reader không bao giờ giữ
+        self.lock = threading.RLock()
+        # Mỗi lúc chỉ một lần dựng lại (snapshot, ANN, codec, reload)
+        self._rebuild_lock = threading.Lock()
+        self._rebuild_pending = False
+        self._rebuilding = None
+        self.current = IndexVersion(1, new_index())
+        self.next_id = 0
+        self.read_only = INDEX_LOAD_MODE == "mmap"
+        # Mọi thay đổi được ghi vào WAL trước, snapshot đầy đủ ghi nền theo chính sách
+        self.wal = WriteAheadLog(wal_path, WAL_FSYNC) if wal_path else None
+        self._snapshot_seq = 0
+        self._interrupted = False
+        # Tiến trình chỉ đọc: file meta của snapshot đang dùng và seq WAL đã áp dụng
+        self._loaded_stamp = None
+        self._applied_seq = 0
+
+    def __len__(self):
+        return len(self.current)
+
+    @property
+    def ann(self):
+        return self.current.ann
+
+    def _check_writable(self):
+        if self.read_only:
+            raise ReadOnlyIndexError("Index đang mở ở chế độ mmap chỉ đọc")
+
+    def _publish(self, version):
+        # Gán thuộc tính là nguyên tử: search đang chạy vẫn dùng version cũ
+        self.current = version
+
+    # === Tải / lưu ===
+
+    def load(self):
+        loaded = os.path.exists(self.index_path) and os.path.exists(self.paths_path)
+        if loaded:
+            self._load_snapshot()
+        if self.wal is not None:
+            loaded = self._replay_wal() or loaded
+        if loaded:
+            self.maybe_compress()
+            self.maybe_promote()
+        return loaded
+
+    def _meta_stamp(self):
+        # File meta được ghi lại (tmp + rename) sau mỗi snapshot nên inode đổi
+        try:
+            stat = os.stat(vector_codec.meta_path(self.index_path))
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _load_snapshot(self):
+        start_time = time.time()
+        self._loaded_stamp = self._meta_stamp()
+        flags = IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if self.read_only else 0
+        index = faiss.read_index(self.index_path, flags)
+        table, order = PathTable.load(self.ids_path, self.paths_path)
+
+        if not isinstance(index, faiss.IndexIDMap2):
+            # Chuyển index phẳng cũ sang IndexIDMap2, không cần trích xuất lại.
+            # Index cũ không có ID: dùng vị trí làm ID (giống PathTable.load)
+            print("Chuyển index cũ sang IndexIDMap2...")
+            vectors = index.reconstruct_n(0, index.ntotal) if index.ntotal else None
+            index = vector_codec.make_index("flat", EMBED_DIM)
+            if vectors is not None:
+                index.add_with_ids(vectors, np.arange(len(vectors), dtype="int64"))
+
+        codec = vector_codec.codec_of(index)
+        meta = vector_codec.read_meta(self.index_path)
+        if meta.get("codec", codec) != codec:
+            print(f"⚠️ File meta ghi codec {meta['codec']} nhưng index là {codec}")
+        # Lần lưu trước bị ngắt giữa chừng: các file có thể lệch nhau, WAL sẽ sửa lại
+        self._interrupted = meta.get("complete") is False
+        self._snapshot_seq = int(meta.get("wal_seq", 0))
+
+        ann = None
+        if os.path.exists(self.ann_path) and not self._interrupted:
+            ann = faiss.read_index(self.ann_path, flags)
+            if ann.ntotal != index.ntotal:
+                print("ANN index không khớp với index phẳng, sẽ dựng lại")
+                ann = None
+
+        exact = None
+        if os.path.exists(self.vectors_path):
+            exact = np.load(self.vectors_path, mmap_mode="r")
+            if len(exact) != len(table) or (self._interrupted and not self._sidecar_matches(index, table, exact)):
+                print("File vector float32 không khớp với index, bỏ qua")
+                exact = None
+            elif order is not None:
+                # File cũ chưa sắp xếp theo ID: sắp xếp lại trong RAM, lần lưu sau sẽ ghi đúng thứ tự
+                exact = np.ascontiguousarray(exact[order])
+
+        with self.lock:
+            # Không cấp lại ID của ảnh đã xóa sau khi khởi động lại
+            self.next_id = max(table.max_id() + 1, int(meta.get("next_id", 0)))
+            self._publish(IndexVersion(self.current.number + 1, index, ann, table, exact))
+        print(f"Tải index ({INDEX_LOAD_MODE}): {time.time() - start_time:.2f}s")
+
+    def _sidecar_matches(self, index, table, exact, sample=32):
+        # So vài hàng của sidecar với vector giải mã từ index (vector đã chuẩn hóa)
+        ids, _ = table.arrays()
+        for pos in np.linspace(0, len(ids) - 1, min(sample, len(ids))).astype(int):
+            try:
+                approx = index.reconstruct(int(ids[pos]))
+            except RuntimeError:
+                return False
+            if float(np.dot(approx, exact[pos])) < 0.95:
+                return False
+        return True
+
+    def _replay_wal(self):
+        # Áp dụng lại các thay đổi chưa có trong snapshot vào delta của version hiện tại.
+        # Tiến trình chỉ đọc không sửa file WAL (tiến trình ghi có thể đang ghi dở)
+        start_time = time.time()
+        records = self.wal.replay(self._snapshot_seq, repair=not self.read_only)
+        if not self.read_only:
+            self.wal.open()
+        self._applied_seq = max([self._snapshot_seq] + [r["seq"] for r in records])
+        if not records:
+            return False
+
+        with self.lock:
+            if self._interrupted:
+                # Snapshot dở dang có thể chứa một phần các thay đổi: che mọi ID có trong
+                # WAL trước, rồi áp dụng lại theo thứ tự để kết quả không phụ thuộc vào
+                # file nào đã kịp ghi
+                touched = sorted({i for r in records for i in r["ids"]})
+                records = [{"op": "remove", "ids": touched}] + records
+            self._publish(self.current.apply(records))
+            added = [max(r["ids"]) for r in records if r["op"] == "add" and r["ids"]]
+            if added:
+                self.next_id = max(self.next_id, max(added) + 1)
+        print(f"Áp dụng lại {len(records)} bản ghi WAL: {time.time() - start_time:.2f}s")
+        return True
+
+    def save(self):
+        return self._rebuild()
+
+    # === Tiến trình chỉ đọc theo dõi tiến trình ghi ===
+
+    def refresh(self):
+        # Nhận snapshot mới (mở lại bằng mmap, thời gian gần như hằng số) hoặc các bản ghi
+        # WAL mới do tiến trình ghi thêm vào
+        if not self.read_only or self.wal is None:
+            return False
+        with self.lock:
+            stamp = self._meta_stamp()
+            if stamp != self._loaded_stamp:
+                if stamp is None:
+                    # Tiến trình ghi đã reset index
+                    self._publish(IndexVersion(self.current.number + 1, new_index()))
+                    self._loaded_stamp = None
+                    self._snapshot_seq = 0
+                    self._interrupted = False
+                elif vector_codec.read_meta(self.index_path).get("complete") is False:
+                    # Snapshot đang ghi dở: giữ version cũ (file cũ vẫn mở bằng mmap)
+                    return False
+                else:
+                    self._load_snapshot()
+                self._replay_wal()
+                return True
+            records = self.wal.tail(self._applied_seq)
+            if not records:
+                return False
+            self._publish(self.current.apply(records))
+            self._applied_seq = records[-1]["seq"]
+            added = [max(r["ids"]) for r in records if r["op"] == "add" and r["ids"]]
+            if added:
+                self.next_id = max(self.next_id, max(added) + 1)
+            return True
+
+    def start_follow(self, interval):
+        if not self.read_only or self.wal is None:
+            return
+        thread = threading.Thread(target=self._follow_loop, args=(interval,), name="index-follow")
+        thread.daemon = True
+        thread.start()
+
+    def _follow_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Lỗi cập nhật index từ tiến trình ghi: {e}")
+
+    def _write_snapshot(self, base, ann, ids, paths, vectors_of, seq, next_id):
+        # Ghi toàn bộ file của một version; trả về bảng đường dẫn và sidecar mở lại bằng mmap
+        # Đánh dấu đang ghi: nếu crash giữa chừng, lần tải sau biết các file có thể lệch nhau
+        meta = vector_codec.read_meta(self.index_path)
+        if meta:
+            vector_codec.write_meta(self.index_path, dict(meta, complete=False))
+        write_index_atomic(base, self.index_path)
+        save_array(self.paths_path, paths)
+        save_array(self.ids_path, ids)
+        self._write_sidecar(ids, vectors_of)
+        if ann is not None:
+            write_index_atomic(ann, self.ann_path)
+        elif os.path.exists(self.ann_path):
+            os.remove(self.ann_path)
+        # Giữ các khóa khác trong meta (update_meta, vd. regions.migrate_ids)
+        vector_codec.write_meta(self.index_path, dict(
+            meta,
+            codec=vector_codec.codec_of(base),
+            dim=base.d,
+            ntotal=base.ntotal,
+            next_id=next_id,
+            wal_seq=seq,
+            complete=True
+        ))
+        # Snapshot đã chứa mọi bản ghi WAL tới seq
+        if self.wal is not None:
+            self.wal.drop_segments(seq)
+        table, _ = PathTable.load(self.ids_path, self.paths_path)
+        return table, np.load(self.vectors_path, mmap_mode="r")
+
+    def _write_sidecar(self, ids, vectors_of):
+        # Ghi toàn bộ vector float32 theo thứ tự ids ra file tạm rồi rename
+        tmp_path = self.vectors_path + ".tmp.npy"
+        out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype="float32", shape=(len(ids), EMBED_DIM))
+        id_list = ids.tolist()
+        for pos in range(0, len(id_list), SIDECAR_CHUNK):
+            chunk = id_list[pos:pos + SIDECAR_CHUNK]
+            out[pos:pos + len(chunk)] = vectors_of(chunk)
+        out.flush()
+        del out
+        fsync_path(tmp_path)
+        os.replace(tmp_path, self.vectors_path)
+
+    # === Dựng lại version ===
+
+    def _rebuild(self, codec=None, ann_kind=None, retrain=False):
+        # Gộp delta và các ID bị che vào index gốc (kèm đổi codec hoặc train ANN nếu cần),
+        # ghi snapshot rồi hoán đổi version. Writer lock chỉ giữ lúc ghim và lúc hoán đổi.
+        # retrain: train lại codec hiện tại (PQ đủ vector cho mã nhiều bit hơn)
+        self._check_writable()
+        with self._rebuild_lock:
+            with self.lock:
+                v = self.current
+                seq = self.wal.rotate() if self.wal is not None else 0
+                next_id = self.next_id
+            start_time = time.time()
+            before = vector_codec.codec_of(v.base)
+            codec = codec or before
+            reencode = codec != before or retrain
+            if reencode:
+                self._rebuilding = f"codec:{codec}"
+            else:
+                self._rebuilding = f"ann:{ann_kind}" if ann_kind else "snapshot"
+            try:
+                ids, paths = v.table.arrays()
+                delta_pos = v.delta_positions()
+
+                def vectors_of(chunk):
+                    return v.exact_vectors(chunk, delta_pos)
+
+                merged = v.live_delta_ids()
+                stale = np.array(sorted(v.shadowed), dtype="int64")
+                changed = bool(len(merged) or len(stale))
+
+                if reencode:
+                    base = self._encode(codec, ids, vectors_of)
+                elif changed:
+                    base = faiss.clone_index(v.base)
+                    self._merge_into(base, stale, merged, vectors_of)
+                else:
+                    base = v.base
+
+                ann = v.ann
+                kind = ann_kind or (ann_index.kind_of(ann) if ann is not None else None)
+                if kind and (ann_kind or (kind == "hnsw" and len(stale))):
+                    # HNSW không xóa được vector: train lại trên toàn bộ vector hiện có
+                    ann = self._train_ann(kind, ids, vectors_of)
+                elif ann is not None and changed:
+                    ann = faiss.clone_index(ann)
+                    self._merge_into(ann, stale, merged, vectors_of, remove=kind != "hnsw")
+
+                with metrics.stage("snapshot_write"):
+                    table, exact = self._write_snapshot(base, ann, ids, paths, vectors_of, seq, next_id)
+                with self.lock:
+                    self._publish(self._rebase(v, base, ann, table, exact))
+            finally:
+                self._rebuilding = None
+
+        elapsed = time.time() - start_time
+        metrics.stage_seconds.observe(elapsed, "rebuild")
+        if retrain and codec == before:
+            print(f"Đã train lại codec {codec} ({len(ids)} vector): {elapsed:.2f}s")
+        elif reencode:
+            print(f"Đã chuyển index từ {before} sang {codec} ({len(ids)} vector): {elapsed:.2f}s")
+        elif ann_kind:
+            print(f"Đã chuyển sang ANN index ({ann_kind}): {elapsed:.2f}s")
+        print(f"Snapshot index v{self.current.number} ({len(ids)} vector, gộp {len(merged)} mới, "
+              f"{len(stale)} bị che): {elapsed:.2f}s")
+        return True
+
+    def _merge_into(self, index, stale, merged, vectors_of, remove=True):
+        # ID bị ghi đè nằm trong cả stale lẫn merged: bỏ vector cũ trước khi thêm vector mới
+        drop = np.union1d(stale, merged)
+        if remove and len(drop):
+            index.remove_ids(drop)
+        for pos in range(0, len(merged), SIDECAR_CHUNK):
+            chunk = merged[pos:pos + SIDECAR_CHUNK]
+            index.add_with_ids(vectors_of(chunk.tolist()), chunk)
+
+    def _encode(self, codec, ids, vectors_of):
+        # Mã hóa lại từ vector float32 chính xác, không trích xuất lại
+        need = vector_codec.train_min(codec)
+        sample = None
+        if need:
+            if len(ids) < need:
+                raise ValueError(f"Cần ít nhất {need} vector để train codec {codec}")
+            rng = np.random.default_rng(0)
+            sample_ids = np.sort(rng.choice(ids, size=min(vector_codec.TRAIN_SAMPLE, len(ids)), replace=False))
+            sample = vectors_of(sample_ids.tolist())
+        index = vector_codec.make_trained_index(codec, EMBED_DIM, sample)
+        for pos in range(0, len(ids), SIDECAR_CHUNK):
+            chunk = ids[pos:pos + SIDECAR_CHUNK]
+            index.add_with_ids(vectors_of(chunk.tolist()), chunk)
+        return index
+
+    def _train_ann(self, kind, ids, vectors_of):
+        if len(ids) == 0:
+            return None
+        print(f"Đang train ANN index ({kind}) với {len(ids)} vector...")
+        vectors = np.vstack([vectors_of(ids[pos:pos + SIDECAR_CHUNK].tolist())
+                             for pos in range(0, len(ids), SIDECAR_CHUNK)])
+        return ann_index.build_ann_index(kind, vectors, ids, nprobe=ANN_NPROBE, ef_search=ANN_EF_SEARCH)
+
+    def _rebase(self, pinned, base, ann, table, exact):
+        # Áp các thay đổi xảy ra sau khi ghim version lên index vừa dựng
+        cur = self.current
+        new_ids = cur.delta.ids[pinned.n:cur.n]
+        # ID bị xóa sau khi ghim, và ID có sẵn bị ghi đè sau khi ghim, nằm trong base mới
+        shadowed = set(cur.shadowed - pinned.shadowed)
+        shadowed.update(i for i in new_ids.tolist() if i in pinned.table)
+        for i in shadowed:
+            table.pop(i, None)
+        delta, n = DeltaBuffer(max(1024, len(new_ids))).append(0, cur.delta.vectors[pinned.n:cur.n], new_ids)
+        for i in new_ids.tolist():
+            path = cur.table.get(i)
+            if path is not None:
+                table[i] = path
+        return IndexVersion(cur.number + 1, base, ann, table, exact, delta, n, frozenset(shadowed))
+
+    def _rebuild_async(self, **kwargs):
+        with self.lock:
+            if self._rebuild_pending:
+                return False
+            self._rebuild_pending = True
+
+        def run():
+            try:
+                self._rebuild(**kwargs)
+            except Exception as e:
+                print(f"Lỗi dựng lại index: {e}")
+            finally:
+                self._rebuild_pending = False
+
+        thread = threading.Thread(target=run, name="index-rebuild")
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def wait_rebuild(self, timeout=None):
+        # Chờ lần dựng lại nền (nén codec, train ANN) đang chạy xong; False nếu hết thời gian
+        deadline = None if timeout is None else time.time() + timeout
+        while self._rebuild_pending:
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def start_snapshots(self):
+        # Luồng nền ghi snapshot theo chính sách thời gian/kích thước WAL và kích thước delta
+        if self.read_only:
+            return
+        thread = threading.Thread(target=self._snapshot_loop, name="index-snapshot")
+        thread.daemon = True
+        thread.start()
+
+    def _snapshot_loop(self):
+        while True:
+            time.sleep(1)
+            if self._rebuild_pending or self._rebuild_lock.locked():
+                continue
+            v = self.current
+            due = (self.wal is not None and self.wal.due(SNAPSHOT_INTERVAL, SNAPSHOT_WAL_MB * 1024**2)) \
+                or v.n >= INDEX_DELTA_MAX \
+                or len(v.shadowed) > ANN_REBUILD_STALE_RATIO * max(len(v), 1)
+            if due:
+                try:
+                    self.save()
+                except Exception as e:
+                    print(f"Lỗi ghi snapshot index: {e}")
+
+    def update_meta(self, **values):
+        # Ghi thêm khóa vào meta của snapshot; các lần snapshot sau giữ nguyên các khóa này
+        self._check_writable()
+        with self._rebuild_lock:
+            vector_codec.write_meta(self.index_path, dict(vector_codec.read_meta(self.index_path), **values))
+
+    def meta(self):
+        return vector_codec.read_meta(self.index_path)
+
+    def wal_status(self):
+        if self.wal is None:
+            return None
+        return dict(self.wal.stats(), snapshot_interval_s=SNAPSHOT_INTERVAL, snapshot_wal_mb=SNAPSHOT_WAL_MB)
+
+    def version_status(self):
+        v = self.current
+        return {
+            "version": v.number,
+            "base_vectors": v.base.ntotal,
+            "delta_vectors": v.n,
+            "shadowed": len(v.shadowed),
+            "rebuilding": self._rebuilding
+        }
+
+    # === Thay đổi ===
+
+    def reset(self):
+        self._check_writable()
+        with self._rebuild_lock, self.lock:
+            self._publish(IndexVersion(self.current.number + 1, new_index()))
+            self.next_id = 0
+            if self.wal is not None:
+                self.wal.clear()
+            for path in (self.index_path, self.paths_path, self.ids_path, self.ann_path,
+                         self.vectors_path, vector_codec.meta_path(self.index_path)):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def add(self, vectors, paths, ids=None):
+        self._check_writable()
+        vectors = np.ascontiguousarray(vectors, dtype="float32").reshape(-1, EMBED_DIM)
+        with self.lock:
+            if ids is None:
+                ids = np.arange(self.next_id, self.next_id + len(paths), dtype="int64")
+            else:
+                ids = np.asarray(ids, dtype="int64")
+            if len(ids) == 0:
+                return []
+            if self.wal is not None:
+                with metrics.stage("wal_append"):
+                    self.wal.append("add", ids, paths, vectors)
+            self._publish(self.current.apply([
+                {"op": "add", "ids": ids.tolist(), "paths": list(paths), "vectors": vectors}]))
+            self.next_id = max(self.next_id, int(ids.max()) + 1)
+        self.maybe_compress()
+        self.maybe_promote()
+        return ids.tolist()
+
+    def allocate_ids(self, n):
+        with self.lock:
+            ids = list(range(self.next_id, self.next_id + n))
+            self.next_id += n
+        return ids
+
+    def replace(self, vectors, paths, ids):
+        # Dựng index mới rồi thay thế toàn bộ (dùng cho /reload).
+        # Không ghi cả catalog vào WAL: lưu snapshot ngay khi thay
+        self._check_writable()
+        index = new_index()
+        ids = np.asarray(ids, dtype="int64")
+        if len(paths):
+            vectors = np.ascontiguousarray(vectors, dtype="float32").reshape(-1, EMBED_DIM)
+            index.add_with_ids(vectors, ids)
+        sorted_ids, sorted_paths = PathTable.from_items(ids, paths).arrays()
+        rows = {i: j for j, i in enumerate(ids.tolist())}
+
+        def vectors_of(chunk):
+            return vectors[[rows[i] for i in chunk]]
+
+        with self._rebuild_lock, self.lock:
+            seq = self.wal.rotate() if self.wal is not None else 0
+            if len(ids):
+                self.next_id = max(self.next_id, int(ids.max()) + 1)
+            table, exact = self._write_snapshot(index, None, sorted_ids, sorted_paths, vectors_of, seq, self.next_id)
+            self._publish(IndexVersion(self.current.number + 1, index, None, table, exact))
+        self.maybe_compress()
+        self.maybe_promote()
+
+    def remove(self, ids):
+        self._check_writable()
+        with self.lock:
+            v = self.current
+            ids = [i for i in dict.fromkeys(int(i) for i in ids) if i in v.table]
+            if not ids:
+                return []
+            if self.wal is not None:
+                with metrics.stage("wal_append"):
+                    self.wal.append("remove", ids)
+            # Vector cũ chỉ bị che; lần gộp kế tiếp mới xóa khỏi base/ANN
+            self._publish(v.apply([{"op": "remove", "ids": ids}]))
+        return ids
+
+    # === Tra cứu ===
+
+    def ids_for_filename(self, filename):
+        return self.current.table.ids_for_basename(filename)
+
+    def ids_by_path(self):
+        return {p: i for i, p in self.current.table.items()}
+
+    def path_ids(self):
+        # Như ids_by_path nhưng giữ mọi ID: thêm lại cùng tên file tạo nhiều vector cho một file
+        out = {}
+        for i, p in self.current.table.items():
+            out.setdefault(p, []).append(i)
+        return out
+
+    def vectors(self, ids):
+        # Vector float32 đã lưu của các ID còn sống (sidecar, delta hoặc reconstruct)
+        v = self.current
+        return v.exact_vectors([int(i) for i in ids], v.delta_positions())
+
+    def path(self, id_):
+        return self.current.table.get(int(id_))
+
+    def paths(self, ids):
+        # Đường dẫn của nhiều ID (None nếu ID không còn), cùng thứ tự với ids
+        table = self.current.table
+        return [table.get(int(i)) for i in ids]
+
+    def live_ids(self):
+        # Mọi ID còn sống, tăng dần (duyệt toàn bộ catalog theo trang)
+        return self.current.table.id_array()
+
+    def search(self, vectors, k, exact=False, nprobe=None, ef_search=None, rerank=None, rerank_factor=None,
+               id_filter=None):
+        # id_filter: mảng ID được phép (kết quả lọc metadata), top-k chỉ lấy trong tập này
+        with metrics.stage("index_search"):
+            return self._search(vectors, k, exact, nprobe, ef_search, rerank, rerank_factor, id_filter)
+
+    def _search(self, vectors, k, exact, nprobe, ef_search, rerank, rerank_factor, id_filter=None):
+        # Ghim version hiện tại: thêm/xóa/dựng lại đồng thời không ảnh hưởng tới truy vấn này
+        v = self.current
+        vectors = np.ascontiguousarray(vectors, dtype="float32").reshape(-1, EMBED_DIM)
+        allowed = None
+        if id_filter is not None:
+            allowed = np.asarray(id_filter, dtype="int64")
+            if len(allowed) <= FILTER_PREFILTER_MAX:
+                return self._search_candidates(v, vectors, k, allowed)
+        k = min(k, len(v))
+        if k == 0:
+            return [[] for _ in range(len(vectors))]
+        use_ann = v.ann is not None and not exact and (
+            allowed is None or len(allowed) >= FILTER_ANN_MIN_FRACTION * len(v))
+        # Lọc ngay trong FAISS: chỉ ID thuộc tập được phép mới được chấm điểm
+        sel = faiss.IDSelectorBatch(allowed) if allowed is not None else None
+        if rerank is None:
+            rerank = SEARCH_RERANK == "1" or (
+                SEARCH_RERANK == "auto" and (use_ann or vector_codec.codec_of(v.base) != "flat"))
+        # Bước 1: lấy k*M ứng viên từ index nén/xấp xỉ
+        fetch = k * (rerank_factor or SEARCH_RERANK_FACTOR) if rerank else k
+        source = v.ann if use_ann else v.base
+        D = I = None
+        if source.ntotal:
+            # Lấy dư để bù các vector đã xóa/ghi đè còn nằm trong base/ANN
+            fetch = min(fetch + len(v.shadowed), source.ntotal)
+            if use_ann:
+                params = ann_index.search_params(v.ann, nprobe or ANN_NPROBE, ef_search or ANN_EF_SEARCH, sel)
+                D, I = v.ann.search(vectors, fetch, params=params)
+            else:
+                D, I = v.base.search(vectors, fetch, params=ann_index.search_params(v.base, sel=sel))
+        # Vector thêm sau snapshot: tìm chính xác trên delta
+        delta_hits = v.search_delta(vectors, k, allowed)
+
+        results = []
+        for row in range(len(vectors)):
+            hits = []
+            if I is not None:
+                hits = [(int(i), float(d)) for d, i in zip(D[row], I[row])
+                        if i >= 0 and int(i) not in v.shadowed and int(i) in v.table]
+            if rerank and hits:
+                # Bước 2: xếp hạng lại bằng tích vô hướng chính xác
+                candidates = [i for i, _ in hits]
+                scores = v.exact_vectors(candidates) @ vectors[row]
+                hits = list(zip(candidates, scores.tolist()))
+            hits = sorted(hits + delta_hits[row], key=lambda hit: -hit[1])[:k]
+            results.append([(i, d, v.table[i]) for i, d in hits])
+        if use_ann and allowed is not None and any(len(row) < min(k, len(allowed)) for row in results):
+            # ANN kèm bộ lọc trả thiếu kết quả (cụm/đồ thị không chứa đủ ID hợp lệ): tìm lại trên index gốc
+            return self._search(vectors, k, True, nprobe, ef_search, rerank, rerank_factor, allowed)
+        return results
+
+    def _search_candidates(self, v, vectors, k, allowed):
+        # Tập ID được phép nhỏ: chấm điểm chính xác từng vector float32, không quét index
+        ids = [i for i in allowed.tolist() if i in v.table]
+        if not ids:
+            return [[] for _ in range(len(vectors))]
+        scores = vectors @ v.exact_vectors(ids, v.delta_positions()).T
+        k = min(k, len(ids))
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for row in range(len(vectors)):
+            top = sorted(part[row], key=lambda j: -scores[row, j])
+            results.append([(ids[j], float(scores[row, j]), v.table[ids[j]]) for j in top])
+        return results
+
+    # === Codec ===
+
+    def maybe_compress(self):
+        # Index đang lưu float32 chờ đủ vector để train codec nén đã cấu hình. PQ train trên kho
+        # nhỏ dùng ít bit hơn; chỉ train lại khi kho đủ lớn cho thêm một bit (tối đa vài lần)
+        if INDEX_CODEC == "flat" or self.read_only:
+            return
+        v = self.current
+        codec = vector_codec.codec_of(v.base)
+        if codec == "flat":
+            if len(v) >= vector_codec.train_min(INDEX_CODEC):
+                self._rebuild_async(codec=INDEX_CODEC)
+        elif codec == INDEX_CODEC == "pq" and vector_codec.pq_nbits(len(v)) > vector_codec.nbits_of(v.base):
+            self._rebuild_async(codec=INDEX_CODEC, retrain=True)
+
+    def migrate_codec(self, codec):
+        # Chuyển codec từ các vector float32 đã lưu, không trích xuất lại.
+        # Train và mã hóa lại ngoài lock, search vẫn chạy trên version cũ
+        self._check_writable()
+        v = self.current
+        if vector_codec.codec_of(v.base) == codec:
+            return False
+        need = vector_codec.train_min(codec)
+        if need and len(v) < need:
+            raise ValueError(f"Cần ít nhất {need} vector để train codec {codec}")
+        return self._rebuild(codec=codec)
+
+    def codec_status(self):
+        base = self.current.base
+        per_vector = vector_codec.bytes_per_vector(base)
+        return {
+            "codec": vector_codec.codec_of(base),
+            "target_codec": INDEX_CODEC,
+            "pq_nbits": vector_codec.nbits_of(base),
+            "bytes_per_vector": per_vector,
+            "vectors_mb": round(per_vector * base.ntotal / 1024**2, 2)
+        }
+
+    # === ANN ===
+
+    def maybe_promote(self):
+        # Tiến trình chỉ đọc dùng ANN do tiến trình ghi dựng và lưu
+        if ANN_KIND == "none" or self.read_only:
+            return
+        if self.current.ann is None and len(self) >= ANN_PROMOTE_THRESHOLD:
+            self._rebuild_async(ann_kind=ANN_KIND)
+
+    def build_ann_async(self, kind=None):
+        return self._rebuild_async(ann_kind=kind or (ANN_KIND if ANN_KIND != "none" else "ivf-flat"))
+
+    def ann_status(self):
+        v = self.current
+        info = ann_index.describe(v.ann) if v.ann is not None else {"kind": "flat"}
+        info.update({
+            "building": (self._rebuilding or "").startswith("ann"),
+            "promote_threshold": ANN_PROMOTE_THRESHOLD,
+            "stale": len(v.shadowed)
+        })
+        return info
+
+    def recall_check(self, k=10, num_queries=200, nprobe_values=None, ef_search_values=None):
+        # Đo recall@k của đường tìm kiếm ANN (như /search: base/ANN + delta, có và không rerank)
+        # so với top-k chính xác tính từ vector float32 của mọi ID còn sống,
+        # dùng chính các vector đã lưu làm truy vấn
+        v = self.current
+        if v.ann is None:
+            return []
+        ids = v.table.id_array()
+        rng = np.random.default_rng(0)
+        sample = rng.choice(ids, size=min(num_queries, len(ids)), replace=False)
+        delta_pos = v.delta_positions()
+        queries = v.exact_vectors(sample.tolist(), delta_pos)
+        k = min(k, len(ids))
+        exact = self._exact_top(v, queries, ids, k, delta_pos)
+
+        # Chỉ quét tham số phù hợp với loại ANN đang dùng
+        if ann_index.kind_of(v.ann) == "hnsw":
+            settings = [{"ef_search": val} for val in (ef_search_values or [ANN_EF_SEARCH])]
+        else:
+            settings = [{"nprobe": val} for val in (nprobe_values or [ANN_NPROBE])]
+
+        results = []
+        for setting in settings:
+            row = dict(setting)
+            for rerank, suffix in ((False, ""), (True, "_rerank")):
+                start_time = time.time()
+                hits = self._search(queries, k, False, setting.get("nprobe"), setting.get("ef_search"), rerank, None)
+                elapsed = time.time() - start_time
+                approx = np.array([[i for i, _, _ in h] + [-1] * (k - len(h)) for h in hits], dtype="int64")
+                row["recall" + suffix] = round(ann_index.recall_at_k(exact, approx), 4)
+                row["ms_per_query" + suffix] = round(elapsed * 1000 / max(len(queries), 1), 3)
+            results.append(row)
+        return results
+
+    def _exact_top(self, v, queries, ids, k, delta_pos):
+        # Top-k chính xác (ID) bằng tích vô hướng float32, quét theo từng khối ID
+        best_ids = np.empty((len(queries), 0), dtype="int64")
+        best_scores = np.empty((len(queries), 0), dtype="float32")
+        for pos in range(0, len(ids), SIDECAR_CHUNK):
+            chunk = ids[pos:pos + SIDECAR_CHUNK]
+            scores = np.hstack([best_scores, queries @ v.exact_vectors(chunk.tolist(), delta_pos).T])
+            cand = np.hstack([best_ids, np.broadcast_to(chunk, (len(queries), len(chunk)))])
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(scores, top, axis=1)
+            best_ids = np.take_along_axis(cand, top, axis=1)
+        return best_ids
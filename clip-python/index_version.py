@@ -0,0 +1,142 @@
+import numpy as np
+
+import vector_codec
+from embedder import EMBED_DIM
+from path_table import PathTable
+
+
+class DeltaBuffer:
+    # Vùng đệm vector float32 chỉ ghi nối: version cũ đọc [:n] của nó trong khi
+    # writer ghi tiếp phía sau; khi đầy thì cấp vùng mới, version cũ giữ vùng cũ
+    def __init__(self, capacity=1024):
+        self.vectors = np.empty((capacity, EMBED_DIM), dtype="float32")
+        self.ids = np.empty(capacity, dtype="int64")
+        self.size = 0
+
+    def append(self, n, vectors, ids):
+        m = len(ids)
+        buffer = self
+        if n != self.size or n + m > len(self.ids):
+            buffer = DeltaBuffer(max(2 * len(self.ids), n + m))
+            buffer.vectors[:n] = self.vectors[:n]
+            buffer.ids[:n] = self.ids[:n]
+            buffer.size = n
+        buffer.vectors[n:n + m] = vectors
+        buffer.ids[n:n + m] = ids
+        buffer.size = n + m
+        return buffer, n + m
+
+
+class IndexVersion:
+    # Ảnh chụp bất biến của index: search ghim một version và đọc không cần lock.
+    #   base/ann: FAISS index từ snapshot gần nhất, không bị sửa sau khi công bố
+    #   delta[:n]: vector thêm sau snapshot (tìm chính xác bằng tích vô hướng)
+    #   shadowed: ID có vector trong base/ann đã bị xóa hoặc bị ghi đè
+    #   table: ID -> đường dẫn của mọi ảnh còn sống; exact: sidecar float32 theo table
+
+    def __init__(self, number, base, ann=None, table=None, exact=None, delta=None, n=0, shadowed=frozenset()):
+        self.number = number
+        self.base = base
+        self.ann = ann
+        self.table = table if table is not None else PathTable()
+        self.exact = exact
+        self.delta = delta if delta is not None else DeltaBuffer()
+        self.n = n
+        self.shadowed = shadowed
+        self._latest = None
+
+    def __len__(self):
+        return len(self.table)
+
+    def apply(self, records):
+        # Version mới sau khi áp dụng các bản ghi (cùng định dạng WAL): một lần copy bảng
+        table = self.table.copy()
+        shadowed = set(self.shadowed)
+        delta, n = self.delta, self.n
+        for record in records:
+            ids = [int(i) for i in record["ids"]]
+            if record["op"] == "add":
+                # Ghi đè ID đã có: che vector cũ trong base
+                shadowed.update(i for i in ids if i in table)
+                table.update(zip(ids, record["paths"]))
+                delta, n = delta.append(n, record["vectors"], ids)
+            elif record["op"] == "remove":
+                for i in ids:
+                    table.pop(i, None)
+                shadowed.update(ids)
+        return IndexVersion(self.number + 1, self.base, self.ann, table, self.exact, delta, n, frozenset(shadowed))
+
+    def delta_positions(self):
+        # ID -> vị trí trong delta (bản ghi sau cùng thắng)
+        return {int(i): pos for pos, i in enumerate(self.delta.ids[:self.n].tolist())}
+
+    def latest_delta(self):
+        # Mặt nạ các vị trí delta còn hiệu lực: ID bị ghi đè nhiều lần trước snapshot chỉ giữ
+        # bản ghi sau cùng. Version bất biến nên tính một lần
+        if self._latest is None:
+            _, last = np.unique(self.delta.ids[:self.n][::-1], return_index=True)
+            latest = np.zeros(self.n, dtype=bool)
+            latest[self.n - 1 - last] = True
+            self._latest = latest
+        return self._latest
+
+    def live_delta_ids(self):
+        return np.array(sorted({i for i in self.delta.ids[:self.n].tolist() if i in self.table}), dtype="int64")
+
+    def search_delta(self, vectors, k, allowed=None):
+        # allowed: mảng ID được phép (lọc theo metadata), None = mọi ID
+        latest = self.latest_delta()
+        if allowed is None and latest.all():
+            # Không lọc, không có bản ghi bị ghi đè: nhân trực tiếp trên view, không copy delta
+            positions = np.arange(self.n)
+            matrix = self.delta.vectors[:self.n]
+        else:
+            if allowed is not None:
+                latest = latest & np.isin(self.delta.ids[:self.n], allowed)
+            positions = np.flatnonzero(latest)
+            matrix = self.delta.vectors[positions]
+        if len(positions) == 0:
+            return [[] for _ in range(len(vectors))]
+        scores = vectors @ matrix.T
+        # Lấy dư để bù các vector trong delta đã bị xóa
+        top = min(len(positions), k + len(self.shadowed))
+        part = np.argpartition(-scores, top - 1, axis=1)[:, :top]
+        results = []
+        for row in range(len(vectors)):
+            hits = []
+            for pos in part[row]:
+                i = int(self.delta.ids[positions[pos]])
+                if i in self.table:
+                    hits.append((i, float(scores[row, pos])))
+            results.append(hits)
+        return results
+
+    def exact_vectors(self, ids, delta_pos=None):
+        out = np.empty((len(ids), EMBED_DIM), dtype="float32")
+        rows = []
+        positions = []
+        rebuilt = []
+        use_sidecar = self.exact is not None and vector_codec.codec_of(self.base) != "flat"
+        for j, i in enumerate(ids):
+            pos = delta_pos.get(i) if delta_pos else None
+            if pos is not None:
+                out[j] = self.delta.vectors[pos]
+                continue
+            # Hàng trong sidecar trùng với vị trí trong phần gốc của bảng đường dẫn
+            row = self.table.position(i) if use_sidecar else -1
+            if row >= 0:
+                rows.append(row)
+                positions.append(j)
+            else:
+                rebuilt.append(j)
+        if rebuilt:
+            # Index phẳng: reconstruct là chính xác; index nén thiếu sidecar: xấp xỉ.
+            # Một lần reconstruct_batch thay vì gọi từng ID
+            keys = np.array([ids[j] for j in rebuilt], dtype="int64")
+            out[np.array(rebuilt)] = self.base.reconstruct_batch(keys)
+        if rows:
+            # Đọc các hàng theo thứ tự tăng dần để page cache đọc tuần tự
+            rows = np.array(rows)
+            order = np.argsort(rows)
+            out[np.array(positions)[order]] = self.exact[rows[order]]
+        return out
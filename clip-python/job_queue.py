@@ -0,0 +1,191 @@
+import json
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class QueueFullError(RuntimeError):
+    pass
+
+
+class Job:
+    # Ngữ cảnh truyền cho handler: danh sách file chưa xử lý và hàm báo tiến độ
+    def __init__(self, queue_, job_id, kind, params, resumed):
+        self._queue = queue_
+        self.id = job_id
+        self.kind = kind
+        self.params = params
+        self.resumed = resumed
+
+    def pending_files(self):
+        return self._queue._pending_files(self.id)
+
+    def report(self, done, errors=None, added=0):
+        self._queue._report(self.id, done, errors or {}, added)
+
+
+class JobQueue:
+    # Hàng đợi job lưu trong SQLite: job và trạng thái từng file sống sót qua
+    # restart; job đang chạy dở được đưa lại vào hàng đợi khi khởi động.
+
+    def __init__(self, db_path, handler, workers=1, max_queued=50):
+        self.handler = handler
+        self.max_queued = max_queued
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db_lock = threading.Lock()
+        self._queue = queue.Queue()
+        with self._db_lock, self._db:
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    params TEXT,
+                    total INTEGER DEFAULT 0,
+                    processed INTEGER DEFAULT 0,
+                    added INTEGER DEFAULT 0,
+                    failed INTEGER DEFAULT 0,
+                    error TEXT,
+                    created REAL,
+                    started REAL,
+                    finished REAL
+                );
+                CREATE TABLE IF NOT EXISTS job_files (
+                    job_id TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    error TEXT,
+                    PRIMARY KEY (job_id, path)
+                );
+            """)
+        self._resume()
+        for i in range(max(1, workers)):
+            thread = threading.Thread(target=self._worker, name=f"job-worker-{i}")
+            thread.daemon = True
+            thread.start()
+
+    def _resume(self):
+        with self._db_lock, self._db:
+            rows = self._db.execute(
+                "SELECT id FROM jobs WHERE status IN ('queued', 'running') ORDER BY created").fetchall()
+            self._db.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'")
+        for (job_id,) in rows:
+            self._queue.put((job_id, True))
+        if rows:
+            print(f"Tiếp tục {len(rows)} job chưa xong")
+
+    def is_full(self):
+        return self._queue.qsize() >= self.max_queued
+
+    def submit(self, kind, files, params=None):
+        if self.is_full():
+            raise QueueFullError(f"Hàng đợi đã đầy ({self.max_queued} job)")
+        job_id = uuid.uuid4().hex
+        # Cùng file gửi nhiều lần trong một job chỉ xử lý một lần; total khớp số dòng job_files
+        files = list(dict.fromkeys(files))
+        with self._db_lock, self._db:
+            self._db.execute(
+                "INSERT INTO jobs (id, kind, status, params, total, created) VALUES (?, ?, 'queued', ?, ?, ?)",
+                (job_id, kind, json.dumps(params or {}), len(files), time.time()))
+            self._db.executemany(
+                "INSERT OR IGNORE INTO job_files (job_id, path) VALUES (?, ?)",
+                [(job_id, path) for path in files])
+        self._queue.put((job_id, False))
+        return job_id
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def get(self, job_id, max_errors=100):
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT id, kind, status, total, processed, added, failed, error, created, started, finished "
+                "FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            errors = self._db.execute(
+                "SELECT path, error FROM job_files WHERE job_id = ? AND state = 'error' LIMIT ?",
+                (job_id, max_errors)).fetchall()
+        return self._to_dict(row, dict(errors))
+
+    def active(self, kind):
+        # Job loại kind đang chờ hoặc đang chạy (cũ nhất trước), None nếu không có
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT id FROM jobs WHERE kind = ? AND status IN ('queued', 'running') ORDER BY created LIMIT 1",
+                (kind,)).fetchone()
+        return self.get(row[0]) if row else None
+
+    def list(self, limit=20):
+        with self._db_lock:
+            rows = self._db.execute(
+                "SELECT id, kind, status, total, processed, added, failed, error, created, started, finished "
+                "FROM jobs ORDER BY created DESC LIMIT ?", (limit,)).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def _to_dict(self, row, errors=None):
+        job_id, kind, status, total, processed, added, failed, error, created, started, finished = row
+        elapsed = ((finished or time.time()) - started) if started else 0.0
+        job = {
+            "id": job_id,
+            "kind": kind,
+            "status": status,
+            "total": total,
+            "processed": processed,
+            "added": added,
+            "failed": failed,
+            "progress": round(processed / total, 4) if total else 1.0,
+            "created": created,
+            "started": started,
+            "finished": finished,
+            "elapsed_s": round(elapsed, 2),
+            "throughput_per_s": round(processed / elapsed, 2) if elapsed > 0 else 0.0
+        }
+        if error:
+            job["error"] = error
+        if errors is not None:
+            job["errors"] = errors
+        return job
+
+    def _pending_files(self, job_id):
+        with self._db_lock:
+            rows = self._db.execute(
+                "SELECT path FROM job_files WHERE job_id = ? AND state = 'pending' ORDER BY rowid",
+                (job_id,)).fetchall()
+        return [path for (path,) in rows]
+
+    def _report(self, job_id, done, errors, added):
+        with self._db_lock, self._db:
+            self._db.executemany(
+                "UPDATE job_files SET state = 'done' WHERE job_id = ? AND path = ?",
+                [(job_id, path) for path in done])
+            self._db.executemany(
+                "UPDATE job_files SET state = 'error', error = ? WHERE job_id = ? AND path = ?",
+                [(str(error), job_id, path) for path, error in errors.items()])
+            self._db.execute(
+                "UPDATE jobs SET processed = processed + ?, added = added + ?, failed = failed + ? WHERE id = ?",
+                (len(done) + len(errors), added, len(errors), job_id))
+
+    def _set_status(self, job_id, status, error=None):
+        column = "started" if status == "running" else "finished"
+        with self._db_lock, self._db:
+            self._db.execute(
+                f"UPDATE jobs SET status = ?, error = ?, {column} = COALESCE({column}, ?) WHERE id = ?",
+                (status, error, time.time(), job_id))
+
+    def _worker(self):
+        while True:
+            job_id, resumed = self._queue.get()
+            with self._db_lock:
+                row = self._db.execute("SELECT kind, params FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                continue
+            self._set_status(job_id, "running")
+            try:
+                self.handler(Job(self, job_id, row[0], json.loads(row[1] or "{}"), resumed))
+                self._set_status(job_id, "done")
+            except Exception as e:
+                print(f"Lỗi job {job_id}: {e}")
+                self._set_status(job_id, "failed", str(e))
@@ -0,0 +1,161 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+HASH_CHUNK = 1 << 20
+
+
+def file_hash(path):
+    # Cùng định dạng với embedding_cache.content_hash nhưng đọc theo khối
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_info(path):
+    # (size, mtime_ns, hash) của file hiện tại; chạy được trong thread pool
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns, file_hash(path)
+
+
+def scan_dir(directory):
+    # {đường dẫn: (size, mtime_ns)} của mọi ảnh trong thư mục, chỉ stat, không đọc nội dung
+    files = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                stat = entry.stat()
+                files[entry.path] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+class Manifest:
+    # Trạng thái của từng file ảnh đã được đưa vào index: (size, mtime, hash nội dung,
+    # model đã trích xuất, ID vector). /reload so sánh với thư mục ảnh để chỉ trích xuất
+    # file mới hoặc đã đổi và xóa vector của file đã mất.
+    # File trùng (cùng nội dung hoặc gần trùng với ảnh đã có) không có vector riêng: bảng
+    # duplicates liên kết file với ID của ảnh gốc, cột id trong files cũng là ID ảnh gốc.
+
+    def __init__(self, db_path):
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db_lock = threading.Lock()
+        with self._db_lock, self._db:
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    hash TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    id INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS files_hash ON files (hash);
+                CREATE TABLE IF NOT EXISTS duplicates (
+                    path TEXT PRIMARY KEY,
+                    id INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    score REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS duplicates_id ON duplicates (id);
+            """)
+
+    def __len__(self):
+        with self._db_lock:
+            return self._db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def entries(self):
+        # {đường dẫn: (size, mtime_ns, hash, model, ID)}
+        with self._db_lock:
+            rows = self._db.execute("SELECT path, size, mtime_ns, hash, model, id FROM files").fetchall()
+        return {row[0]: tuple(row[1:]) for row in rows}
+
+    def put(self, rows):
+        # rows: [(đường dẫn, size, mtime_ns, hash, model, ID)]
+        with self._db_lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, hash, model, id) VALUES (?, ?, ?, ?, ?, ?)",
+                rows)
+
+    def remove(self, paths):
+        with self._db_lock, self._db:
+            self._db.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in paths])
+            self._db.executemany("DELETE FROM duplicates WHERE path = ?", [(p,) for p in paths])
+
+    def clear(self):
+        with self._db_lock, self._db:
+            self._db.execute("DELETE FROM files")
+            self._db.execute("DELETE FROM duplicates")
+
+    # === Ảnh trùng ===
+
+    def find_hashes(self, hashes):
+        # {hash: ID ảnh gốc} của các file đã biết có cùng nội dung
+        hashes = list(hashes)
+        if not hashes:
+            return {}
+        with self._db_lock:
+            rows = self._db.execute(
+                f"SELECT hash, id FROM files WHERE hash IN ({','.join('?' * len(hashes))})", hashes).fetchall()
+        return dict(rows)
+
+    def link(self, rows):
+        # rows: [(đường dẫn, ID ảnh gốc, "exact" | "near", điểm cosine)]
+        with self._db_lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO duplicates (path, id, kind, score) VALUES (?, ?, ?, ?)", rows)
+
+    def unlink(self, paths):
+        with self._db_lock, self._db:
+            self._db.executemany("DELETE FROM duplicates WHERE path = ?", [(p,) for p in paths])
+
+    def duplicates(self, paths=None, limit=None):
+        # {đường dẫn: (ID ảnh gốc, loại, điểm)}, của mọi file trùng hoặc chỉ các đường dẫn cho trước
+        with self._db_lock:
+            if paths is not None:
+                paths = list(paths)
+                rows = self._db.execute(
+                    f"SELECT path, id, kind, score FROM duplicates WHERE path IN ({','.join('?' * len(paths))})",
+                    paths).fetchall() if paths else []
+            else:
+                rows = self._db.execute("SELECT path, id, kind, score FROM duplicates ORDER BY id, path LIMIT ?",
+                                        (-1 if limit is None else limit,)).fetchall()
+        return {row[0]: tuple(row[1:]) for row in rows}
+
+    def duplicates_of(self, ids):
+        # {ID ảnh gốc: [đường dẫn file trùng]}
+        ids = [int(i) for i in ids]
+        if not ids:
+            return {}
+        with self._db_lock:
+            rows = self._db.execute(
+                f"SELECT id, path FROM duplicates WHERE id IN ({','.join('?' * len(ids))}) ORDER BY path", ids).fetchall()
+        out = {}
+        for id_, path in rows:
+            out.setdefault(id_, []).append(path)
+        return out
+
+    def promote(self, path, old_id, new_id):
+        # File trùng thành ảnh gốc mới (ảnh gốc cũ đã bị xóa): các file trùng còn lại trỏ sang ID mới
+        with self._db_lock, self._db:
+            self._db.execute("DELETE FROM duplicates WHERE path = ?", (path,))
+            self._db.execute("UPDATE duplicates SET id = ? WHERE id = ?", (new_id, old_id))
+            self._db.execute("UPDATE files SET id = ? WHERE id = ?", (new_id, old_id))
+
+    def duplicate_counts(self):
+        with self._db_lock:
+            rows = self._db.execute("SELECT kind, COUNT(*) FROM duplicates GROUP BY kind").fetchall()
+        return dict({"exact": 0, "near": 0}, **dict(rows))
+
+    def diff(self, files, model):
+        # So thư mục (kết quả scan_dir) với manifest: (file cần kiểm tra, file đã mất, số file không đổi).
+        # File cần kiểm tra là file mới, đổi size/mtime hoặc trích xuất bằng model khác;
+        # đổi mtime nhưng cùng nội dung được nhận ra bằng hash lúc chạy job, không trích xuất lại
+        entries = self.entries()
+        changed = [p for p, stat in files.items()
+                   if p not in entries or entries[p][:2] != stat or entries[p][3] != model]
+        gone = [p for p in entries if p not in files]
+        return sorted(changed), sorted(gone), len(files) - len(changed)
@@ -0,0 +1,285 @@
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Số kết quả lọc (theo biểu thức) được giữ lại; xóa sạch khi metadata thay đổi
+FILTER_CACHE_SIZE = 256
+RANGE_OPS = ("$lt", "$lte", "$gt", "$gte")
+
+
+class MetadataError(ValueError):
+    pass
+
+
+def canonical(expr):
+    # Chuỗi JSON chuẩn của biểu thức lọc: cùng điều kiện -> cùng khóa cache / cùng nhóm batch
+    return json.dumps(expr, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+
+
+def check_metadata(data):
+    if not isinstance(data, dict):
+        raise MetadataError("metadata phải là object JSON")
+    for field, value in data.items():
+        if field.startswith("$"):
+            raise MetadataError(f"Tên trường không được bắt đầu bằng '$': {field}")
+        values = value if isinstance(value, list) else [value]
+        for v in values:
+            if not isinstance(v, (str, bool, int, float)):
+                raise MetadataError(f"Trường {field}: chỉ hỗ trợ chuỗi, số, bool hoặc danh sách của chúng")
+
+
+class MetadataIndex:
+    # Metadata theo ID vector (category, tags, giá, tồn kho...) lưu trong SQLite và
+    # chỉ mục ngược trong RAM để /search lọc trước khi tìm:
+    #   chuỗi/bool: trường -> giá trị -> tập ID (danh sách thì mỗi phần tử một mục)
+    #   số: trường -> mảng (giá trị, ID) đã sắp xếp, truy vấn khoảng bằng searchsorted
+    # Mỗi thay đổi mang một seq tăng dần (xóa = data NULL), tiến trình reader chỉ đọc
+    # các dòng có seq mới hơn lần đọc trước.
+    # Metadata của file chưa có trong index được giữ theo đường dẫn (pending) và gắn
+    # vào ID khi file được thêm (job add-batch, reload).
+
+    def __init__(self, db_path):
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db_lock = threading.Lock()
+        with self._db_lock, self._db:
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS items (
+                    id INTEGER PRIMARY KEY,
+                    data TEXT,
+                    seq INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS items_seq ON items (seq);
+                CREATE TABLE IF NOT EXISTS pending (
+                    path TEXT PRIMARY KEY,
+                    data TEXT NOT NULL
+                );
+            """)
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._data = {}
+        self._fields = {}
+        self._postings = {}
+        self._numbers = {}
+        self._sorted = {}
+        self._cache = OrderedDict()
+        self.refresh()
+
+    def __len__(self):
+        return len(self._data)
+
+    # === Đồng bộ với SQLite ===
+
+    def refresh(self):
+        # Áp dụng các thay đổi chưa đọc (của chính tiến trình này hoặc của writer)
+        with self._db_lock:
+            rows = self._db.execute(
+                "SELECT id, data, seq FROM items WHERE seq > ? ORDER BY seq", (self._seq,)).fetchall()
+        if not rows:
+            return
+        with self._lock:
+            for id_, data, seq in rows:
+                self._unindex(id_)
+                if data is not None:
+                    self._index(id_, json.loads(data))
+                self._seq = max(self._seq, seq)
+            self._cache.clear()
+
+    def _write(self, items):
+        # items: [(ID, dict hoặc None)]
+        with self._db_lock, self._db:
+            seq = self._db.execute("SELECT COALESCE(MAX(seq), 0) FROM items").fetchone()[0] + 1
+            self._db.executemany(
+                "INSERT OR REPLACE INTO items (id, data, seq) VALUES (?, ?, ?)",
+                [(int(i), json.dumps(d, ensure_ascii=False) if d is not None else None, seq) for i, d in items])
+        self.refresh()
+
+    def _index(self, id_, data):
+        self._data[id_] = data
+        for field, value in data.items():
+            self._fields.setdefault(field, set()).add(id_)
+            for v in value if isinstance(value, list) else [value]:
+                if isinstance(v, (str, bool)):
+                    self._postings.setdefault(field, {}).setdefault(v, set()).add(id_)
+                else:
+                    self._numbers.setdefault(field, {}).setdefault(id_, []).append(float(v))
+                    self._sorted.pop(field, None)
+
+    def _unindex(self, id_):
+        data = self._data.pop(id_, None)
+        if data is None:
+            return
+        for field, value in data.items():
+            self._fields[field].discard(id_)
+            for v in value if isinstance(value, list) else [value]:
+                if isinstance(v, (str, bool)):
+                    self._postings[field][v].discard(id_)
+                    if not self._postings[field][v]:
+                        del self._postings[field][v]
+                elif self._numbers[field].pop(id_, None) is not None:
+                    self._sorted.pop(field, None)
+
+    # === Ghi (chỉ writer) ===
+
+    def get(self, id_):
+        return self._data.get(int(id_))
+
+    def put(self, items, merge=False):
+        # items: {ID: dict}; merge=True thì chỉ ghi đè các trường được gửi
+        if not items:
+            return
+        for data in items.values():
+            check_metadata(data)
+        if merge:
+            items = {i: dict(self._data.get(int(i), {}), **data) for i, data in items.items()}
+        self._write(items.items())
+
+    def remove(self, ids):
+        ids = [int(i) for i in ids if int(i) in self._data]
+        if ids:
+            self._write([(i, None) for i in ids])
+
+    def stage(self, items):
+        # items: {đường dẫn: dict} cho file chưa được thêm vào index
+        if not items:
+            return
+        for data in items.values():
+            check_metadata(data)
+        with self._db_lock, self._db:
+            self._db.executemany("INSERT OR REPLACE INTO pending (path, data) VALUES (?, ?)",
+                                 [(p, json.dumps(d, ensure_ascii=False)) for p, d in items.items()])
+
+    def attach(self, ids, paths):
+        # Gắn metadata đang chờ của các file vừa được thêm vào ID của chúng
+        if not paths:
+            return 0
+        with self._db_lock:
+            rows = self._db.execute(
+                f"SELECT path, data FROM pending WHERE path IN ({','.join('?' * len(paths))})", list(paths)).fetchall()
+        if not rows:
+            return 0
+        staged = dict(rows)
+        self._write([(i, json.loads(staged[p])) for i, p in zip(ids, paths) if p in staged])
+        with self._db_lock, self._db:
+            self._db.executemany("DELETE FROM pending WHERE path = ?", [(p,) for p in staged])
+        return len(staged)
+
+    def clear(self):
+        with self._db_lock, self._db:
+            self._db.execute("DELETE FROM pending")
+        self.remove(list(self._data))
+
+    def stats(self):
+        with self._db_lock:
+            pending = self._db.execute("SELECT COUNT(*) FROM pending").fetchone()[0]
+        return {"items": len(self._data), "fields": sorted(f for f, ids in self._fields.items() if ids),
+                "pending": pending}
+
+    # === Lọc ===
+
+    def select(self, expr):
+        # Mảng ID (int64, tăng dần) thỏa biểu thức lọc; expr là chuỗi JSON chuẩn (xem canonical)
+        self.refresh()
+        with self._lock:
+            ids = self._cache.get(expr)
+            if ids is None:
+                try:
+                    parsed = json.loads(expr)
+                except ValueError:
+                    raise MetadataError("filter không phải JSON hợp lệ")
+                ids = np.array(sorted(self._eval(parsed)), dtype="int64")
+                self._cache[expr] = ids
+                if len(self._cache) > FILTER_CACHE_SIZE:
+                    self._cache.popitem(last=False)
+            else:
+                self._cache.move_to_end(expr)
+        return ids
+
+    def _eval(self, expr):
+        # {"category": "dress", "tags": {"$in": [...]}, "price": {"$lt": 100}, "$or": [...], "$not": {...}}
+        if not isinstance(expr, dict):
+            raise MetadataError("Biểu thức lọc phải là object JSON")
+        sets = []
+        for key, cond in expr.items():
+            if key in ("$and", "$or"):
+                if not isinstance(cond, list) or not cond:
+                    raise MetadataError(f"{key} cần một danh sách biểu thức")
+                parts = [self._eval(e) for e in cond]
+                sets.append(set.intersection(*parts) if key == "$and" else set().union(*parts))
+            elif key == "$not":
+                sets.append(set(self._data) - self._eval(cond))
+            elif key.startswith("$"):
+                raise MetadataError(f"Toán tử không hỗ trợ: {key}")
+            else:
+                sets.append(self._eval_field(key, cond))
+        if not sets:
+            return set(self._data)
+        sets.sort(key=len)
+        return sets[0].intersection(*sets[1:])
+
+    def _eval_field(self, field, cond):
+        if not isinstance(cond, dict):
+            return self._equal(field, cond)
+        sets = []
+        bounds = {op: cond[op] for op in RANGE_OPS if op in cond}
+        if bounds:
+            sets.append(self._range(field, bounds))
+        for op, value in cond.items():
+            if op in RANGE_OPS:
+                continue
+            if op == "$eq":
+                sets.append(self._equal(field, value))
+            elif op == "$ne":
+                sets.append(set(self._data) - self._equal(field, value))
+            elif op in ("$in", "$nin"):
+                if not isinstance(value, list):
+                    raise MetadataError(f"{field}: {op} cần một danh sách giá trị")
+                found = set().union(*[self._equal(field, v) for v in value])
+                sets.append(found if op == "$in" else set(self._data) - found)
+            elif op == "$exists":
+                found = set(self._fields.get(field, ()))
+                sets.append(found if value else set(self._data) - found)
+            else:
+                raise MetadataError(f"{field}: toán tử không hỗ trợ {op}")
+        if not sets:
+            raise MetadataError(f"{field}: điều kiện rỗng")
+        sets.sort(key=len)
+        return sets[0].intersection(*sets[1:])
+
+    def _equal(self, field, value):
+        if isinstance(value, (str, bool)):
+            return set(self._postings.get(field, {}).get(value, ()))
+        if isinstance(value, (int, float)):
+            return self._range(field, {"$gte": value, "$lte": value})
+        if value is None:
+            return set(self._data) - self._fields.get(field, set())
+        raise MetadataError(f"{field}: giá trị so sánh phải là chuỗi, số, bool hoặc null")
+
+    def _range(self, field, bounds):
+        for op, value in bounds.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise MetadataError(f"{field}: {op} chỉ dùng với số")
+        values, ids = self._sorted_numbers(field)
+        lo, hi = 0, len(values)
+        if "$gt" in bounds:
+            lo = max(lo, int(np.searchsorted(values, bounds["$gt"], side="right")))
+        if "$gte" in bounds:
+            lo = max(lo, int(np.searchsorted(values, bounds["$gte"], side="left")))
+        if "$lt" in bounds:
+            hi = min(hi, int(np.searchsorted(values, bounds["$lt"], side="left")))
+        if "$lte" in bounds:
+            hi = min(hi, int(np.searchsorted(values, bounds["$lte"], side="right")))
+        return set(ids[lo:hi].tolist()) if lo < hi else set()
+
+    def _sorted_numbers(self, field):
+        # Dựng lại mảng đã sắp xếp của trường số khi có thay đổi, dùng cho mọi truy vấn sau đó
+        cached = self._sorted.get(field)
+        if cached is None:
+            pairs = [(v, i) for i, vs in self._numbers.get(field, {}).items() for v in vs]
+            values = np.array([v for v, _ in pairs], dtype="float64")
+            ids = np.array([i for _, i in pairs], dtype="int64")
+            order = np.argsort(values, kind="stable")
+            cached = self._sorted[field] = (values[order], ids[order])
+        return cached
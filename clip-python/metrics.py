@@ -0,0 +1,143 @@
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+# Bucket cho thời gian (giây) và kích thước batch
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Histogram:
+    # Histogram theo nhãn, định dạng Prometheus (bucket tích lũy, _sum, _count)
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, [list(v[0]), v[1], v[2]]) for k, v in self._series.items())
+        for label_values, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                labels = _format_labels(self.labels + ("le",), label_values + (_format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels + ("le",), label_values + ("+Inf",))
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total:.6f}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for label_values, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}")
+        return lines
+
+
+# === Metric dùng chung cho các module ===
+request_seconds = Histogram("clip_request_seconds", "Thời gian xử lý request theo endpoint",
+                            ("endpoint", "method", "status"))
+stage_seconds = Histogram("clip_stage_seconds", "Thời gian từng bước xử lý", ("stage",))
+batch_size = Histogram("clip_batch_size", "Số item trong một batch", ("batcher",), SIZE_BUCKETS)
+errors_total = Counter("clip_errors_total", "Số lỗi theo bước", ("stage",))
+duplicates_total = Counter("clip_duplicates_total", "Số ảnh trùng được liên kết thay vì thêm vào index", ("kind",))
+
+_metrics = [request_seconds, stage_seconds, batch_size, errors_total, duplicates_total]
+# Hàm thu thập giá trị tức thời (gauge) lúc scrape: trả về list (tên, kiểu, mô tả, [(nhãn dict, giá trị)])
+_collectors = []
+
+
+@contextmanager
+def stage(name):
+    # with metrics.stage("forward"): ... ghi thời gian vào clip_stage_seconds{stage="forward"}
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - start_time, name)
+
+
+def observe_batch(batcher, size):
+    batch_size.observe(size, batcher)
+
+
+def register_collector(collect):
+    _collectors.append(collect)
+
+
+def process_memory():
+    # RSS hiện tại (byte); /proc chỉ có trên Linux, nơi khác dùng RSS đỉnh
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    families = [("clip_process_resident_memory_bytes", "gauge", "RSS của tiến trình",
+                 [({}, process_memory())])]
+    for collect in _collectors:
+        try:
+            families.extend(collect())
+        except Exception as e:
+            print(f"Lỗi thu thập metrics: {e}")
+    for name, kind, help_text, samples in families:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{_format_labels(tuple(labels), tuple(labels.values()))} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,162 @@
+import os
+
+import numpy as np
+
+
+def save_array(path, array):
+    # Ghi file tạm rồi rename: tiến trình khác đang mmap file cũ vẫn đọc được
+    tmp_path = path + ".tmp.npy"
+    with open(tmp_path, "wb") as f:
+        np.save(f, array, allow_pickle=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class PathTable:
+    # Bảng ID -> đường dẫn ảnh. Phần gốc là hai mảng .npy (ID tăng dần, đường dẫn
+    # dạng chuỗi cố định độ dài, không pickle) mở bằng mmap nên tải trong thời gian
+    # hằng số; các thay đổi sau lần lưu gần nhất nằm trong dict/set nhỏ.
+
+    def __init__(self, ids=None, paths=None):
+        self._ids = ids if ids is not None else np.zeros(0, dtype="int64")
+        self._paths = paths if paths is not None else np.zeros(0, dtype="<U1")
+        self._added = {}
+        self._removed = set()
+
+    @classmethod
+    def from_items(cls, ids, paths):
+        ids = np.asarray(ids, dtype="int64")
+        order = np.argsort(ids, kind="stable")
+        return cls(ids[order], np.array(list(paths))[order] if len(ids) else None)
+
+    @classmethod
+    def load(cls, ids_path, paths_path, mmap=True):
+        # Trả về (bảng, thứ tự sắp xếp lại so với file hoặc None)
+        mode = "r" if mmap else None
+        try:
+            paths = np.load(paths_path, mmap_mode=mode, allow_pickle=False)
+        except ValueError:
+            # File cũ lưu mảng object (pickle): đọc một lần, lần lưu sau sẽ đổi định dạng
+            paths = np.array([str(p) for p in np.load(paths_path, allow_pickle=True)])
+        if os.path.exists(ids_path):
+            ids = np.load(ids_path, mmap_mode=mode)
+        else:
+            # Index cũ không có ID: dùng vị trí làm ID
+            ids = np.arange(len(paths), dtype="int64")
+
+        if len(ids) > 1 and not np.all(ids[1:] > ids[:-1]):
+            # File do phiên bản cũ ghi, chưa sắp xếp theo ID
+            order = np.argsort(ids, kind="stable")
+            return cls(np.asarray(ids)[order].astype("int64"), np.asarray(paths)[order]), order
+        return cls(ids, paths), None
+
+    def copy(self):
+        # Dùng chung phần gốc (chỉ đọc), chỉ copy phần thay đổi
+        table = PathTable(self._ids, self._paths)
+        table._added = dict(self._added)
+        table._removed = set(self._removed)
+        return table
+
+    def position(self, id_):
+        # Vị trí của ID trong phần gốc (cũng là số hàng trong file vector float32), -1 nếu không có
+        pos = int(np.searchsorted(self._ids, id_))
+        if pos < len(self._ids) and int(self._ids[pos]) == id_:
+            return pos
+        return -1
+
+    def get(self, id_, default=None):
+        id_ = int(id_)
+        path = self._added.get(id_)
+        if path is not None:
+            return path
+        if id_ in self._removed:
+            return default
+        pos = self.position(id_)
+        return str(self._paths[pos]) if pos >= 0 else default
+
+    def __getitem__(self, id_):
+        path = self.get(id_)
+        if path is None:
+            raise KeyError(id_)
+        return path
+
+    def __contains__(self, id_):
+        return self.get(id_) is not None
+
+    def __len__(self):
+        return len(self._ids) - len(self._removed) + len(self._added)
+
+    def __setitem__(self, id_, path):
+        id_ = int(id_)
+        if self.position(id_) >= 0:
+            self._removed.add(id_)
+        self._added[id_] = path
+
+    def update(self, pairs):
+        for id_, path in pairs:
+            self[id_] = path
+
+    def pop(self, id_, default=None):
+        id_ = int(id_)
+        path = self.get(id_)
+        if path is None:
+            return default
+        self._added.pop(id_, None)
+        if self.position(id_) >= 0:
+            self._removed.add(id_)
+        return path
+
+    def items(self):
+        for pos in range(len(self._ids)):
+            id_ = int(self._ids[pos])
+            if id_ not in self._removed:
+                yield id_, str(self._paths[pos])
+        yield from self._added.items()
+
+    def keys(self):
+        for id_, _ in self.items():
+            yield id_
+
+    def values(self):
+        for _, path in self.items():
+            yield path
+
+    def __iter__(self):
+        return self.keys()
+
+    def ids_for_basename(self, filename):
+        found = []
+        if len(self._paths):
+            paths = np.asarray(self._paths)
+            mask = np.char.endswith(paths, os.sep + filename) | (paths == filename)
+            found = [int(i) for i in np.asarray(self._ids)[mask] if int(i) not in self._removed]
+        return found + [i for i, p in self._added.items() if os.path.basename(p) == filename]
+
+    def id_array(self):
+        # Mảng ID còn sống tăng dần, không duyệt từng phần tử của phần gốc
+        ids = np.asarray(self._ids, dtype="int64")
+        if self._removed:
+            ids = ids[~np.isin(ids, np.fromiter(self._removed, dtype="int64"))]
+        if self._added:
+            ids = np.union1d(ids, np.fromiter(self._added, dtype="int64"))
+        return ids
+
+    def max_id(self):
+        base = int(self._ids[-1]) if len(self._ids) else -1
+        return max([base] + list(self._added))
+
+    def arrays(self):
+        # Hai mảng (ID tăng dần, đường dẫn) của toàn bộ bảng hiện tại
+        if not self._added and not self._removed:
+            return np.asarray(self._ids, dtype="int64"), np.asarray(self._paths)
+        pairs = sorted(self.items())
+        ids = np.array([i for i, _ in pairs], dtype="int64")
+        paths = np.array([p for _, p in pairs]) if pairs else np.zeros(0, dtype="<U1")
+        return ids, paths
+
+    def save(self, ids_path, paths_path):
+        ids, paths = self.arrays()
+        save_array(paths_path, paths)
+        save_array(ids_path, ids)
+        return ids
@@ -0,0 +1,142 @@
+import argparse
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+# Số luồng giải mã + tiền xử lý ảnh, chạy song song với forward của batch trước
+PREPROCESS_WORKERS = int(os.environ.get("PREPROCESS_WORKERS", "4"))
+# reducing_gap của PIL: thu nhỏ nhanh bằng reduce() nguyên lần trước khi resize bicubic;
+# càng lớn càng sát resize đầy đủ, 0 để tắt
+PREPROCESS_REDUCING_GAP = float(os.environ.get("PREPROCESS_REDUCING_GAP", "3.0"))
+# JPEG draft: decoder thu nhỏ 1/2, 1/4, 1/8 ngay khi giải mã nhưng vẫn giữ ảnh lớn hơn
+# DRAFT_MARGIN lần kích thước sau resize, phần còn lại do bicubic (có khử răng cưa) làm
+DRAFT_MARGIN = 2
+# Chênh lệch tối đa (sau chuẩn hóa) cho phép so với AutoImageProcessor ở lần tự kiểm tra
+PREPROCESS_TOLERANCE = 0.05
+
+
+class FastPreprocessor:
+    # Tái hiện AutoImageProcessor của DINOv2 (resize cạnh ngắn -> center crop -> /255 -> chuẩn hóa):
+    #   - resize + crop trong một lần Image.resize(box=...): chỉ tính các pixel của vùng crop
+    #   - JPEG giải mã ở kích thước giảm (draft mode), ảnh 12MP không bao giờ giải mã đầy đủ
+    #   - rescale + chuẩn hóa cả batch bằng một phép nhân-cộng trên tensor
+
+    def __init__(self, shortest_edge, crop_size, mean, std, resample=Image.BICUBIC):
+        self.shortest_edge = int(shortest_edge)
+        self.crop_size = (int(crop_size[0]), int(crop_size[1]))
+        self.resample = int(resample)
+        mean = np.asarray(mean, dtype="float32")
+        std = np.asarray(std, dtype="float32")
+        # x_norm = (x / 255 - mean) / std = x * scale + bias
+        self.scale = (1.0 / (255.0 * std)).reshape(1, 3, 1, 1)
+        self.bias = (-mean / std).reshape(1, 3, 1, 1)
+        self._tensors = None
+
+    @classmethod
+    def from_processor(cls, processor):
+        # None nếu processor dùng bước mà đường nhanh không tái hiện
+        config = processor.to_dict()
+        size = config.get("size") or {}
+        crop = config.get("crop_size") or {}
+        steps = ("do_resize", "do_center_crop", "do_rescale", "do_normalize")
+        if "shortest_edge" not in size or "height" not in crop or not all(config.get(step) for step in steps):
+            return None
+        if size.get("longest_edge") or abs(config.get("rescale_factor", 0) - 1 / 255) > 1e-9:
+            return None
+        return cls(size["shortest_edge"], (crop["height"], crop["width"]),
+                   config["image_mean"], config["image_std"], config.get("resample", Image.BICUBIC))
+
+    def resized_size(self, width, height):
+        # Giống get_resize_output_image_size(default_to_square=False) của transformers
+        short, long = (width, height) if width <= height else (height, width)
+        new_long = int(self.shortest_edge * long / short)
+        return (self.shortest_edge, new_long) if width <= height else (new_long, self.shortest_edge)
+
+    def decode(self, source):
+        image = Image.open(source)
+        if image.format == "JPEG":
+            width, height = self.resized_size(*image.size)
+            image.draft("RGB", (width * DRAFT_MARGIN, height * DRAFT_MARGIN))
+        return image.convert("RGB")
+
+    def prepare(self, image):
+        # Ảnh PIL RGB -> mảng uint8 (crop_h, crop_w, 3)
+        width, height = image.size
+        resized_w, resized_h = self.resized_size(width, height)
+        crop_h, crop_w = self.crop_size
+        top = (resized_h - crop_h) // 2
+        left = (resized_w - crop_w) // 2
+        # Vùng crop quy về tọa độ ảnh gốc
+        sx = width / resized_w
+        sy = height / resized_h
+        box = (left * sx, top * sy, (left + crop_w) * sx, (top + crop_h) * sy)
+        out = image.resize((crop_w, crop_h), self.resample, box=box,
+                           reducing_gap=PREPROCESS_REDUCING_GAP or None)
+        return np.asarray(out, dtype="uint8")
+
+    def load(self, source):
+        return self.prepare(self.decode(source))
+
+    def to_tensor(self, arrays):
+        # Batch uint8 (N, H, W, 3) -> float32 (N, 3, H, W) đã chuẩn hóa
+        import torch
+
+        if self._tensors is None:
+            self._tensors = (torch.from_numpy(self.scale), torch.from_numpy(self.bias))
+        scale, bias = self._tensors
+        batch = torch.from_numpy(np.stack(arrays)).permute(0, 3, 1, 2).contiguous()
+        return torch.addcmul(bias, batch.float(), scale)
+
+
+def self_check(processor, fast):
+    # So sánh trên một ảnh tổng hợp (không phải JPEG: không qua draft) để phát hiện
+    # cấu hình processor mà đường nhanh tái hiện sai
+    rng = np.random.default_rng(0)
+    small = rng.integers(0, 256, size=(24, 32, 3), dtype="uint8")
+    image = Image.fromarray(small).resize((640, 480), Image.BICUBIC)
+    ref = processor(images=[image], return_tensors="pt")["pixel_values"]
+    out = fast.to_tensor([fast.prepare(image)])
+    return float((out - ref).abs().max()) if out.shape == ref.shape else float("inf")
+
+
+def compare(processor, fast, sources):
+    # Chênh lệch pixel_values và thời gian (tính cả giải mã) so với AutoImageProcessor
+    start_time = time.time()
+    ref = processor(images=[Image.open(s).convert("RGB") for s in sources], return_tensors="pt")["pixel_values"]
+    ref_time = time.time() - start_time
+    start_time = time.time()
+    out = fast.to_tensor([fast.load(s) for s in sources])
+    run_time = time.time() - start_time
+    diff = (out - ref).abs()
+    n = len(sources)
+    return {
+        "images": n,
+        "max_abs_diff": round(float(diff.max()), 4),
+        "mean_abs_diff": round(float(diff.mean()), 5),
+        "reference_ms_per_image": round(ref_time * 1000 / n, 2),
+        "ms_per_image": round(run_time * 1000 / n, 2),
+        "speedup": round(ref_time / max(run_time, 1e-9), 2)
+    }, ref, out
+
+
+if __name__ == '__main__':
+    # So sánh với AutoImageProcessor trên ảnh thật, ví dụ:
+    #   python preprocess.py image_storage --images 64
+    from transformers import AutoImageProcessor
+
+    parser = argparse.ArgumentParser(description="Đo tốc độ và độ lệch của tiền xử lý nhanh")
+    parser.add_argument("image_dir")
+    parser.add_argument("--images", type=int, default=32)
+    parser.add_argument("--model", default=os.environ.get("DINO_MODEL_ID", "facebook/dinov2-base"))
+    args = parser.parse_args()
+
+    files = sorted(f for f in os.listdir(args.image_dir) if f.lower().endswith(('.jpg', '.jpeg', '.png')))
+    sources = [os.path.join(args.image_dir, f) for f in files[:args.images]]
+    processor = AutoImageProcessor.from_pretrained(args.model)
+    fast = FastPreprocessor.from_processor(processor)
+    if fast is None:
+        raise SystemExit(f"Processor {type(processor).__name__} không được hỗ trợ")
+    print(f"Tự kiểm tra: chênh lệch tối đa {self_check(processor, fast):.4f}")
+    print(compare(processor, fast, sources)[0])
@@ -0,0 +1,120 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# Bật bằng PROFILE_SLOW_MS > 0: request chậm hơn ngưỡng được ghi stack đã lấy mẫu
+# ra file định dạng "folded" (mỗi dòng "hàm1;hàm2;hàm3 số mẫu"), dùng trực tiếp với
+# flamegraph.pl hoặc speedscope
+PROFILE_SLOW_MS = float(os.environ.get("PROFILE_SLOW_MS", "0"))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+# Giữ tối đa bấy nhiêu file, file cũ nhất bị xóa
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", "50"))
+# Thread nền làm việc thay cho request (theo tiền tố tên): gom truy vấn (forward + search),
+# dựng lại/snapshot index, giải mã ảnh, gọi shard. Mẫu của chúng được ghi vào mọi request
+# đang theo dõi, dưới nhánh "[thread <tên>]"
+PROFILE_THREADS = tuple(t.strip() for t in os.environ.get(
+    "PROFILE_THREADS", "search,index-rebuild,index-snapshot,decode,shard").split(",") if t.strip())
+# Thread nền đang chờ việc (đỉnh stack nằm trong các module này) không được ghi
+IDLE_MODULES = ("threading.py", "queue.py", "selectors.py", "thread.py")
+
+
+def _fold(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+def _idle(frame):
+    # Đang chờ trong queue/lock, hoặc hàm vòng lặp của thread đang ở trong lệnh C (time.sleep)
+    if os.path.basename(frame.f_code.co_filename) in IDLE_MODULES:
+        return True
+    caller = frame.f_back
+    return caller is not None and os.path.basename(caller.f_code.co_filename) == "threading.py"
+
+
+class SamplingProfiler:
+    # Một thread lấy mẫu stack của các thread đang xử lý request (và các thread nền trong
+    # PROFILE_THREADS) qua sys._current_frames(); không cần thư viện ngoài và chi phí chỉ
+    # phát sinh khi đang có request được theo dõi
+
+    def __init__(self, slow_ms, interval_ms=5.0, out_dir="profiles", keep=50, threads=PROFILE_THREADS):
+        self.slow_ms = slow_ms
+        self.threads = threads
+        self.interval = interval_ms / 1000.0
+        self.out_dir = out_dir
+        self.keep = keep
+        self.dumps = 0
+        self._active = {}
+        self._lock = threading.Lock()
+        os.makedirs(out_dir, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def begin(self):
+        with self._lock:
+            self._active[threading.get_ident()] = Counter()
+
+    def end(self, name, elapsed):
+        # Trả về đường dẫn file đã ghi nếu request chậm hơn ngưỡng
+        with self._lock:
+            samples = self._active.pop(threading.get_ident(), None)
+        if not samples or elapsed * 1000 < self.slow_ms:
+            return None
+        self.dumps += 1
+        filename = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self.dumps}-{name}-{int(elapsed * 1000)}ms.folded"
+        path = os.path.join(self.out_dir, filename)
+        with open(path, "w") as f:
+            for stack, count in samples.most_common():
+                f.write(f"{stack} {count}\n")
+        self._prune()
+        print(f"Request chậm {name}: {elapsed:.2f}s, profile {path}")
+        return path
+
+    def list(self):
+        # Mới nhất trước
+        files = [os.path.join(self.out_dir, f) for f in os.listdir(self.out_dir) if f.endswith(".folded")]
+        return sorted(files, key=os.path.getmtime, reverse=True)
+
+    def _prune(self):
+        for path in self.list()[self.keep:]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    continue
+                frames = sys._current_frames()
+                background = self._background(frames)
+                for ident, samples in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        samples[_fold(frame)] += 1
+                    for stack in background:
+                        samples[stack] += 1
+
+    def _background(self, frames):
+        # Stack của các thread nền đang chạy (bỏ thread đang chờ việc)
+        stacks = []
+        for thread in threading.enumerate():
+            if not thread.name.startswith(self.threads):
+                continue
+            frame = frames.get(thread.ident)
+            if frame is None or _idle(frame):
+                continue
+            stacks.append(f"[thread {thread.name}];{_fold(frame)}")
+        return stacks
+
+
+profiler = SamplingProfiler(PROFILE_SLOW_MS, PROFILE_INTERVAL_MS, PROFILE_DIR, PROFILE_KEEP) if PROFILE_SLOW_MS > 0 else None
@@ -0,0 +1,81 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import metrics
+
+
+class QueryBatcher:
+    # Gom các truy vấn đồng thời thành một batch: đợi tối đa max_wait_ms kể từ
+    # truy vấn đầu tiên hoặc đến khi đủ max_batch_size, rồi gọi handler một lần.
+    # handler nhận danh sách item và trả về danh sách kết quả cùng thứ tự.
+
+    def __init__(self, handler, max_batch_size=16, max_wait_ms=5.0, name="query-batcher"):
+        self.handler = handler
+        self.name = name
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self.batches = 0
+        self.items = 0
+        self.max_seen = 0
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, item, timeout=None):
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future.result(timeout=timeout)
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            # Thời gian mỗi truy vấn chờ trong hàng đợi trước khi vào batch
+            now = time.perf_counter()
+            for _, _, enqueued in batch:
+                metrics.stage_seconds.observe(now - enqueued, f"{self.name}_wait")
+            metrics.observe_batch(self.name, len(batch))
+            batch = [(item, future) for item, future, _ in batch]
+            items = [item for item, _ in batch]
+            try:
+                results = self.handler(items)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+            self.batches += 1
+            self.items += len(batch)
+            self.max_seen = max(self.max_seen, len(batch))
+
+    def stats(self):
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "batches": self.batches,
+            "avg_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "max_batch_seen": self.max_seen,
+            "queue_depth": self.queue_depth()
+        }
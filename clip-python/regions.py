@@ -0,0 +1,165 @@
+import io
+import os
+import threading
+import time
+
+import numpy as np
+
+import detector
+import embedder
+
+# === Index theo vùng trang phục ===
+# Mỗi vùng DETR phát hiện được lưu thành một vector riêng trong một IndexStore thứ hai;
+# "đường dẫn" của vùng là "<ID ảnh gốc>:<x1>,<y1>,<x2>,<y2>:<nhãn>"
+REGION_INDEX = os.environ.get("REGION_INDEX", "0") == "1"
+# ID vùng suy ra từ ID ảnh gốc: <ID ảnh> * REGION_ID_STRIDE + thứ tự vùng, nên xóa/ghi đè
+# một ảnh chỉ tra các ID đó thay vì duyệt mọi ref trong index vùng
+REGION_ID_STRIDE = 32
+# Số vùng tối đa cho mỗi ảnh (giữ các vùng điểm cao nhất)
+REGION_MAX_PER_IMAGE = min(int(os.environ.get("REGION_MAX_PER_IMAGE", "5")), REGION_ID_STRIDE)
+# Cách gộp điểm các vùng của cùng một ảnh: max hoặc sum
+REGION_AGGREGATE = os.environ.get("REGION_AGGREGATE", "max")
+AGGREGATES = ("max", "sum")
+# Lấy k*factor vùng để sau khi gộp theo ảnh vẫn đủ k ảnh
+REGION_FETCH_FACTOR = int(os.environ.get("REGION_FETCH_FACTOR", "4"))
+
+# Chi phí thêm ảnh ở chế độ này (tính từ lúc khởi động tiến trình)
+_stats = {"images": 0, "regions": 0, "detect_s": 0.0, "embed_s": 0.0}
+_stats_lock = threading.Lock()
+
+
+def region_ref(parent_id, box, label):
+    return f"{int(parent_id)}:{','.join(str(int(v)) for v in box)}:{label}"
+
+
+def parse_ref(ref):
+    parent, box, label = ref.split(":", 2)
+    return int(parent), [int(v) for v in box.split(",")], label
+
+
+def ids_for_refs(refs):
+    # ID vùng theo thứ tự xuất hiện của các vùng cùng ảnh gốc
+    slots = {}
+    ids = []
+    for ref in refs:
+        parent = parse_ref(ref)[0]
+        slot = slots.get(parent, 0)
+        slots[parent] = slot + 1
+        ids.append(parent * REGION_ID_STRIDE + slot if slot < REGION_ID_STRIDE else None)
+    return ids
+
+
+def embed_regions(parent_ids, paths):
+    # Phát hiện (theo batch, có cache) rồi trích xuất đặc trưng từng vùng trong bộ nhớ.
+    # Trả về (vectors, refs, ids) với mỗi vùng một dòng
+    start_time = time.time()
+    images = []
+    keys = []
+    parents = []
+    for parent, path in zip(parent_ids, paths):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            images.append(embedder.load_image(io.BytesIO(data)))
+        except Exception as e:
+            print(f"Lỗi đọc ảnh {path}: {e}")
+            continue
+        keys.append(detector.detect_cache.key(data))
+        parents.append(parent)
+
+    detections = detector.detect_images(images, keys) if images else []
+    detect_time = time.time() - start_time
+
+    crops = []
+    refs = []
+    seen = set()
+    for parent, image, detection in zip(parents, images, detections):
+        order = np.argsort(-detection["scores"])[:REGION_MAX_PER_IMAGE]
+        names = detector.label_names(detection["labels"][order])
+        for box, name in zip(detection["boxes"][order], names):
+            box = detector.clip_box(image, box)
+            if box is None:
+                continue
+            ref = region_ref(parent, box, name)
+            # Box trùng nhau sau khi làm tròn chỉ cần một vector
+            if ref in seen:
+                continue
+            seen.add(ref)
+            crops.append(image.crop(box))
+            refs.append(ref)
+    vectors = embedder.embed_images(crops)
+    embed_time = time.time() - start_time - detect_time
+
+    with _stats_lock:
+        _stats["images"] += len(images)
+        _stats["regions"] += len(refs)
+        _stats["detect_s"] += detect_time
+        _stats["embed_s"] += embed_time
+    print(f"Trích xuất {len(refs)} vùng từ {len(images)} ảnh: {time.time() - start_time:.2f}s")
+    return vectors, refs, ids_for_refs(refs)
+
+
+def region_ids_for(region_store, parent_ids):
+    candidates = (int(p) * REGION_ID_STRIDE + slot for p in parent_ids for slot in range(REGION_ID_STRIDE))
+    return [i for i in candidates if region_store.path(i) is not None]
+
+
+def migrate_ids(region_store):
+    # Index vùng tạo trước khi có REGION_ID_STRIDE (ID tăng dần): đánh lại ID một lần lúc khởi động.
+    # Đã kiểm tra/đánh lại thì ghi dấu vào meta của index vùng, các lần khởi động sau không duyệt lại
+    if region_store.meta().get("region_id_stride") == REGION_ID_STRIDE:
+        return 0
+    pairs = sorted((i, ref) for ref, ids in region_store.path_ids().items() for i in ids)
+    refs = [ref for _, ref in pairs]
+    new_ids = ids_for_refs(refs)
+    rows = []
+    if not all(i == new for (i, _), new in zip(pairs, new_ids)):
+        rows = [j for j, i in enumerate(new_ids) if i is not None]
+        vectors = region_store.vectors([pairs[j][0] for j in rows])
+        region_store.replace(vectors, [refs[j] for j in rows], [new_ids[j] for j in rows])
+        print(f"Đánh lại ID cho {len(rows)} vùng theo ID ảnh gốc")
+    region_store.update_meta(region_id_stride=REGION_ID_STRIDE)
+    return len(rows)
+
+
+def aggregate(hits, k, mode="max"):
+    # hits: [(ID vùng, điểm, ref)] -> [(ID ảnh, điểm gộp, box, nhãn)]; box/nhãn là của vùng khớp nhất
+    images = {}
+    for _, score, ref in hits:
+        parent, box, label = parse_ref(ref)
+        entry = images.get(parent)
+        if entry is None:
+            images[parent] = [score, score, box, label]
+            continue
+        entry[0] = max(entry[0], score) if mode == "max" else entry[0] + score
+        if score > entry[1]:
+            entry[1:] = [score, box, label]
+    ranked = sorted(images.items(), key=lambda item: -item[1][0])[:k]
+    return [(parent, total, box, label) for parent, (total, _, box, label) in ranked]
+
+
+def search(region_store, vectors, k, mode="max", **options):
+    hits = region_store.search(vectors, k * REGION_FETCH_FACTOR, **options)
+    return [aggregate(row, k, mode) for row in hits]
+
+
+def status(region_store, store):
+    regions = len(region_store)
+    images = len(store)
+    storage = region_store.codec_status()
+    with _stats_lock:
+        stats = dict(_stats)
+    ingested = max(stats["images"], 1)
+    return {
+        "enabled": True,
+        "aggregate": REGION_AGGREGATE,
+        "regions": regions,
+        "regions_per_image": round(regions / images, 2) if images else 0.0,
+        "vectors_mb": round(storage["bytes_per_vector"] * regions / 1024**2, 2),
+        "ingest": {
+            "images": stats["images"],
+            "regions": stats["regions"],
+            "detect_ms_per_image": round(stats["detect_s"] * 1000 / ingested, 2),
+            "embed_ms_per_image": round(stats["embed_s"] * 1000 / ingested, 2)
+        }
+    }
@@ -0,0 +1,116 @@
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+# Chế độ nhiều tiến trình (tùy chọn, mặc định vẫn là python app.py): một tiến trình ghi (writer)
+# sở hữu mọi thay đổi của index, N tiến trình đọc (reader) dùng chung socket và index mmap.
+# Reader theo dõi WAL/snapshot của writer nên thấy dữ liệu mới mà không cần khởi động lại.
+#   python serve.py
+# Bộ nhớ: mỗi reader giữ một bản model riêng (DINO, cộng DETR nếu PRELOAD_DETR=1), nên RAM cho
+# model ~ SERVE_WORKERS lần so với app.py. Writer không warm-up: chỉ tải model khi có
+# /add, /add-batch hoặc /reload đầu tiên. Máy ít RAM: đặt SERVE_WORKERS nhỏ hoặc dùng app.py
+
+# === Cấu hình ===
+SERVE_HOST = os.environ.get("SERVE_HOST", "0.0.0.0")
+SERVE_PORT = int(os.environ.get("SERVE_PORT", "5000"))
+# Cổng nội bộ của writer, chỉ reader gọi tới
+WRITER_PORT = int(os.environ.get("WRITER_PORT", "5001"))
+# Số luồng PyTorch mỗi tiến trình; mặc định chia đều các core cho các reader
+TORCH_NUM_THREADS = int(os.environ.get("TORCH_NUM_THREADS", "2"))
+SERVE_WORKERS = int(os.environ.get("SERVE_WORKERS", str(max(1, (os.cpu_count() or 1) // TORCH_NUM_THREADS))))
+# Số shard chạy trên máy này (shard.py, cổng SHARD_BASE_PORT + i, dữ liệu ở SHARD_DIR/i);
+# 0: index nằm trong writer. Shard trên máy khác: đặt SHARD_URLS thay vì SERVE_SHARDS
+SERVE_SHARDS = int(os.environ.get("SERVE_SHARDS", "0"))
+SHARD_BASE_PORT = int(os.environ.get("SHARD_BASE_PORT", "5101"))
+SHARD_DIR = os.environ.get("SHARD_DIR", "shards")
+
+
+def run_worker(role, fd=None):
+    # Import trong tiến trình con: biến môi trường (vai trò, chế độ mmap) đã được đặt
+    from werkzeug.serving import make_server
+    import app
+
+    # Warm-up model trước khi nhận request: reader chưa sẵn sàng không lấy kết nối từ socket chung.
+    # Writer chỉ nhận thao tác ghi từ reader, model được tải khi cần
+    if role == "reader":
+        app.warm_up_models()
+    if role == "writer":
+        server = make_server("127.0.0.1", WRITER_PORT, app.app, threaded=True)
+    else:
+        server = make_server(SERVE_HOST, SERVE_PORT, app.app, threaded=True, fd=fd)
+    print(f"✅ {role} (pid {os.getpid()}) sẵn sàng")
+    server.serve_forever()
+
+
+def spawn(role, sock=None):
+    env = dict(os.environ,
+               INDEX_ROLE=role,
+               TORCH_NUM_THREADS=str(TORCH_NUM_THREADS),
+               WRITER_URL=f"http://127.0.0.1:{WRITER_PORT}")
+    if SERVE_SHARDS:
+        env["SHARD_URLS"] = ",".join(f"http://127.0.0.1:{SHARD_BASE_PORT + i}" for i in range(SERVE_SHARDS))
+    args = [sys.executable, os.path.abspath(__file__), "--role", role]
+    pass_fds = ()
+    if role == "reader":
+        # Reader map file index chỉ đọc, các tiến trình dùng chung page cache
+        env["INDEX_LOAD_MODE"] = "mmap"
+        args += ["--fd", str(sock.fileno())]
+        pass_fds = (sock.fileno(),)
+    return subprocess.Popen(args, env=env, pass_fds=pass_fds)
+
+
+def spawn_shard(i):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shard.py")
+    return subprocess.Popen([sys.executable, script, "--dir", os.path.join(SHARD_DIR, str(i)),
+                             "--port", str(SHARD_BASE_PORT + i)])
+
+
+def supervise():
+    # Socket tạo một lần ở tiến trình cha; kernel chia kết nối cho các reader
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((SERVE_HOST, SERVE_PORT))
+    sock.listen(128)
+
+    # docker stop gửi SIGTERM: dừng các tiến trình con rồi thoát
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    # Shard khởi động trước (writer/reader chờ shard sẵn sàng), rồi writer để chạy
+    # WAL replay / job dở dang
+    starters = {f"shard-{i}": (lambda i=i: spawn_shard(i)) for i in range(SERVE_SHARDS)}
+    starters["writer"] = lambda: spawn("writer")
+    for i in range(SERVE_WORKERS):
+        starters[f"reader-{i}"] = lambda: spawn("reader", sock)
+    workers = {name: start() for name, start in starters.items()}
+    print(f"Khởi động {SERVE_SHARDS} shard + 1 writer + {SERVE_WORKERS} reader trên {SERVE_HOST}:{SERVE_PORT} "
+          f"({TORCH_NUM_THREADS} luồng torch/tiến trình)")
+
+    try:
+        while True:
+            time.sleep(1)
+            for name, proc in list(workers.items()):
+                if proc.poll() is not None:
+                    print(f"⚠️ {name} (pid {proc.pid}) dừng với mã {proc.returncode}, khởi động lại")
+                    workers[name] = starters[name]()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in workers.values():
+            proc.terminate()
+        for proc in workers.values():
+            proc.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Chạy dịch vụ với nhiều tiến trình")
+    parser.add_argument("--role", choices=("writer", "reader"))
+    parser.add_argument("--fd", type=int)
+    args = parser.parse_args()
+    if args.role:
+        run_worker(args.role, args.fd)
+    else:
+        supervise()
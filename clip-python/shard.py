@@ -0,0 +1,571 @@
+import argparse
+import base64
+import http.client
+import json
+import os
+import socket
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+
+import metrics
+from embedder import EMBED_DIM
+
+# Chế độ sharded: vector chia theo hash của ID cho N tiến trình shard (cùng máy hoặc máy khác).
+# Tiến trình app giữ ShardedStore (cùng giao diện với IndexStore): search gửi vector truy vấn
+# tới mọi shard song song rồi gộp top-k theo điểm; thêm/xóa chỉ gửi tới shard sở hữu ID.
+#   python shard.py --dir shards/0 --port 5101
+#   python shard.py --dir shards/1 --socket /tmp/clip-shard-1.sock
+#   SHARD_URLS=http://127.0.0.1:5101,unix:///tmp/clip-shard-1.sock python app.py
+
+# === Cấu hình ===
+SHARD_URLS = [u.strip() for u in os.environ.get("SHARD_URLS", "").split(",") if u.strip()]
+# Thời gian chờ tối đa của search trên mỗi shard; shard trả lời chậm hơn bị bỏ qua (kết quả một phần)
+SHARD_TIMEOUT_MS = float(os.environ.get("SHARD_TIMEOUT_MS", "2000"))
+# Thêm/xóa/quản trị: lâu hơn nhiều (train ANN, đổi codec) và không được bỏ qua
+SHARD_WRITE_TIMEOUT = 600
+# Kích thước từng shard được đọc lại tối đa một lần mỗi bấy nhiêu giây
+SHARD_STATUS_TTL = 1.0
+# Số ID tối đa mỗi request tra đường dẫn (/shard/paths) gửi tới một shard
+SHARD_PATHS_CHUNK = 5000
+# Lúc khởi động chờ các shard sẵn sàng tối đa bấy nhiêu giây
+SHARD_CONNECT_TIMEOUT = float(os.environ.get("SHARD_CONNECT_TIMEOUT", "120"))
+
+# Tên file index trong thư mục của mỗi shard
+INDEX_FILE = "faiss_index_dino.idx"
+PATHS_FILE = "features_paths_dino.npy"
+IDS_FILE = "features_ids_dino.npy"
+VECTORS_FILE = "features_vectors_dino.npy"
+WAL_FILE = "index_dino.wal"
+
+
+class ShardError(RuntimeError):
+    pass
+
+
+def shard_of(ids, n):
+    # Shard sở hữu mỗi ID: splitmix64 để ID liên tiếp trải đều trên các shard
+    x = np.asarray(ids, dtype="uint64")
+    with np.errstate(over="ignore"):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        x = x ^ (x >> np.uint64(31))
+    return (x % np.uint64(n)).astype("int64")
+
+
+def encode_vectors(vectors):
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    return base64.b64encode(vectors.tobytes()).decode("ascii")
+
+
+def decode_vectors(data):
+    return np.frombuffer(base64.b64decode(data), dtype="float32").reshape(-1, EMBED_DIM)
+
+
+def encode_ids(ids):
+    return base64.b64encode(np.ascontiguousarray(ids, dtype="int64").tobytes()).decode("ascii")
+
+
+def decode_ids(data):
+    return np.frombuffer(base64.b64decode(data), dtype="int64")
+
+
+# === Kết nối tới shard ===
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class ShardClient:
+    # Một kết nối keep-alive cho mỗi thread; URL dạng http://host:port hoặc unix:///đường/dẫn.sock
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self._local = threading.local()
+
+    def _connect(self, timeout):
+        if self.url.startswith("unix://"):
+            return UnixHTTPConnection(self.url[len("unix://"):], timeout=timeout)
+        parsed = urllib.parse.urlsplit(self.url)
+        return http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=timeout)
+
+    def request(self, method, path, body=None, timeout=SHARD_WRITE_TIMEOUT):
+        payload = json.dumps(body).encode() if body is not None else None
+        headers = {"Content-Type": "application/json"} if payload is not None else {}
+        for attempt in range(2):
+            conn = getattr(self._local, "conn", None)
+            if conn is None:
+                conn = self._local.conn = self._connect(timeout)
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            try:
+                conn.request(method, path, body=payload, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                # Kết nối keep-alive cũ đã bị đóng phía shard: thử lại một lần với kết nối mới.
+                # Mọi lệnh ghi của shard đều lặp lại được (thêm theo ID cho trước, xóa theo ID)
+                conn.close()
+                self._local.conn = None
+                if attempt:
+                    raise
+            except OSError:
+                conn.close()
+                self._local.conn = None
+                raise
+        try:
+            result = json.loads(data) if data else {}
+        except ValueError:
+            raise ShardError(f"{self.url}{path}: HTTP {resp.status}, phản hồi không phải JSON")
+        if resp.status >= 400:
+            raise ShardError(f"{self.url}{path}: HTTP {resp.status} {result.get('error', '')}")
+        return result
+
+
+class ShardHits(list):
+    # Kết quả một dòng truy vấn; missing_shards: các shard không trả lời kịp (kết quả một phần)
+    def __init__(self, hits, missing_shards):
+        super().__init__(hits)
+        self.missing_shards = missing_shards
+
+
+class ShardedStore:
+    # Giao diện của IndexStore mà app dùng, dữ liệu nằm ở các tiến trình shard.
+    # ID được cấp ở đây (tiến trình ghi) rồi gửi tới shard sở hữu, nên ID là duy nhất toàn cục.
+
+    def __init__(self, urls, timeout_ms=SHARD_TIMEOUT_MS):
+        self.shards = [ShardClient(u) for u in urls]
+        self.timeout = timeout_ms / 1000.0
+        self.pool = ThreadPoolExecutor(4 * len(self.shards), thread_name_prefix="shard")
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.read_only = False
+        self._status = [None] * len(self.shards)
+        self._errors = [None] * len(self.shards)
+        self._sizes = [0] * len(self.shards)
+        self._status_time = 0.0
+
+    def __len__(self):
+        if time.time() - self._status_time > SHARD_STATUS_TTL:
+            self.refresh_status()
+        return sum(self._sizes)
+
+    # === Gửi lệnh ===
+
+    def _call(self, shard_ids, method, path, bodies=None, timeout=SHARD_WRITE_TIMEOUT):
+        # Gửi song song; trả về {shard: kết quả hoặc exception}
+        futures = {
+            s: self.pool.submit(self.shards[s].request, method, path, bodies[s] if bodies else None, timeout)
+            for s in shard_ids
+        }
+        wait(list(futures.values()), timeout=timeout)
+        results = {}
+        for s, future in futures.items():
+            if not future.done():
+                results[s] = ShardError(f"{self.shards[s].url}{path}: quá {timeout:.2f}s")
+            elif future.exception() is not None:
+                results[s] = future.exception()
+            else:
+                results[s] = future.result()
+                if "size" in results[s]:
+                    self._sizes[s] = results[s]["size"]
+            self._errors[s] = str(results[s]) if isinstance(results[s], Exception) else None
+        return results
+
+    def _call_all(self, method, path, body=None, timeout=SHARD_WRITE_TIMEOUT):
+        shard_ids = range(len(self.shards))
+        results = self._call(shard_ids, method, path, {s: body for s in shard_ids}, timeout)
+        failed = [f"shard {s}: {r}" for s, r in results.items() if isinstance(r, Exception)]
+        if failed:
+            raise ShardError("; ".join(failed))
+        return [results[s] for s in shard_ids]
+
+    def _group(self, ids):
+        owners = shard_of(ids, len(self.shards))
+        return {int(s): np.flatnonzero(owners == s) for s in np.unique(owners)}
+
+    def refresh_status(self):
+        results = self._call(range(len(self.shards)), "GET", "/shard/status", timeout=self.timeout)
+        for s, result in results.items():
+            if not isinstance(result, Exception):
+                self._status[s] = result
+        self._status_time = time.time()
+        return results
+
+    # === Tải / lưu: mỗi shard tự giữ WAL và snapshot của mình ===
+
+    def load(self):
+        # Chờ mọi shard trả lời: ID mới chỉ được cấp khi đã biết next_id của tất cả shard
+        deadline = time.time() + SHARD_CONNECT_TIMEOUT
+        while True:
+            results = self.refresh_status()
+            failed = {s: r for s, r in results.items() if isinstance(r, Exception)}
+            if not failed:
+                break
+            if time.time() > deadline:
+                raise ShardError("Không kết nối được shard: " + "; ".join(
+                    f"{self.shards[s].url}: {r}" for s, r in failed.items()))
+            time.sleep(0.5)
+        self.next_id = max([self.next_id] + [r["next_id"] for r in results.values()])
+        return sum(self._sizes) > 0
+
+    def refresh(self):
+        pass
+
+    def start_follow(self, interval):
+        pass
+
+    def start_snapshots(self):
+        pass
+
+    # === Thay đổi ===
+
+    def allocate_ids(self, n):
+        with self.lock:
+            ids = list(range(self.next_id, self.next_id + n))
+            self.next_id += n
+        return ids
+
+    def add(self, vectors, paths, ids=None):
+        vectors = np.ascontiguousarray(vectors, dtype="float32").reshape(-1, EMBED_DIM)
+        ids = np.asarray(self.allocate_ids(len(paths)) if ids is None else ids, dtype="int64")
+        if len(ids) == 0:
+            return []
+        with self.lock:
+            self.next_id = max(self.next_id, int(ids.max()) + 1)
+        groups = self._group(ids)
+        bodies = {
+            s: {"vectors": encode_vectors(vectors[rows]), "ids": ids[rows].tolist(), "paths": [paths[j] for j in rows]}
+            for s, rows in groups.items()
+        }
+        results = self._call(groups, "POST", "/shard/add", bodies)
+        failed = [f"shard {s}: {r}" for s, r in results.items() if isinstance(r, Exception)]
+        if failed:
+            raise ShardError("Thêm vector thất bại: " + "; ".join(failed))
+        return ids.tolist()
+
+    def remove(self, ids):
+        ids = np.asarray(list(dict.fromkeys(int(i) for i in ids)), dtype="int64")
+        if len(ids) == 0:
+            return []
+        groups = self._group(ids)
+        results = self._call(groups, "POST", "/shard/remove", {s: {"ids": ids[rows].tolist()} for s, rows in groups.items()})
+        failed = [f"shard {s}: {r}" for s, r in results.items() if isinstance(r, Exception)]
+        if failed:
+            raise ShardError("Xóa vector thất bại: " + "; ".join(failed))
+        return [i for result in results.values() for i in result["removed"]]
+
+    def reset(self):
+        self._call_all("POST", "/shard/reset")
+        self.next_id = 0
+
+    # === Đọc ===
+
+    def path(self, id_):
+        s = int(shard_of([id_], len(self.shards))[0])
+        return self.shards[s].request("GET", f"/shard/path?id={int(id_)}", timeout=self.timeout)["path"]
+
+    def paths(self, ids):
+        # Như path cho nhiều ID: mỗi shard sở hữu một request (song song) cho mỗi SHARD_PATHS_CHUNK ID
+        ids = np.asarray([int(i) for i in ids], dtype="int64")
+        out = [None] * len(ids)
+        for pos in range(0, len(ids), SHARD_PATHS_CHUNK):
+            chunk = ids[pos:pos + SHARD_PATHS_CHUNK]
+            groups = self._group(chunk)
+            results = self._call(groups, "POST", "/shard/paths", {s: {"ids": chunk[rows].tolist()} for s, rows in groups.items()},
+                                 timeout=self.timeout)
+            for s, rows in groups.items():
+                if isinstance(results[s], Exception):
+                    raise results[s]
+                for j, path in zip(rows, results[s]["paths"]):
+                    out[pos + j] = path
+        return out
+
+    def ids_for_filename(self, filename):
+        quoted = urllib.parse.quote(filename)
+        return [i for result in self._call_all("GET", f"/shard/lookup?filename={quoted}", timeout=self.timeout)
+                for i in result["ids"]]
+
+    def path_ids(self):
+        out = {}
+        for result in self._call_all("GET", "/shard/paths"):
+            for i, p in zip(result["ids"], result["paths"]):
+                out.setdefault(p, []).append(i)
+        return out
+
+    def ids_by_path(self):
+        return {p: ids[0] for p, ids in self.path_ids().items()}
+
+    def live_ids(self):
+        return np.unique(np.concatenate([decode_ids(r["ids"]) for r in self._call_all("GET", "/shard/ids")]))
+
+    def vectors(self, ids):
+        ids = np.asarray(ids, dtype="int64")
+        out = np.empty((len(ids), EMBED_DIM), dtype="float32")
+        groups = self._group(ids)
+        results = self._call(groups, "POST", "/shard/vectors", {s: {"ids": ids[rows].tolist()} for s, rows in groups.items()})
+        for s, rows in groups.items():
+            if isinstance(results[s], Exception):
+                raise results[s]
+            out[rows] = decode_vectors(results[s]["vectors"])
+        return out
+
+    def search(self, vectors, k, id_filter=None, **options):
+        # Scatter-gather: mỗi shard trả top-k của nó, gộp lại top-k toàn cục theo điểm.
+        # Shard lỗi hoặc quá SHARD_TIMEOUT_MS bị bỏ qua; chỉ lỗi khi không shard nào trả lời.
+        # id_filter: mỗi shard chỉ nhận các ID nó sở hữu, shard không có ID nào thì không được hỏi
+        vectors = np.ascontiguousarray(vectors, dtype="float32").reshape(-1, EMBED_DIM)
+        body = dict(options, vectors=encode_vectors(vectors), k=k)
+        bodies = {s: body for s in range(len(self.shards))}
+        if id_filter is not None:
+            id_filter = np.asarray(id_filter, dtype="int64")
+            bodies = {s: dict(body, ids=encode_ids(id_filter[pos])) for s, pos in self._group(id_filter).items()}
+            if not bodies:
+                return [ShardHits([], []) for _ in range(len(vectors))]
+        shard_ids = list(bodies)
+        with metrics.stage("shard_search"):
+            results = self._call(shard_ids, "POST", "/shard/search", bodies, self.timeout)
+        missing = [s for s, r in results.items() if isinstance(r, Exception)]
+        for s in missing:
+            metrics.errors_total.inc(1, "shard_search")
+            print(f"⚠️ Shard {self.shards[s].url} không trả lời: {results[s]}")
+        if len(missing) == len(shard_ids):
+            raise ShardError("Không shard nào trả lời")
+
+        rows = [[] for _ in range(len(vectors))]
+        for s, result in results.items():
+            if s in missing:
+                continue
+            for row, hits in zip(rows, result["hits"]):
+                row.extend(hits)
+        out = []
+        for row in rows:
+            row.sort(key=lambda hit: -hit[1])
+            out.append(ShardHits([(int(i), float(score), path) for i, score, path in row[:k]], missing))
+        return out
+
+    # === Trạng thái ===
+
+    def _statuses(self):
+        if time.time() - self._status_time > SHARD_STATUS_TTL:
+            self.refresh_status()
+        return [st for st in self._status if st is not None]
+
+    def shard_status(self):
+        self._statuses()
+        return [{
+            "url": shard.url,
+            "ok": self._errors[s] is None,
+            "error": self._errors[s],
+            "size": self._sizes[s]
+        } for s, shard in enumerate(self.shards)]
+
+    def version_status(self):
+        statuses = [st["version"] for st in self._statuses()]
+        return {
+            "version": max((v["version"] for v in statuses), default=0),
+            "base_vectors": sum(v["base_vectors"] for v in statuses),
+            "delta_vectors": sum(v["delta_vectors"] for v in statuses),
+            "shadowed": sum(v["shadowed"] for v in statuses),
+            "rebuilding": next((v["rebuilding"] for v in statuses if v["rebuilding"]), None),
+            "shards": len(self.shards)
+        }
+
+    def codec_status(self):
+        statuses = [st["storage"] for st in self._statuses()]
+        codecs = {c["codec"] for c in statuses}
+        vectors = sum(self._sizes)
+        total_mb = sum(c["vectors_mb"] for c in statuses)
+        return {
+            "codec": codecs.pop() if len(codecs) == 1 else "mixed",
+            "target_codec": statuses[0]["target_codec"] if statuses else None,
+            "pq_nbits": min((c["pq_nbits"] for c in statuses if c.get("pq_nbits")), default=None),
+            "bytes_per_vector": round(total_mb * 1024**2 / vectors, 2) if vectors else 0,
+            "vectors_mb": round(total_mb, 2)
+        }
+
+    def wal_status(self):
+        statuses = [st["wal"] for st in self._statuses() if st.get("wal")]
+        return {"bytes": sum(w.get("bytes", 0) for w in statuses), "shards": statuses}
+
+    @property
+    def ann(self):
+        # Khác None khi có ít nhất một shard đã dùng ANN
+        kinds = [st["ann"]["kind"] for st in self._statuses()]
+        return next((kind for kind in kinds if kind != "flat"), None)
+
+    def ann_status(self):
+        statuses = [st["ann"] for st in self._statuses()]
+        kinds = sorted({a["kind"] for a in statuses})
+        return {
+            "kind": kinds[0] if len(kinds) == 1 else ",".join(kinds),
+            "building": any(a["building"] for a in statuses),
+            "promote_threshold": statuses[0]["promote_threshold"] if statuses else None,
+            "stale": sum(a["stale"] for a in statuses),
+            "shards": statuses
+        }
+
+    def build_ann_async(self, kind=None):
+        results = self._call_all("POST", "/shard/ann/build", {"kind": kind})
+        self._status_time = 0.0
+        return any(r["started"] for r in results)
+
+    def recall_check(self, k=10, num_queries=200, nprobe_values=None, ef_search_values=None):
+        # Recall của từng shard trên chính dữ liệu của shard đó
+        body = {"k": k, "queries": num_queries, "nprobe": nprobe_values, "ef_search": ef_search_values}
+        results = self._call_all("POST", "/shard/ann/recall", body)
+        return [dict(row, shard=s) for s, r in enumerate(results) for row in r["results"]]
+
+    def migrate_codec(self, codec):
+        results = self._call(range(len(self.shards)), "POST", "/shard/codec", {s: {"codec": codec} for s in range(len(self.shards))})
+        errors = [r for r in results.values() if isinstance(r, Exception)]
+        self._status_time = 0.0
+        if errors:
+            raise ValueError("; ".join(str(e) for e in errors))
+        return any(r["changed"] for r in results.values())
+
+
+# === Tiến trình shard ===
+
+def create_app(store):
+    from flask import Flask, jsonify, request
+
+    shard_app = Flask(__name__)
+
+    def status():
+        return {
+            "size": len(store),
+            "next_id": store.next_id,
+            "version": store.version_status(),
+            "storage": store.codec_status(),
+            "ann": store.ann_status(),
+            "wal": store.wal_status()
+        }
+
+    @shard_app.route('/healthz')
+    def liveness():
+        return jsonify({"status": "ok", "pid": os.getpid()})
+
+    @shard_app.route('/shard/status')
+    def shard_status():
+        return jsonify(status())
+
+    @shard_app.route('/shard/search', methods=['POST'])
+    def shard_search():
+        data = request.json
+        options = {name: data.get(name) for name in ("exact", "nprobe", "ef_search", "rerank", "rerank_factor")}
+        options["exact"] = bool(options["exact"])
+        if data.get("ids") is not None:
+            options["id_filter"] = decode_ids(data["ids"])
+        vectors = decode_vectors(data["vectors"])
+        if len(store) == 0:
+            return jsonify({"hits": [[] for _ in range(len(vectors))], "size": 0})
+        hits = store.search(vectors, int(data["k"]), **options)
+        return jsonify({"hits": [[[i, round(float(score), 6), path] for i, score, path in row] for row in hits],
+                        "size": len(store)})
+
+    @shard_app.route('/shard/add', methods=['POST'])
+    def shard_add():
+        data = request.json
+        ids = store.add(decode_vectors(data["vectors"]), data["paths"], data["ids"])
+        return jsonify({"ids": ids, "size": len(store)})
+
+    @shard_app.route('/shard/remove', methods=['POST'])
+    def shard_remove():
+        removed = store.remove(request.json["ids"])
+        return jsonify({"removed": removed, "size": len(store)})
+
+    @shard_app.route('/shard/reset', methods=['POST'])
+    def shard_reset():
+        store.reset()
+        return jsonify({"size": 0})
+
+    @shard_app.route('/shard/path')
+    def shard_path():
+        return jsonify({"path": store.path(request.args.get('id', type=int))})
+
+    @shard_app.route('/shard/lookup')
+    def shard_lookup():
+        return jsonify({"ids": store.ids_for_filename(request.args.get('filename', ''))})
+
+    @shard_app.route('/shard/paths', methods=['GET', 'POST'])
+    def shard_paths():
+        # ids (query "1,2,3" hoặc body JSON): đường dẫn của các ID đó; không có ids: mọi cặp (ID, đường dẫn),
+        # kể cả nhiều ID cùng một đường dẫn
+        ids = request.json.get("ids") if request.is_json else None
+        if ids is None and request.args.get('ids'):
+            ids = [int(i) for i in request.args['ids'].split(",")]
+        if ids is not None:
+            return jsonify({"paths": store.paths(ids)})
+        pairs = [(i, p) for p, ids in store.path_ids().items() for i in ids]
+        return jsonify({"ids": [i for i, _ in pairs], "paths": [p for _, p in pairs]})
+
+    @shard_app.route('/shard/ids')
+    def shard_ids():
+        return jsonify({"ids": encode_ids(store.live_ids())})
+
+    @shard_app.route('/shard/vectors', methods=['POST'])
+    def shard_vectors():
+        return jsonify({"vectors": encode_vectors(store.vectors(request.json["ids"]))})
+
+    @shard_app.route('/shard/ann/build', methods=['POST'])
+    def shard_build_ann():
+        started = len(store) > 0 and store.build_ann_async(request.json.get("kind"))
+        return jsonify({"started": bool(started)})
+
+    @shard_app.route('/shard/ann/recall', methods=['POST'])
+    def shard_recall():
+        data = request.json
+        results = store.recall_check(k=data.get("k", 10), num_queries=data.get("queries", 200),
+                                     nprobe_values=data.get("nprobe"), ef_search_values=data.get("ef_search"))
+        return jsonify({"results": results})
+
+    @shard_app.route('/shard/codec', methods=['POST'])
+    def shard_codec():
+        try:
+            changed = store.migrate_codec(request.json["codec"])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify({"changed": changed})
+
+    return shard_app
+
+
+def run_shard(directory, host, port=None, socket_path=None):
+    from werkzeug.serving import make_server
+    from index_store import IndexStore
+
+    os.makedirs(directory, exist_ok=True)
+    store = IndexStore(*(os.path.join(directory, name) for name in (INDEX_FILE, PATHS_FILE, IDS_FILE, VECTORS_FILE)),
+                       wal_path=os.path.join(directory, WAL_FILE))
+    store.load()
+    store.start_snapshots()
+    if socket_path:
+        server = make_server(f"unix://{socket_path}", 0, create_app(store), threaded=True)
+    else:
+        server = make_server(host, port, create_app(store), threaded=True)
+    print(f"✅ Shard {directory} ({len(store)} vector) sẵn sàng trên {socket_path or f'{host}:{port}'}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Chạy một shard của index")
+    parser.add_argument("--dir", required=True, help="Thư mục chứa index, WAL và snapshot của shard")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5101)
+    parser.add_argument("--socket", help="Lắng nghe trên Unix socket thay vì TCP")
+    args = parser.parse_args()
+    run_shard(args.dir, args.host, args.port, args.socket)
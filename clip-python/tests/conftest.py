@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+# Các module của dịch vụ nằm ngay trong clip-python/ (không đóng gói thành package)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def app_module(tmp_path_factory):
+    # app mở index, manifest, hàng đợi job... theo đường dẫn tương đối: import trong thư mục tạm
+    work = tmp_path_factory.mktemp("app")
+    cwd = os.getcwd()
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("WAL_FSYNC", "0")
+        mp.setenv("REGION_INDEX", "0")
+        mp.setenv("INDEX_ROLE", "standalone")
+        mp.setenv("DEDUP_MODE", "near")
+        mp.setenv("INDEX_CODEC", "flat")
+        mp.delenv("SHARD_URLS", raising=False)
+        os.chdir(work)
+        try:
+            import app
+            storage = work / "image_storage"
+            storage.mkdir()
+            mp.setattr(app, "STORAGE_DIR", str(storage))
+            yield app
+        finally:
+            os.chdir(cwd)
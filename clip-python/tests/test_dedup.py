@@ -0,0 +1,246 @@
+import io
+import os
+
+import numpy as np
+import pytest
+
+from embedder import EMBED_DIM
+
+
+def fake_vector(data):
+    # b"base:3" -> vector đơn vị e3; b"base:3:near" -> lệch nhẹ khỏi e3 (cosine ~0.9988)
+    parts = data.decode().split(":")
+    v = np.zeros(EMBED_DIM, dtype="float32")
+    v[int(parts[1])] = 1.0
+    if len(parts) > 2:
+        v[int(parts[1]) + 100] = 0.05
+    return v / np.linalg.norm(v)
+
+
+def fake_embed(paths):
+    vectors = []
+    for path in paths:
+        with open(path, "rb") as f:
+            vectors.append(fake_vector(f.read()))
+    return np.vstack(vectors) if vectors else np.zeros((0, EMBED_DIM), dtype="float32"), list(paths), {}
+
+
+@pytest.fixture
+def app(app_module, monkeypatch):
+    # /add đi qua embed_each thật, chỉ bước forward của model được thay
+    monkeypatch.setattr(app_module.embedder, "embed_bytes", lambda data, persist=True: fake_vector(data))
+    app_module.app.test_client().post("/reset")
+    return app_module
+
+
+def add(app, name, data, **form):
+    form["image"] = (io.BytesIO(data), name)
+    response = app.app.test_client().post("/add", data=form)
+    assert response.status_code == 200, response.json
+    return response.json
+
+
+def path_of(app, name):
+    return os.path.join(app.STORAGE_DIR, name)
+
+
+def vector_of(app, name):
+    [i] = app.store.path_ids()[path_of(app, name)]
+    return app.store.vectors([i])[0]
+
+
+def test_exact_duplicate_is_linked(app):
+    first = add(app, "a.jpg", b"base:1")
+    dup = add(app, "b.jpg", b"base:1", metadata='{"category": "dress"}')
+
+    assert dup["duplicate"] == "exact" and dup["duplicate_of"] == first["id"]
+    assert len(app.store) == 1
+    assert os.path.exists(path_of(app, "b.jpg"))
+    assert app.file_manifest.duplicate_counts() == {"exact": 1, "near": 0}
+    assert app.file_manifest.entries()[path_of(app, "b.jpg")][-1] == first["id"]
+    # Metadata của file trùng chờ đến khi file thành ảnh gốc
+    assert app.metadata_index.stats()["pending"] == 1
+
+    listed = app.app.test_client().get("/duplicates").json["duplicates"]
+    assert listed == [{"path": path_of(app, "b.jpg"), "duplicate_of": first["id"],
+                       "canonical_path": path_of(app, "a.jpg"), "kind": "exact", "score": 1.0}]
+
+
+def test_near_duplicate_is_linked(app):
+    first = add(app, "a.jpg", b"base:2")
+    dup = add(app, "b.jpg", b"base:2:near")
+
+    assert dup["duplicate"] == "near" and dup["duplicate_of"] == first["id"]
+    assert dup["score"] == pytest.approx(0.9988, abs=1e-3)
+    assert len(app.store) == 1
+    assert app.file_manifest.duplicate_counts() == {"exact": 0, "near": 1}
+
+
+def test_dedupe_off_adds_vector(app):
+    first = add(app, "a.jpg", b"base:1")
+    forced = add(app, "b.jpg", b"base:1", dedupe="0")
+
+    assert forced["id"] != first["id"]
+    assert len(app.store) == 2
+    assert app.file_manifest.duplicate_counts() == {"exact": 0, "near": 0}
+
+
+def test_unreadable_upload_is_not_indexed(app):
+    add(app, "a.jpg", b"base:1")
+    response = app.app.test_client().post("/add", data={"image": (io.BytesIO(b"not an image"), "bad.jpg")})
+
+    assert response.status_code == 500 and "error" in response.json
+    assert len(app.store) == 1
+    assert path_of(app, "bad.jpg") not in app.file_manifest.entries()
+
+
+def test_reupload_overwrites_existing_id(app):
+    first = add(app, "a.jpg", b"base:1")
+    add(app, "b.jpg", b"base:2")
+    again = add(app, "a.jpg", b"base:5")
+
+    assert again["id"] == first["id"]
+    assert app.store.path_ids()[path_of(app, "a.jpg")] == [first["id"]]
+    assert len(app.store) == 2
+    np.testing.assert_allclose(vector_of(app, "a.jpg"), fake_vector(b"base:5"), atol=1e-6)
+    [row] = app.store.search(fake_vector(b"base:1")[None], 2, exact=True)
+    assert all(score < 0.5 for _, score, _ in row)
+    assert app.file_manifest.entries()[path_of(app, "a.jpg")][-1] == first["id"]
+
+
+def test_reupload_same_content_keeps_vector(app):
+    first = add(app, "a.jpg", b"base:1")
+    again = add(app, "a.jpg", b"base:1")
+
+    assert again["id"] == first["id"]
+    assert app.store.path_ids() == {path_of(app, "a.jpg"): [first["id"]]}
+    assert app.file_manifest.duplicates() == {}
+
+
+def test_reupload_promotes_linked_duplicate(app):
+    first = add(app, "a.jpg", b"base:1")
+    add(app, "b.jpg", b"base:1")
+    add(app, "a.jpg", b"base:5")
+
+    ids = app.store.path_ids()
+    assert ids[path_of(app, "a.jpg")] == [first["id"]]
+    [promoted] = ids[path_of(app, "b.jpg")]
+    assert promoted != first["id"]
+    np.testing.assert_allclose(vector_of(app, "b.jpg"), fake_vector(b"base:1"), atol=1e-6)
+    np.testing.assert_allclose(vector_of(app, "a.jpg"), fake_vector(b"base:5"), atol=1e-6)
+    assert app.file_manifest.duplicates() == {}
+    assert app.file_manifest.entries()[path_of(app, "b.jpg")][-1] == promoted
+
+
+def test_reupload_as_duplicate_of_other_image(app):
+    first = add(app, "a.jpg", b"base:1")
+    other = add(app, "c.jpg", b"base:2")
+    again = add(app, "a.jpg", b"base:2")
+
+    assert again["duplicate"] == "exact" and again["duplicate_of"] == other["id"]
+    assert first["id"] not in app.store.live_ids().tolist()
+    assert path_of(app, "a.jpg") not in app.store.path_ids()
+    assert len(app.store) == 1
+    assert os.path.exists(path_of(app, "a.jpg"))
+    assert app.file_manifest.duplicates() == {path_of(app, "a.jpg"): (other["id"], "exact", 1.0)}
+    assert app.file_manifest.entries()[path_of(app, "a.jpg")][-1] == other["id"]
+
+
+def test_deleting_canonical_promotes_duplicate(app):
+    first = add(app, "a.jpg", b"base:1")
+    add(app, "b.jpg", b"base:1", metadata='{"category": "dress"}')
+    add(app, "c.jpg", b"base:1:near")
+
+    response = app.app.test_client().post("/delete", json={"filename": "a.jpg"})
+    assert response.json["ids"] == [first["id"]]
+
+    assert not os.path.exists(path_of(app, "a.jpg"))
+    [promoted] = app.store.path_ids()[path_of(app, "b.jpg")]
+    assert promoted != first["id"]
+    np.testing.assert_allclose(vector_of(app, "b.jpg"), fake_vector(b"base:1"), atol=1e-6)
+    assert app.metadata_index.get(promoted) == {"category": "dress"}
+    assert app.file_manifest.duplicates() == {path_of(app, "c.jpg"): (promoted, "near", pytest.approx(0.9988, abs=1e-3))}
+
+    # Xóa file trùng: chỉ bỏ liên kết và file
+    response = app.app.test_client().post("/delete", json={"filename": "c.jpg"})
+    assert response.json["duplicate_of"] == promoted
+    assert not os.path.exists(path_of(app, "c.jpg"))
+    assert app.file_manifest.duplicates() == {}
+    assert len(app.store) == 1
+
+
+def test_batch_links_duplicates_within_batch(app):
+    files = {"x.jpg": b"base:3", "y.jpg": b"base:3", "z.jpg": b"base:3:near", "w.jpg": b"base:4"}
+    paths = []
+    for name, data in files.items():
+        with open(path_of(app, name), "wb") as f:
+            f.write(data)
+        paths.append(path_of(app, name))
+    infos, errors = app.file_infos(paths)
+    assert errors == {}
+
+    id_of, links, errors = app.ingest_files(paths, infos, embed=fake_embed)
+    assert errors == {}
+    assert sorted(id_of) == [path_of(app, "w.jpg"), path_of(app, "x.jpg")]
+    x = id_of[path_of(app, "x.jpg")]
+    assert sorted((p, i, kind) for p, i, kind, _ in links) == [
+        (path_of(app, "y.jpg"), x, "exact"), (path_of(app, "z.jpg"), x, "near")]
+    assert len(app.store) == 2
+    entries = app.file_manifest.entries()
+    assert {os.path.basename(p): e[-1] for p, e in entries.items()} == {
+        "x.jpg": x, "y.jpg": x, "z.jpg": x, "w.jpg": id_of[path_of(app, "w.jpg")]}
+
+    # Batch sau: trùng nội dung với ảnh gốc của batch trước, nhận ra bằng hash, không trích xuất
+    with open(path_of(app, "v.jpg"), "wb") as f:
+        f.write(b"base:4")
+    infos, _ = app.file_infos([path_of(app, "v.jpg")])
+    w = app.store.path_ids()[path_of(app, "w.jpg")][0]
+    id_of, links, _ = app.ingest_files([path_of(app, "v.jpg")], infos, embed=fake_embed)
+    assert id_of == {} and links == [(path_of(app, "v.jpg"), w, "exact", 1.0)]
+
+
+class FakeJob:
+    # Thay cho job của JobQueue: chỉ ghi lại các file đã báo xong
+    def __init__(self, paths, resumed=False):
+        self.id = "test"
+        self.params = {}
+        self.resumed = resumed
+        self.paths = paths
+        self.reported = []
+
+    def pending_files(self):
+        return list(self.paths)
+
+    def report(self, paths, errors=None, added=0):
+        self.reported.extend(paths)
+
+
+def write(app, name, data):
+    with open(path_of(app, name), "wb") as f:
+        f.write(data)
+    return path_of(app, name)
+
+
+def test_ingest_job_overwrites_reuploaded_file(app, monkeypatch):
+    monkeypatch.setattr(app.embedder, "embed_paths", fake_embed)
+    first = add(app, "a.jpg", b"base:1")
+    job = FakeJob([write(app, "a.jpg", b"base:5"), write(app, "b.jpg", b"base:6")])
+    app.run_ingest_job(job)
+
+    ids = app.store.path_ids()
+    assert ids[path_of(app, "a.jpg")] == [first["id"]]
+    np.testing.assert_allclose(vector_of(app, "a.jpg"), fake_vector(b"base:5"), atol=1e-6)
+    assert len(ids[path_of(app, "b.jpg")]) == 1
+    assert sorted(job.reported) == sorted(job.paths)
+
+
+def test_resumed_ingest_job_skips_indexed_files(app, monkeypatch):
+    monkeypatch.setattr(app.embedder, "embed_paths", fake_embed)
+    first = add(app, "a.jpg", b"base:1")
+    job = FakeJob([write(app, "a.jpg", b"base:5"), write(app, "b.jpg", b"base:6")], resumed=True)
+    app.run_ingest_job(job)
+
+    np.testing.assert_allclose(vector_of(app, "a.jpg"), fake_vector(b"base:1"), atol=1e-6)
+    assert app.store.path_ids()[path_of(app, "a.jpg")] == [first["id"]]
+    assert path_of(app, "b.jpg") in app.store.path_ids()
+    assert sorted(job.reported) == sorted(job.paths)
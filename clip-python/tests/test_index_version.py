@@ -0,0 +1,187 @@
+import threading
+
+import numpy as np
+import pytest
+
+import index_store
+from embedder import EMBED_DIM
+from index_store import IndexStore
+
+
+def vec(i):
+    # Vector đơn vị cố định theo ID: truy vấn bằng vec(i) luôn trả i ở đầu
+    v = np.random.default_rng(int(i)).standard_normal(EMBED_DIM).astype("float32")
+    return v / np.linalg.norm(v)
+
+
+def vecs(ids):
+    return np.vstack([vec(i) for i in ids])
+
+
+def path(i):
+    return f"/img/{i}.jpg"
+
+
+def open_store(tmp_path):
+    d = str(tmp_path)
+    return IndexStore(f"{d}/index.idx", f"{d}/paths.npy", f"{d}/ids.npy", f"{d}/vectors.npy",
+                      wal_path=f"{d}/index.wal")
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(index_store, "WAL_FSYNC", False)
+    monkeypatch.setattr(index_store, "INDEX_CODEC", "flat")
+    s = open_store(tmp_path)
+    s.load()
+    return s
+
+
+def add(store, ids):
+    return store.add(vecs(ids), [path(i) for i in ids], ids=ids)
+
+
+def test_pinned_version_is_not_changed_by_add_and_remove(store):
+    add(store, range(10))
+    store.save()
+    add(store, range(10, 15))
+    pinned = store.current
+    before = dict(pinned.table.items())
+
+    add(store, range(15, 20))
+    store.remove([0, 11])
+    store.add(vecs([99]), [path(3)], ids=[3])
+
+    assert dict(pinned.table.items()) == before
+    assert pinned.n == 5 and not pinned.shadowed
+    np.testing.assert_allclose(pinned.exact_vectors([3, 11], pinned.delta_positions()), vecs([3, 11]))
+    top = [[i for i, _ in row] for row in pinned.search_delta(vecs([11, 12]), 1)]
+    assert top == [[11], [12]]
+
+    cur = store.current
+    assert 0 not in cur.table and 11 not in cur.table
+    assert {0, 3, 11} <= cur.shadowed
+    np.testing.assert_allclose(store.vectors([3]), vecs([99]))
+
+
+def test_search_during_concurrent_add_remove_and_rebuild(store):
+    stable = list(range(50))
+    add(store, stable)
+    store.save()
+    stop = threading.Event()
+    errors = []
+
+    def writer():
+        next_id = 1000
+        try:
+            for _ in range(60):
+                batch = list(range(next_id, next_id + 20))
+                add(store, batch)
+                store.remove(batch[::2])
+                next_id += 20
+        except Exception as e:
+            errors.append(e)
+        finally:
+            stop.set()
+
+    def rebuilder():
+        while not stop.is_set():
+            store.save()
+
+    def searcher():
+        rng = np.random.default_rng()
+        while not stop.is_set():
+            ids = rng.choice(stable, size=4, replace=False)
+            for want, row in zip(ids, store.search(vecs(ids), 5, exact=True)):
+                got = [i for i, _, _ in row]
+                try:
+                    assert got[0] == want
+                    assert len(set(got)) == len(got)
+                    assert all(p == path(i) for i, _, p in row)
+                    scores = [d for _, d, _ in row]
+                    assert scores == sorted(scores, reverse=True)
+                    assert all(i < 50 or 1000 <= i < 2200 for i in got)
+                except AssertionError as e:
+                    errors.append(e)
+
+    threads = [threading.Thread(target=writer), threading.Thread(target=rebuilder)]
+    threads += [threading.Thread(target=searcher) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+
+    store.save()
+    odd = [i for i in range(1000, 2200) if i % 2]
+    assert store.live_ids().tolist() == stable + odd
+    assert store.current.n == 0 and not store.current.shadowed
+
+
+def test_rebuild_rebases_changes_made_while_writing_snapshot(store, monkeypatch):
+    add(store, range(10))
+    store.save()
+    add(store, [10, 11])
+    store.remove([1])
+    write_snapshot = store._write_snapshot
+
+    def racing_write(*args):
+        # Thay đổi trong lúc snapshot đang ghi ngoài writer lock
+        add(store, [12, 13])
+        store.add(vecs([50]), [path(2) + ".new"], ids=[2])
+        store.add(vecs([51]), [path(10) + ".new"], ids=[10])
+        store.remove([3, 12])
+        return write_snapshot(*args)
+
+    monkeypatch.setattr(store, "_write_snapshot", racing_write)
+    store.save()
+    monkeypatch.undo()
+
+    want_ids = [0, 2, 4, 5, 6, 7, 8, 9, 10, 11, 13]
+    want_paths = {i: path(i) for i in want_ids}
+    want_paths[2] = path(2) + ".new"
+    want_paths[10] = path(10) + ".new"
+    want_vecs = {i: vec(i) for i in want_ids}
+    want_vecs[2] = vec(50)
+    want_vecs[10] = vec(51)
+
+    def check(s):
+        assert s.live_ids().tolist() == want_ids
+        assert dict(zip(want_ids, s.paths(want_ids))) == want_paths
+        np.testing.assert_allclose(s.vectors(want_ids), np.vstack([want_vecs[i] for i in want_ids]), atol=1e-6)
+        for i in (2, 10, 13):
+            [row] = s.search(want_vecs[i][None], 3, exact=True)
+            assert [hit[0] for hit in row].count(i) == 1 and row[0][0] == i
+        [row] = s.search(vec(3)[None], len(want_ids), exact=True)
+        assert 3 not in [hit[0] for hit in row] and 1 not in [hit[0] for hit in row]
+
+    cur = store.current
+    assert {2, 3, 10} <= cur.shadowed
+    assert sorted(cur.live_delta_ids().tolist()) == [2, 10, 13]
+    check(store)
+
+    # Snapshot đã ghi + WAL sau khi xoay cho ra đúng trạng thái đó
+    reopened = open_store(store.index_path.rsplit("/", 1)[0])
+    reopened.load()
+    check(reopened)
+    store.save()
+    assert not store.current.shadowed
+    check(store)
+
+
+def test_overwrite_within_delta_hides_old_vector(store):
+    add(store, range(5))
+    store.add(vecs([50]), [path(2)], ids=[2])
+    store.add(vecs([51]), [path(2)], ids=[2])
+
+    for allowed in (None, np.arange(5)):
+        [row] = store.current.search_delta(vec(2)[None], 5, allowed)
+        assert dict(row)[2] == pytest.approx(float(vec(2) @ vec(51)), abs=1e-6)
+        [row] = store.current.search_delta(vec(51)[None], 1, allowed)
+        assert row[0][0] == 2
+    want = pytest.approx(float(vec(2) @ vec(51)), abs=1e-6)
+    [row] = store.search(vec(2)[None], 5, exact=True)
+    assert [d for i, d, _ in row if i == 2] == [want]
+    store.save()
+    [row] = store.search(vec(2)[None], 5, exact=True)
+    assert [d for i, d, _ in row if i == 2] == [want]
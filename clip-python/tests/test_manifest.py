@@ -0,0 +1,130 @@
+import hashlib
+import os
+
+import pytest
+
+from manifest import Manifest, file_hash, file_info, scan_dir
+
+MODEL = "dino-a"
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    return Manifest(str(tmp_path / "manifest.sqlite3"))
+
+
+@pytest.fixture
+def image_dir(tmp_path):
+    d = tmp_path / "images"
+    d.mkdir()
+    for name, data in [("a.jpg", b"aaa"), ("b.PNG", b"bbbb"), ("c.jpeg", b"c")]:
+        (d / name).write_bytes(data)
+    (d / "notes.txt").write_bytes(b"x")
+    (d / "sub.jpg").mkdir()
+    return d
+
+
+def record(manifest, files, start_id=0):
+    # Ghi manifest như job sau khi trích xuất xong các file
+    rows = []
+    for n, (p, (size, mtime_ns)) in enumerate(sorted(files.items())):
+        rows.append((p, size, mtime_ns, file_hash(p), MODEL, start_id + n))
+    manifest.put(rows)
+    return rows
+
+
+def test_scan_dir_lists_images_only(image_dir):
+    files = scan_dir(str(image_dir))
+    assert sorted(os.path.basename(p) for p in files) == ["a.jpg", "b.PNG", "c.jpeg"]
+    stat = os.stat(image_dir / "b.PNG")
+    assert files[str(image_dir / "b.PNG")] == (stat.st_size, stat.st_mtime_ns)
+
+
+def test_file_info_hashes_content(image_dir, monkeypatch):
+    monkeypatch.setattr("manifest.HASH_CHUNK", 2)
+    size, _, digest = file_info(str(image_dir / "b.PNG"))
+    assert size == 4
+    assert digest == hashlib.sha256(b"bbbb").hexdigest()
+
+
+def test_diff_new_changed_model_and_gone(manifest, image_dir):
+    files = scan_dir(str(image_dir))
+    changed, gone, unchanged = manifest.diff(files, MODEL)
+    assert changed == sorted(files) and gone == [] and unchanged == 0
+
+    record(manifest, files)
+    assert manifest.diff(files, MODEL) == ([], [], 3)
+
+    a, b, c = sorted(files)
+    os.utime(a, ns=(0, files[a][1] + 10 ** 9))
+    (image_dir / "b.PNG").write_bytes(b"bbbbb")
+    os.remove(c)
+    (image_dir / "d.jpg").write_bytes(b"d")
+    files = scan_dir(str(image_dir))
+    changed, gone, unchanged = manifest.diff(files, MODEL)
+    assert changed == sorted([a, b, str(image_dir / "d.jpg")])
+    assert gone == [c]
+    assert unchanged == 0
+
+    # Đổi model: mọi file phải trích xuất lại
+    record(manifest, files)
+    manifest.remove([c])
+    assert manifest.diff(files, "dino-b") == (sorted(files), [], 0)
+
+
+def test_put_replaces_and_remove(manifest, image_dir):
+    rows = record(manifest, scan_dir(str(image_dir)))
+    assert len(manifest) == 3
+    path = rows[0][0]
+    manifest.put([(path, 1, 2, "h", MODEL, 42)])
+    assert manifest.entries()[path] == (1, 2, "h", MODEL, 42)
+    assert len(manifest) == 3
+
+    manifest.remove([path, "/missing.jpg"])
+    assert path not in manifest.entries()
+    assert len(manifest) == 2
+    manifest.clear()
+    assert len(manifest) == 0
+
+
+def test_entries_survive_reopen(tmp_path, manifest, image_dir):
+    rows = record(manifest, scan_dir(str(image_dir)))
+    reopened = Manifest(str(tmp_path / "manifest.sqlite3"))
+    assert reopened.entries() == {r[0]: tuple(r[1:]) for r in rows}
+
+
+def test_find_hashes(manifest):
+    manifest.put([("/a.jpg", 1, 1, "h1", MODEL, 0), ("/b.jpg", 1, 1, "h2", MODEL, 1)])
+    assert manifest.find_hashes(["h1", "h3"]) == {"h1": 0}
+    assert manifest.find_hashes([]) == {}
+
+
+def test_duplicate_links(manifest):
+    manifest.put([("/a.jpg", 1, 1, "h1", MODEL, 0), ("/b.jpg", 1, 1, "h1", MODEL, 0),
+                  ("/c.jpg", 1, 1, "h3", MODEL, 0), ("/d.jpg", 1, 1, "h4", MODEL, 5)])
+    manifest.link([("/b.jpg", 0, "exact", 1.0), ("/c.jpg", 0, "near", 0.99)])
+
+    assert manifest.duplicates() == {"/b.jpg": (0, "exact", 1.0), "/c.jpg": (0, "near", 0.99)}
+    assert manifest.duplicates(["/c.jpg", "/a.jpg"]) == {"/c.jpg": (0, "near", 0.99)}
+    assert manifest.duplicates([]) == {}
+    assert list(manifest.duplicates(limit=1)) == ["/b.jpg"]
+    assert manifest.duplicates_of([0, 5]) == {0: ["/b.jpg", "/c.jpg"]}
+    assert manifest.duplicate_counts() == {"exact": 1, "near": 1}
+
+    manifest.unlink(["/c.jpg"])
+    assert manifest.duplicate_counts() == {"exact": 1, "near": 0}
+    # Xóa dòng manifest cũng xóa liên kết
+    manifest.remove(["/b.jpg"])
+    assert manifest.duplicates() == {}
+
+
+def test_promote_moves_links_to_new_id(manifest):
+    manifest.put([("/a.jpg", 1, 1, "h1", MODEL, 0), ("/b.jpg", 1, 1, "h1", MODEL, 0),
+                  ("/c.jpg", 1, 1, "h3", MODEL, 0), ("/d.jpg", 1, 1, "h4", MODEL, 5)])
+    manifest.link([("/b.jpg", 0, "exact", 1.0), ("/c.jpg", 0, "near", 0.99)])
+    manifest.remove(["/a.jpg"])
+
+    manifest.promote("/b.jpg", 0, 7)
+    assert manifest.duplicates() == {"/c.jpg": (7, "near", 0.99)}
+    assert {p: e[-1] for p, e in manifest.entries().items()} == {"/b.jpg": 7, "/c.jpg": 7, "/d.jpg": 5}
+    assert manifest.find_hashes(["h1"]) == {"h1": 7}
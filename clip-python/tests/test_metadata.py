@@ -0,0 +1,172 @@
+import numpy as np
+import pytest
+
+from metadata import MetadataError, MetadataIndex, canonical, check_metadata
+
+CATEGORIES = ["dress", "shirt", "shoe"]
+
+
+def make_items(n=600):
+    rng = np.random.default_rng(0)
+    items = {}
+    for i in range(n):
+        data = {"category": CATEGORIES[i % 3], "price": int(rng.integers(10, 1000)), "in_stock": bool(i % 4),
+                "tags": ["red" if i % 5 == 0 else "blue", "sale"] if i % 7 == 0 else ["blue"]}
+        if i % 11 == 0:
+            data["sizes"] = [36, 38.5]
+        items[i] = data
+    return items
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "metadata.sqlite3")
+
+
+@pytest.fixture
+def items():
+    return make_items()
+
+
+@pytest.fixture
+def index(db_path, items):
+    m = MetadataIndex(db_path)
+    m.put(items)
+    return m
+
+
+def brute(items, f):
+    return [i for i, d in sorted(items.items()) if f(d)]
+
+
+CASES = [
+    ({}, lambda d: True),
+    ({"category": "dress"}, lambda d: d["category"] == "dress"),
+    ({"category": "dress", "in_stock": True, "price": {"$lt": 300}},
+     lambda d: d["category"] == "dress" and d["in_stock"] and d["price"] < 300),
+    ({"in_stock": False}, lambda d: not d["in_stock"]),
+    ({"tags": "red"}, lambda d: "red" in d["tags"]),
+    ({"tags": {"$in": ["red", "sale"]}}, lambda d: "red" in d["tags"] or "sale" in d["tags"]),
+    ({"$or": [{"category": "shoe"}, {"price": {"$gte": 990}}]},
+     lambda d: d["category"] == "shoe" or d["price"] >= 990),
+    ({"$and": [{"category": "shoe"}, {"price": {"$lte": 500}}]},
+     lambda d: d["category"] == "shoe" and d["price"] <= 500),
+    ({"category": {"$ne": "shirt"}, "price": {"$gt": 100, "$lte": 200}},
+     lambda d: d["category"] != "shirt" and 100 < d["price"] <= 200),
+    ({"$not": {"category": "shoe"}}, lambda d: d["category"] != "shoe"),
+    ({"sizes": 38.5}, lambda d: 38.5 in d.get("sizes", [])),
+    ({"sizes": {"$gt": 37, "$lt": 39}}, lambda d: "sizes" in d),
+    ({"sizes": {"$exists": False}}, lambda d: "sizes" not in d),
+    ({"sizes": None}, lambda d: "sizes" not in d),
+    ({"price": 500}, lambda d: d["price"] == 500),
+    ({"price": {"$eq": 500.0}}, lambda d: d["price"] == 500),
+    ({"category": {"$nin": ["shoe", "dress"]}}, lambda d: d["category"] not in ("shoe", "dress")),
+    ({"color": "red"}, lambda d: False),
+]
+
+
+@pytest.mark.parametrize("expr,f", CASES, ids=[canonical(e) for e, _ in CASES])
+def test_select_matches_brute_force(index, items, expr, f):
+    got = index.select(canonical(expr))
+    assert got.dtype == np.int64
+    assert got.tolist() == brute(items, f)
+
+
+@pytest.mark.parametrize("expr", [
+    {"$foo": 1},
+    {"price": {"$lt": "x"}},
+    {"price": {"$gt": True}},
+    {"a": {"$bogus": 1}},
+    {"tags": {"$in": "red"}},
+    {"a": {}},
+    {"a": [1, 2]},
+    [1],
+    {"$or": []},
+    {"$and": {"a": 1}},
+])
+def test_invalid_filters_raise(index, expr):
+    with pytest.raises(MetadataError):
+        index.select(canonical(expr))
+
+
+def test_invalid_json_filter_raises(index):
+    with pytest.raises(MetadataError):
+        index.select("{category:")
+
+
+@pytest.mark.parametrize("data", [
+    [1],
+    {"$price": 1},
+    {"a": {"b": 1}},
+    {"a": [1, [2]]},
+    {"a": None},
+])
+def test_check_metadata_rejects(data):
+    with pytest.raises(MetadataError):
+        check_metadata(data)
+
+
+def test_canonical_ignores_key_order():
+    assert canonical({"b": 1, "a": {"$lt": 2, "$gt": 0}}) == canonical({"a": {"$gt": 0, "$lt": 2}, "b": 1})
+
+
+def test_put_merge_and_remove(index, items):
+    index.put({0: {"category": "shoe"}})
+    index.put({1: {"price": 5}}, merge=True)
+    index.remove([2, 99999])
+
+    assert index.get(0) == {"category": "shoe"}
+    assert index.get(1) == dict(items[1], price=5)
+    assert index.get(2) is None
+    assert len(index) == len(items) - 1
+    assert index.select(canonical({"price": 5})).tolist() == [1]
+    assert 0 not in index.select(canonical({"price": {"$gte": 0}})).tolist()
+    assert 2 not in index.select(canonical({})).tolist()
+
+
+def test_cached_result_invalidated_on_change(index):
+    expr = canonical({"category": "dress", "price": {"$lt": 300}})
+    first = index.select(expr)
+    assert index.select(expr) is first
+    index.put({first[0]: {"category": "shirt"}})
+    second = index.select(expr)
+    assert first[0] not in second.tolist()
+    assert len(second) == len(first) - 1
+
+
+def test_reader_sees_writer_changes_after_refresh(db_path, index, items):
+    reader = MetadataIndex(db_path)
+    assert len(reader) == len(items)
+    expr = canonical({"category": "shoe"})
+    before = reader.select(expr).tolist()
+    assert 0 not in before
+
+    index.put({0: {"category": "shoe"}})
+    index.remove([2])
+    assert reader.get(0) == items[0]
+    # select đọc các thay đổi mới trước khi lọc
+    assert reader.select(expr).tolist() == sorted(set(before + [0]) - {2})
+    assert reader.get(2) is None
+    assert len(reader) == len(items) - 1
+
+
+def test_stage_then_attach(index):
+    index.stage({"/x/a.jpg": {"category": "bag"}, "/x/b.jpg": {"category": "bag", "price": 1}})
+    assert index.stats()["pending"] == 2
+    assert index.attach([9001, 9002], ["/x/a.jpg", "/x/c.jpg"]) == 1
+    assert index.get(9001) == {"category": "bag"}
+    assert index.get(9002) is None
+    assert index.stats()["pending"] == 1
+    assert index.select(canonical({"category": "bag"})).tolist() == [9001]
+
+    with pytest.raises(MetadataError):
+        index.stage({"/x/d.jpg": {"a": {"b": 1}}})
+
+
+def test_clear(db_path, index):
+    index.stage({"/x/a.jpg": {"category": "bag"}})
+    index.clear()
+    assert len(index) == 0
+    assert index.stats() == {"items": 0, "fields": [], "pending": 0}
+    assert index.select(canonical({})).tolist() == []
+    assert len(MetadataIndex(db_path)) == 0
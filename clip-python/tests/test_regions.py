@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+import index_store
+import regions
+from embedder import EMBED_DIM
+from index_store import IndexStore
+
+
+def open_store(tmp_path):
+    d = str(tmp_path)
+    return IndexStore(f"{d}/regions.idx", f"{d}/paths.npy", f"{d}/ids.npy", f"{d}/vectors.npy",
+                      wal_path=f"{d}/regions.wal")
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(index_store, "WAL_FSYNC", False)
+    s = open_store(tmp_path)
+    s.load()
+    return s
+
+
+def test_migrate_ids_renumbers_legacy_store_once(store, tmp_path, monkeypatch):
+    # Index vùng cũ: ID tăng dần, không theo ID ảnh gốc
+    refs = ["7:0,0,10,10:shirt", "3:5,5,20,20:dress", "7:1,1,9,9:shoe"]
+    vectors = np.random.default_rng(0).standard_normal((3, EMBED_DIM)).astype("float32")
+    store.add(vectors, refs, ids=[0, 1, 2])
+    store.save()
+
+    assert regions.migrate_ids(store) == 3
+    stride = regions.REGION_ID_STRIDE
+    assert store.live_ids().tolist() == [3 * stride, 7 * stride, 7 * stride + 1]
+    assert store.paths([7 * stride, 7 * stride + 1]) == [refs[0], refs[2]]
+    np.testing.assert_allclose(store.vectors([3 * stride]), vectors[1:2])
+    assert sorted(regions.region_ids_for(store, [7])) == [7 * stride, 7 * stride + 1]
+
+    # Lần khởi động sau: dấu trong meta còn qua snapshot, không duyệt lại index vùng
+    store.add(vectors[:1], ["9:0,0,1,1:bag"], ids=[9 * stride])
+    store.save()
+    reopened = open_store(tmp_path)
+    reopened.load()
+    monkeypatch.setattr(reopened, "path_ids", lambda: pytest.fail("migrate_ids duyệt lại index vùng"))
+    assert regions.migrate_ids(reopened) == 0
+
+
+def test_migrate_ids_marks_new_store(store, monkeypatch):
+    assert regions.migrate_ids(store) == 0
+    assert store.meta()["region_id_stride"] == regions.REGION_ID_STRIDE
+    monkeypatch.setattr(store, "path_ids", lambda: pytest.fail("migrate_ids duyệt lại index vùng"))
+    assert regions.migrate_ids(store) == 0
@@ -0,0 +1,169 @@
+import threading
+
+import numpy as np
+import pytest
+from werkzeug.serving import make_server
+
+import index_store
+import shard
+from embedder import EMBED_DIM
+from index_store import IndexStore
+from shard import ShardedStore, ShardError, shard_of
+
+NUM_SHARDS = 3
+NUM_IMAGES = 90
+
+
+def vecs(ids):
+    out = np.vstack([np.random.default_rng(int(i)).standard_normal(EMBED_DIM) for i in ids]).astype("float32")
+    return out / np.linalg.norm(out, axis=1, keepdims=True)
+
+
+def path(i):
+    return f"/img/{i}.jpg"
+
+
+class LocalShard:
+    # Một tiến trình shard chạy trong thread: IndexStore riêng + create_app trên cổng ngẫu nhiên
+    def __init__(self, directory):
+        self.store = IndexStore(*(str(directory / name) for name in (
+            shard.INDEX_FILE, shard.PATHS_FILE, shard.IDS_FILE, shard.VECTORS_FILE)),
+            wal_path=str(directory / shard.WAL_FILE))
+        self.store.load()
+        self.server = make_server("127.0.0.1", 0, shard.create_app(self.store), threaded=True)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self.alive = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        if self.alive:
+            self.alive = False
+            self.server.shutdown()
+            self.server.server_close()
+
+
+@pytest.fixture
+def shards(tmp_path, monkeypatch):
+    monkeypatch.setattr(index_store, "WAL_FSYNC", False)
+    local = []
+    for s in range(NUM_SHARDS):
+        (tmp_path / str(s)).mkdir()
+        local.append(LocalShard(tmp_path / str(s)))
+    yield local
+    for s in local:
+        s.stop()
+
+
+@pytest.fixture
+def sharded(shards):
+    store = ShardedStore([s.url for s in shards])
+    store.load()
+    ids = list(range(NUM_IMAGES))
+    store.add(vecs(ids), [path(i) for i in ids], ids)
+    return store
+
+
+def owned(s, ids=range(NUM_IMAGES)):
+    return [i for i in ids if shard_of([i], NUM_SHARDS)[0] == s]
+
+
+def brute_top(queries, ids, k):
+    ids = list(ids)
+    scores = queries @ vecs(ids).T
+    return [[ids[j] for j in np.argsort(-row)[:k]] for row in scores]
+
+
+def test_add_and_remove_route_by_id_hash(shards, sharded):
+    for s, local in enumerate(shards):
+        assert local.store.live_ids().tolist() == owned(s)
+        assert owned(s)
+    assert len(sharded) == NUM_IMAGES
+    assert sharded.next_id == NUM_IMAGES
+    assert sharded.allocate_ids(2) == [NUM_IMAGES, NUM_IMAGES + 1]
+
+    assert sorted(sharded.remove([1, 2, 3, 2, 999])) == [1, 2, 3]
+    for s, local in enumerate(shards):
+        assert local.store.live_ids().tolist() == [i for i in owned(s) if i not in (1, 2, 3)]
+    assert len(sharded) == NUM_IMAGES - 3
+
+    # ID cấp tiếp sau khi khởi động lại: lấy next_id lớn nhất của các shard
+    restarted = ShardedStore([s.url for s in shards])
+    restarted.load()
+    assert restarted.next_id == NUM_IMAGES
+
+
+def test_lookups_go_to_owning_shard(sharded):
+    assert sharded.paths([5, 999, 40]) == [path(5), None, path(40)]
+    assert sharded.path(7) == path(7)
+    assert sharded.ids_for_filename("12.jpg") == [12]
+    assert sharded.live_ids().tolist() == list(range(NUM_IMAGES))
+    np.testing.assert_allclose(sharded.vectors([3, 60, 8]), vecs([3, 60, 8]), atol=1e-6)
+    sharded.add(vecs([100]), [path(5)], [100])
+    assert sorted(sharded.path_ids()[path(5)]) == [5, 100]
+
+
+def test_search_merges_top_k_across_shards(sharded):
+    queries = np.vstack([vecs([4, 50]), vecs([1000, 1001])])
+    results = sharded.search(queries, 10, exact=True)
+
+    assert [[i for i, _, _ in row] for row in results] == brute_top(queries, range(NUM_IMAGES), 10)
+    for row in results:
+        scores = [d for _, d, _ in row]
+        assert scores == sorted(scores, reverse=True)
+        assert all(p == path(i) for i, _, p in row)
+        assert row.missing_shards == []
+    assert {shard_of([i], NUM_SHARDS)[0] for row in results for i, _, _ in row} == set(range(NUM_SHARDS))
+
+
+def test_filter_is_split_by_owner(shards, sharded):
+    allowed = [i for i in range(0, NUM_IMAGES, 3)]
+    queries = vecs([1000, 1001])
+    results = sharded.search(queries, 5, exact=True, id_filter=allowed)
+    assert [[i for i, _, _ in row] for row in results] == brute_top(queries, allowed, 5)
+
+    # Bộ lọc chỉ gồm ID của shard 0: shard khác không được hỏi, kể cả khi đã dừng
+    only_first = owned(0)[:6]
+    shards[2].stop()
+    results = sharded.search(queries, 3, exact=True, id_filter=only_first)
+    assert [[i for i, _, _ in row] for row in results] == brute_top(queries, only_first, 3)
+    assert all(row.missing_shards == [] for row in results)
+    assert [list(row) for row in sharded.search(queries, 3, id_filter=[])] == [[], []]
+
+
+def test_dead_shard_gives_partial_results(shards, sharded):
+    shards[2].stop()
+    queries = vecs([1000])
+    [row] = sharded.search(queries, 10, exact=True)
+
+    live = [i for i in range(NUM_IMAGES) if shard_of([i], NUM_SHARDS)[0] != 2]
+    assert [i for i, _, _ in row] == brute_top(queries, live, 10)[0]
+    assert row.missing_shards == [2]
+    assert not sharded.shard_status()[2]["ok"]
+
+    # Ghi vào shard đã dừng thì lỗi, không bỏ qua
+    new_id = owned(2, range(NUM_IMAGES, 2 * NUM_IMAGES))[0]
+    with pytest.raises(ShardError):
+        sharded.add(vecs([new_id]), [path(new_id)], [new_id])
+    for local in shards[:2]:
+        local.stop()
+    with pytest.raises(ShardError):
+        sharded.search(queries, 10)
+
+
+def test_app_reports_missing_shards_and_passes_filter(app_module, shards, sharded, monkeypatch):
+    app = app_module
+    monkeypatch.setattr(app, "store", sharded)
+    app.metadata_index.put({i: {"category": "dress" if i % 2 == 0 else "shirt"} for i in range(NUM_IMAGES)})
+    try:
+        shards[2].stop()
+        query = owned(0)[0]
+        response = app.app.test_client().post("/search/by-id", json={
+            "id": query, "k": 5, "exact": True, "filter": {"category": "dress"}})
+        assert response.status_code == 200
+        assert response.headers["X-Missing-Shards"] == shards[2].url
+
+        got = [hit["id"] for hit in response.json]
+        allowed = [i for i in range(NUM_IMAGES) if i % 2 == 0 and i != query and shard_of([i], NUM_SHARDS)[0] != 2]
+        assert got == brute_top(vecs([query]), allowed, 5)[0]
+    finally:
+        app.metadata_index.remove(range(NUM_IMAGES))
@@ -0,0 +1,151 @@
+import os
+
+import numpy as np
+
+from wal import RECORD_HEADER, WriteAheadLog
+
+
+def make_wal(tmp_path):
+    return WriteAheadLog(str(tmp_path / "index.wal"), fsync=False)
+
+
+def vectors(n, seed=0):
+    return np.random.default_rng(seed).standard_normal((n, 8)).astype("float32")
+
+
+def test_replay_returns_records_after_seq(tmp_path):
+    wal = make_wal(tmp_path)
+    vecs = vectors(2)
+    wal.append("add", [0, 1], ["/a.jpg", "/b.jpg"], vecs)
+    wal.append("remove", [0])
+    wal.append("add", [2], ["/c.jpg"], vecs[:1])
+
+    records = make_wal(tmp_path).replay()
+    assert [r["seq"] for r in records] == [1, 2, 3]
+    assert records[0]["paths"] == ["/a.jpg", "/b.jpg"]
+    np.testing.assert_array_equal(records[0]["vectors"], vecs)
+    assert "vectors" not in records[1]
+
+    reader = make_wal(tmp_path)
+    assert [r["seq"] for r in reader.replay(after_seq=2)] == [3]
+    assert reader.seq == 3
+
+
+def test_torn_tail_is_truncated_and_appends_continue(tmp_path):
+    wal = make_wal(tmp_path)
+    wal.append("add", [0], ["/a.jpg"], vectors(1))
+    wal.append("add", [1], ["/b.jpg"], vectors(1, 1))
+    good = os.path.getsize(wal.path)
+    wal.append("add", [2], ["/c.jpg"], vectors(1, 2))
+    wal._file.close()
+    # Crash giữa lúc ghi bản ghi thứ ba: chỉ còn header và một phần thân
+    with open(wal.path, "r+b") as f:
+        f.truncate(good + RECORD_HEADER.size + 5)
+
+    recovered = make_wal(tmp_path)
+    assert [r["ids"] for r in recovered.replay()] == [[0], [1]]
+    assert os.path.getsize(wal.path) == good
+    assert recovered.seq == 2
+
+    assert recovered.append("add", [3], ["/d.jpg"], vectors(1, 3)) == 3
+    recovered._file.close()
+    assert [r["ids"] for r in make_wal(tmp_path).replay()] == [[0], [1], [3]]
+
+
+def test_replay_without_repair_keeps_file(tmp_path):
+    wal = make_wal(tmp_path)
+    wal.append("add", [0], ["/a.jpg"], vectors(1))
+    wal._file.close()
+    with open(wal.path, "ab") as f:
+        f.write(b"\x01\x02\x03")
+    size = os.path.getsize(wal.path)
+
+    assert len(make_wal(tmp_path).replay(repair=False)) == 1
+    assert os.path.getsize(wal.path) == size
+
+
+def test_crc_mismatch_stops_replay(tmp_path):
+    wal = make_wal(tmp_path)
+    wal.append("add", [0], ["/a.jpg"], vectors(1))
+    first = os.path.getsize(wal.path)
+    wal.append("add", [1], ["/b.jpg"], vectors(1, 1))
+    wal.append("add", [2], ["/c.jpg"], vectors(1, 2))
+    wal._file.close()
+    # Hỏng một byte trong thân bản ghi thứ hai: bản ghi đó và mọi bản ghi sau bị bỏ
+    with open(wal.path, "r+b") as f:
+        f.seek(first + RECORD_HEADER.size + 2)
+        byte = f.read(1)
+        f.seek(-1, os.SEEK_CUR)
+        f.write(bytes([byte[0] ^ 0xFF]))
+
+    assert [r["ids"] for r in make_wal(tmp_path).replay()] == [[0]]
+    assert os.path.getsize(wal.path) == first
+
+
+def test_rotate_keeps_segments_until_dropped(tmp_path):
+    wal = make_wal(tmp_path)
+    wal.append("add", [0], ["/a.jpg"], vectors(1))
+    wal.append("add", [1], ["/b.jpg"], vectors(1, 1))
+    assert wal.rotate() == 2
+    wal.append("remove", [0])
+
+    assert [seq for seq, _ in wal.segments()] == [2]
+    assert [r["seq"] for r in make_wal(tmp_path).replay()] == [1, 2, 3]
+    # Snapshot chứa tới seq 2 đã ghi xong: đoạn cũ được xóa, file đang ghi còn nguyên
+    wal.drop_segments(2)
+    assert wal.segments() == []
+    assert [r["seq"] for r in make_wal(tmp_path).replay()] == [3]
+
+
+def test_rotate_without_records_keeps_file(tmp_path):
+    wal = make_wal(tmp_path)
+    assert wal.rotate() == 0
+    assert wal.segments() == []
+
+
+def test_tail_follows_appends_and_rotation(tmp_path):
+    writer = make_wal(tmp_path)
+    writer.append("add", [0], ["/a.jpg"], vectors(1))
+    reader = make_wal(tmp_path)
+    assert [r["seq"] for r in reader.replay(repair=False)] == [1]
+
+    writer.append("add", [1], ["/b.jpg"], vectors(1, 1))
+    assert [r["seq"] for r in reader.tail(1)] == [2]
+    assert reader.tail(2) == []
+
+    # Writer bắt đầu snapshot: file đang ghi thành đoạn, reader đọc lại từ các đoạn
+    writer.rotate()
+    writer.append("remove", [0])
+    assert [r["seq"] for r in reader.tail(2)] == [3]
+
+
+def test_tail_ignores_partial_record_until_complete(tmp_path):
+    writer = make_wal(tmp_path)
+    writer.append("add", [0], ["/a.jpg"], vectors(1))
+    reader = make_wal(tmp_path)
+    reader.replay(repair=False)
+    writer.append("add", [1], ["/b.jpg"], vectors(1, 1))
+    writer._file.close()
+    with open(writer.path, "rb") as f:
+        data = f.read()
+    full = len(data)
+    with open(writer.path, "r+b") as f:
+        f.truncate(full - 4)
+
+    # Bản ghi đang ghi dở chưa được đọc; đọc lại khi writer ghi xong
+    assert reader.tail(1) == []
+    with open(writer.path, "r+b") as f:
+        f.seek(0)
+        f.write(data)
+    assert [r["seq"] for r in reader.tail(1)] == [2]
+
+
+def test_clear_drops_everything(tmp_path):
+    wal = make_wal(tmp_path)
+    wal.append("add", [0], ["/a.jpg"], vectors(1))
+    wal.rotate()
+    wal.append("add", [1], ["/b.jpg"], vectors(1, 1))
+    wal.clear()
+    assert wal.size() == 0
+    assert wal.segments() == []
+    assert make_wal(tmp_path).replay() == []
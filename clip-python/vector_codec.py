@@ -0,0 +1,167 @@
+import argparse
+import json
+import os
+import time
+
+import faiss
+import numpy as np
+
+# Cách mã hóa vector trong index chính:
+#   flat: float32 (3 KB/ảnh), fp16: 1.5 KB/ảnh, sq8: 768 B/ảnh, pq: PQ_M byte/ảnh
+CODECS = ("flat", "fp16", "sq8", "pq")
+PQ_M = int(os.environ.get("INDEX_PQ_M", "96"))
+# Số bit mỗi mã PQ: 8 (256 tâm) khi đủ vector; kho nhỏ dùng ít bit hơn (tối thiểu PQ_MIN_NBITS)
+# để mỗi tâm có ít nhất PQ_TRAIN_POINTS điểm train
+PQ_NBITS = 8
+PQ_MIN_NBITS = 4
+PQ_TRAIN_POINTS = 39
+# Số vector tối đa dùng để train codec
+TRAIN_SAMPLE = 100000
+MIGRATE_CHUNK = 65536
+
+
+def pq_nbits(n):
+    # Số bit lớn nhất (<= PQ_NBITS) mà n vector đủ để train: n >= PQ_TRAIN_POINTS * 2**nbits
+    nbits = PQ_NBITS
+    while nbits > PQ_MIN_NBITS and n < PQ_TRAIN_POINTS * 2 ** nbits:
+        nbits -= 1
+    return nbits
+
+
+def nbits_of(index):
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    return inner.pq.nbits if isinstance(inner, faiss.IndexPQ) else None
+
+
+def make_index(codec, dim, pq_m=PQ_M, nbits=PQ_NBITS):
+    if codec == "flat":
+        inner = faiss.IndexFlatIP(dim)
+    elif codec == "fp16":
+        inner = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+    elif codec == "sq8":
+        inner = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+    elif codec == "pq":
+        inner = faiss.IndexPQ(dim, pq_m, nbits, faiss.METRIC_INNER_PRODUCT)
+    else:
+        raise ValueError(f"Codec không hỗ trợ: {codec}")
+    return faiss.IndexIDMap2(inner)
+
+
+def train_min(codec, pq_m=PQ_M):
+    # Số vector tối thiểu để train codec (0 = không cần train)
+    if codec == "sq8":
+        return 1000
+    if codec == "pq":
+        return PQ_TRAIN_POINTS * 2 ** PQ_MIN_NBITS
+    return 0
+
+
+def codec_of(index):
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if isinstance(inner, faiss.IndexFlat):
+        return "flat"
+    if isinstance(inner, faiss.IndexScalarQuantizer):
+        return "fp16" if inner.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "sq8"
+    if isinstance(inner, faiss.IndexPQ):
+        return "pq"
+    return type(inner).__name__
+
+
+def bytes_per_vector(index):
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if isinstance(inner, faiss.IndexFlat):
+        return inner.d * 4
+    return int(inner.code_size)
+
+
+def meta_path(index_path):
+    return os.path.splitext(index_path)[0] + ".meta.json"
+
+
+def read_meta(index_path):
+    path = meta_path(index_path)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_meta(index_path, meta):
+    path = meta_path(index_path)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def stored_ids(index):
+    return faiss.vector_to_array(index.id_map).astype("int64")
+
+
+def training_sample(index, codec, pq_m=PQ_M):
+    # Lấy mẫu vector đã lưu để train codec (None nếu codec không cần train)
+    need = train_min(codec, pq_m)
+    if not need:
+        return None
+    ids = stored_ids(index)
+    if len(ids) < need:
+        raise ValueError(f"Cần ít nhất {need} vector để train codec {codec}")
+    rng = np.random.default_rng(0)
+    sample = np.sort(rng.choice(len(ids), size=min(TRAIN_SAMPLE, len(ids)), replace=False))
+    return np.vstack([index.index.reconstruct(int(pos)) for pos in sample])
+
+
+def make_trained_index(codec, dim, sample=None, pq_m=PQ_M):
+    index = make_index(codec, dim, pq_m, pq_nbits(len(sample)) if sample is not None else PQ_NBITS)
+    if not index.is_trained:
+        index.train(sample)
+    return index
+
+
+def copy_vectors(src, dst):
+    # Giải mã các vector đã lưu theo từng khối rồi mã hóa lại vào dst,
+    # không cần chạy lại DINO
+    ids = stored_ids(src)
+    for pos in range(0, len(ids), MIGRATE_CHUNK):
+        n = min(MIGRATE_CHUNK, len(ids) - pos)
+        dst.add_with_ids(src.index.reconstruct_n(pos, n), ids[pos:pos + n])
+    return dst
+
+
+def migrate(index, codec, pq_m=PQ_M):
+    sample = training_sample(index, codec, pq_m)
+    return copy_vectors(index, make_trained_index(codec, index.d, sample, pq_m))
+
+
+if __name__ == '__main__':
+    # Chuyển file index có sẵn sang codec khác, ví dụ:
+    #   python vector_codec.py faiss_index_dino.idx --codec sq8
+    parser = argparse.ArgumentParser(description="Chuyển đổi codec của FAISS index")
+    parser.add_argument("index_path")
+    parser.add_argument("--codec", choices=CODECS, required=True)
+    parser.add_argument("--pq-m", type=int, default=PQ_M)
+    parser.add_argument("--output", help="Mặc định ghi đè index_path")
+    args = parser.parse_args()
+
+    start_time = time.time()
+    index = faiss.read_index(args.index_path)
+    if not isinstance(index, faiss.IndexIDMap2):
+        # Index phẳng cũ không có ID: dùng vị trí làm ID (giống IndexStore.load)
+        wrapped = make_index("flat", index.d)
+        if index.ntotal:
+            wrapped.add_with_ids(index.reconstruct_n(0, index.ntotal), np.arange(index.ntotal, dtype="int64"))
+        index = wrapped
+
+    before = bytes_per_vector(index)
+    new_index = migrate(index, args.codec, args.pq_m)
+    output = args.output or args.index_path
+    tmp_path = output + ".tmp"
+    faiss.write_index(new_index, tmp_path)
+    os.replace(tmp_path, output)
+    # Giữ next_id, wal_seq, complete của snapshot: ID đã xóa không được cấp lại sau khi chuyển
+    meta = read_meta(args.index_path)
+    write_meta(output, dict(meta, codec=args.codec, dim=new_index.d, ntotal=new_index.ntotal))
+    print(f"Đã chuyển {new_index.ntotal} vector sang {args.codec}: "
+          f"{before} -> {bytes_per_vector(new_index)} byte/vector ({time.time() - start_time:.2f}s)")
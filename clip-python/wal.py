@@ -0,0 +1,183 @@
+import glob
+import json
+import os
+import struct
+import time
+import zlib
+
+import numpy as np
+
+# Mỗi bản ghi: [độ dài thân][crc32 thân][thân]; thân là header JSON, "\n", rồi vector float32
+RECORD_HEADER = struct.Struct("<II")
+
+
+def fsync_path(path):
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+
+
+class WriteAheadLog:
+    # Nhật ký chỉ ghi nối các thay đổi của index (thêm/xóa) kể từ snapshot gần nhất.
+    # Mỗi lần ghi được fsync nên chi phí một lần thêm ảnh không phụ thuộc kích thước index;
+    # khi khởi động, các bản ghi có seq lớn hơn seq của snapshot được áp dụng lại.
+    # Khi bắt đầu ghi snapshot, file hiện tại được đổi tên thành đoạn "<path>.<seq cuối>"
+    # và chỉ bị xóa sau khi snapshot chứa nó đã ghi xong.
+
+    def __init__(self, path, fsync=True):
+        self.path = path
+        self.fsync = fsync
+        self.seq = 0
+        self.records = 0
+        self.first_time = None
+        self._file = None
+        # Vị trí đã đọc trong file đang ghi (inode, offset), dùng cho tiến trình chỉ đọc
+        self._tail = None
+
+    def segments(self):
+        # Các đoạn WAL đã đóng, theo thứ tự seq
+        found = []
+        for path in glob.glob(glob.escape(self.path) + ".*"):
+            suffix = path[len(self.path) + 1:]
+            if suffix.isdigit():
+                found.append((int(suffix), path))
+        return sorted(found)
+
+    def replay(self, after_seq=0, repair=True):
+        records = []
+        for last_seq, path in self.segments():
+            if last_seq > after_seq:
+                records.extend(self._read(path, after_seq, repair=repair))
+        self.records = 0
+        self._tail = None
+        records.extend(self._read(self.path, after_seq, active=True, repair=repair))
+        self.seq = max(self.seq, after_seq)
+        self.first_time = time.time() if records else None
+        return records
+
+    def tail(self, after_seq):
+        # Đọc các bản ghi ghi thêm kể từ lần đọc trước; nếu file đã được đổi thành
+        # đoạn (tiến trình ghi bắt đầu snapshot) thì đọc lại từ các đoạn
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return []
+        with f:
+            inode = os.fstat(f.fileno()).st_ino
+            if self._tail is None or self._tail[0] != inode:
+                return self.replay(after_seq, repair=False)
+            f.seek(self._tail[1])
+            records, good = self._scan(f, after_seq)
+        self._tail = (inode, good)
+        return records
+
+    def _read(self, path, after_seq, active=False, repair=True):
+        # Đọc các bản ghi hợp lệ; phần đuôi ghi dở do crash bị cắt bỏ khi repair
+        if not os.path.exists(path):
+            return []
+        with open(path, "rb") as f:
+            records, good = self._scan(f, after_seq, active)
+            if active:
+                self._tail = (os.fstat(f.fileno()).st_ino, good)
+            size = os.fstat(f.fileno()).st_size
+        if good < size and repair:
+            print(f"⚠️ WAL {path} bị ghi dở ở byte {good}/{size}, bỏ phần cuối")
+            with open(path, "r+b") as f:
+                f.truncate(good)
+        return records
+
+    def _scan(self, f, after_seq, active=False):
+        # Trả về (bản ghi có seq > after_seq, vị trí sau bản ghi hợp lệ cuối cùng)
+        records = []
+        good = f.tell()
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            length, crc = RECORD_HEADER.unpack(header)
+            body = f.read(length)
+            if len(body) < length or zlib.crc32(body) != crc:
+                break
+            good = f.tell()
+            head, _, raw = body.partition(b"\n")
+            record = json.loads(head)
+            self.seq = max(self.seq, record["seq"])
+            if active:
+                self.records += 1
+            if record["seq"] <= after_seq:
+                continue
+            if raw:
+                record["vectors"] = np.frombuffer(raw, dtype="float32").reshape(len(record["ids"]), -1)
+            records.append(record)
+        return records, good
+
+    def open(self):
+        if self._file is None:
+            self._file = open(self.path, "ab")
+
+    def append(self, op, ids, paths=None, vectors=None):
+        self.open()
+        self.seq += 1
+        head = {"seq": self.seq, "op": op, "ids": [int(i) for i in ids]}
+        if paths is not None:
+            head["paths"] = list(paths)
+        body = json.dumps(head).encode() + b"\n"
+        if vectors is not None:
+            body += np.ascontiguousarray(vectors, dtype="float32").tobytes()
+        self._file.write(RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self.records += 1
+        if self.first_time is None:
+            self.first_time = time.time()
+        return self.seq
+
+    def rotate(self):
+        # Đóng file hiện tại thành một đoạn; trả về seq cuối mà snapshot sắp ghi sẽ chứa
+        if self.records:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            os.replace(self.path, f"{self.path}.{self.seq}")
+            self.records = 0
+            self.first_time = None
+        self.open()
+        return self.seq
+
+    def drop_segments(self, upto_seq):
+        # Gọi sau khi snapshot chứa các bản ghi tới upto_seq đã được ghi xuống đĩa
+        for last_seq, path in self.segments():
+            if last_seq <= upto_seq:
+                os.remove(path)
+
+    def clear(self):
+        self.drop_segments(self.seq)
+        self.open()
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.records = 0
+        self.first_time = None
+
+    def size(self):
+        # Kích thước file đang ghi (chưa tính các đoạn đang chờ snapshot)
+        if self._file is not None:
+            return self._file.tell()
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def due(self, interval, max_bytes):
+        # Chính sách snapshot: có bản ghi chưa snapshot và đã quá thời gian hoặc kích thước
+        if not self.records:
+            return False
+        return time.time() - self.first_time >= interval or self.size() >= max_bytes
+
+    def stats(self):
+        return {
+            "seq": self.seq,
+            "records": self.records,
+            "segments": len(self.segments()),
+            "bytes": self.size(),
+            "age_s": round(time.time() - self.first_time, 1) if self.first_time else 0.0,
+            "fsync": self.fsync
+        }